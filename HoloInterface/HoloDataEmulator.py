@@ -0,0 +1,95 @@
+'''
+Local emulator of the HoloSoftware's measurement protocol, without Qt or a sensor.
+It answers START_ACQUISITION requests by sending the requested buffers_to_return
+(honouring roi and decimation of each buffer description) on the same connection,
+followed by a FUNCTION_READY evaluated_data_ready message.
+Date - 2026-10-19
+Coding: utf-8
+'''
+import json
+import socketserver
+import sys
+from typing import Callable
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.holo_tcp_globals as holo_dll
+import globals.IPM_Holo_Globals as holo_globals
+from globals.holo_data_channel import byte_keys_to_strings, send_buffer
+from globals.holo_result_buffer import ResultBuffer
+
+DEFAULT_SHAPE = (3450, 3456)  # height, width of the result images in ExampleLogFile.txt
+
+
+def synthetic_frame(description: ResultBuffer, shape=DEFAULT_SHAPE) -> numpy.ndarray:
+    '''Deterministic test image for a buffer description: a tilted phase ramp or a smooth amplitude.'''
+    rows, cols = numpy.ogrid[:shape[0], :shape[1]]
+    if description.is_amp:
+        frame = 1.0 + 0.5 * numpy.cos(rows / 97.0) * numpy.sin(cols / 61.0)
+    else:
+        frame = numpy.angle(numpy.exp(1j * (0.01 * cols + 0.02 * rows + (description.laser_nr or 0))))
+    return frame.astype(numpy.float32)
+
+
+class HoloDataEmulator(socketserver.ThreadingTCPServer):
+    '''
+    TCP server emulating the HoloSoftware's command and data interface.
+    frame_source maps a buffer description (without roi) to the full frame that would be sent.
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="localhost", port=2026,
+                 frame_source: Callable[[ResultBuffer], numpy.ndarray] = synthetic_frame):
+        self.frame_source = frame_source
+        super().__init__((host, port), _EmulatorRequestHandler)
+
+    def frame_for(self, description: ResultBuffer) -> numpy.ndarray:
+        full = ResultBuffer(description.processing_step, description.laser_nr, description.img_nr,
+                            description.is_amp, measurement_id=description.measurement_id)
+        return self.frame_source(full)
+
+
+class _EmulatorRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        decoder = json.JSONDecoder()
+        pending = ""
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            pending += data.decode()
+            # the client sends plain concatenated json objects, no separator:
+            while pending.strip():
+                try:
+                    message, end = decoder.raw_decode(pending.lstrip())
+                except json.JSONDecodeError:
+                    break
+                pending = pending.lstrip()[end:]
+                self.handle_message(message)
+
+    def handle_message(self, message: dict):
+        command = message.get(holo_dll.KeysClientToServer().command.decode())
+        if command != holo_dll.ClientToServerCommand.START_ACQUISITION:
+            print(f"HoloDataEmulator: ignoring command {command}")
+            return
+        for jso in message.get(holo_dll.KeysStartAcq().buffers_to_return.decode(), []):
+            description = ResultBuffer()
+            description.from_jso(jso)
+            send_buffer(self.request, description, self.server.frame_for(description))
+
+        keys = holo_dll.KeysFunctionReady()
+        ready = {holo_dll.KeysServerToClient().command: holo_dll.ServerToClientCommand.FUNCTION_READY.value,
+                 keys.KEY_FUNCTION_ID: holo_globals.FunctionId.evaluated_data_ready.value,
+                 keys.KEY_ERROR_CODE: holo_globals.error_codes_IPM.HOLO_SUCCESS.value}
+        self.request.sendall(json.dumps(byte_keys_to_strings(ready)).encode() + b"\n")
+
+
+if __name__ == "__main__":
+    port_to_use = int(sys.argv[1]) if len(sys.argv) > 1 else 2026
+    with HoloDataEmulator(port=port_to_use) as emulator:
+        print(f"HoloDataEmulator listening on port {port_to_use}, "
+              f"serving {cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED.name} et al.")
+        emulator.serve_forever()
@@ -19,6 +19,7 @@ from PySide6.QtWidgets import QApplication, QMainWindow
 import globals.cuda_holo_definitions as cuda_holo
 import globals.holo_tcp_globals as holo_dll
 import globals.IPM_Holo_Globals as holo_globals
+from globals.holo_data_channel import byte_keys_to_strings, read_header, receive_buffer
 from globals.holo_result_buffer import ResultBuffer
 
 
@@ -26,26 +27,6 @@ def qtMessageHandler(mode, context, message):
     print(message, context)
 
 
-def byte_keys_to_strings(json_ob: dict):
-    """convert a dictionary's keys from bytes to strings, recursively."""
-    ret = {}
-    if isinstance(json_ob, dict):
-        for key, val in json_ob.items():
-            if isinstance(key, bytes):
-                key = key.decode()
-            if isinstance(val, dict):
-                val = byte_keys_to_strings(val)
-            elif isinstance(val, (tuple, list, set)):
-                val = [byte_keys_to_strings(x) for x in val]
-            ret[key] = val
-        return ret
-    elif isinstance(json_ob, (tuple, list, set)):
-        val = [byte_keys_to_strings(x) for x in json_ob]  # recurse elements
-        return val
-    else:
-        return json_ob
-
-
 class InterfaceTcpClient:
     """
     Class to connect to the TCP Server.
@@ -185,6 +166,17 @@ class InterfaceTcpClient:
         json_str = json.dumps(json_ob)
         self.sendMessage(json_str)
 
+    def receive_measurement(self, num_buffers, preview_levels=None) -> List[ResultBuffer]:
+        """
+        Receive the buffers_to_return of a request (as sent by HoloDataEmulator) and the final
+        FUNCTION_READY message. Buffers with a ROI/decimation only allocate the transferred part.
+        """
+        buffers = [receive_buffer(self.sock, preview_levels) for _ in range(num_buffers)]
+        ready = read_header(self.sock)
+        if self.fullLogging:
+            print(f"TCP Client: received {buffers}, then {ready}")
+        return buffers
+
 
 class ClientTestWindow(QMainWindow):
     def __init__(self, port=1234, app=None):
@@ -0,0 +1,204 @@
+'''
+Benchmarks for the CPU-side buffer handling, run e.g. with
+    python benchmarks.py codec --size 2048
+    python benchmarks.py phase_shifting --size 2048
+    python benchmarks.py propagation --size 1024
+    python benchmarks.py autofocus --size 2048
+    python benchmarks.py filters --size 1024
+    python benchmarks.py noise_reduction --size 1024
+    python benchmarks.py raw_quality --size 4096
+Synthetic data mimics the content of each ProcessingStep; numbers are indicative only.
+Date - 2026-10-19
+Coding: utf-8
+'''
+import argparse
+import time
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.holo_buffer_codec as holo_codec
+from cpu_holo import autofocus, filters, noise_reduction, phase_shifting, propagation, raw_quality
+from cpu_holo.cache import ArrayCache
+
+STEP = cuda_holo.ProcessingStep
+
+
+def synthetic_step_data(step: cuda_holo.ProcessingStep, size=2048, seed=0) -> numpy.ndarray:
+    '''Data with roughly the statistics of a buffer of the given processing step.'''
+    rng = numpy.random.default_rng(seed)
+    rows, cols = numpy.mgrid[:size, :size].astype(numpy.float32) / size
+    surface = 40 * (rows - 0.5) ** 2 + 25 * cols + 3 * numpy.sin(8 * rows)  # in rad of the largest synth.
+    if step == STEP.STEP_CAM_IMAGE:
+        fringes = 2000 + 1500 * numpy.cos(400 * cols + surface + rng.normal(0, 0.3, rows.shape))
+        return rng.poisson(numpy.clip(fringes, 0, None)).astype(numpy.uint16)
+    if step in (STEP.STEP_CAM_CPX, STEP.STEP_FFT, STEP.STEP_VIS_PHASES_RAW):
+        speckle = rng.rayleigh(1.0, rows.shape) * numpy.exp(2j * numpy.pi * rng.random(rows.shape))
+        return speckle.astype(numpy.complex64)
+    if step in (STEP.STEP_SYN_PHASES_RAW, STEP.STEP_SYN_PHASES_FILTERED):
+        noise = 0.3 if step == STEP.STEP_SYN_PHASES_RAW else 0.05
+        return numpy.angle(numpy.exp(1j * (surface + rng.normal(0, noise, rows.shape)))).astype(numpy.float32)
+    height = surface + rng.normal(0, 0.01, rows.shape)
+    if step == STEP.STEP_CONVERTED_TO_HEIGHT:
+        height *= 1319.356 / (4 * numpy.pi)  # rad -> micron for a 1.3 mm synthetic wavelength
+    return height.astype(numpy.float32)
+
+
+def benchmark_codec(size=2048, repeats=3):
+    '''Compression ratio and encode/decode throughput (MB/s of raw data) per ProcessingStep.'''
+    codecs = [holo_codec.BufferCodec(holo_codec.CODEC_ZLIB),
+              holo_codec.BufferCodec(holo_codec.CODEC_LZMA),
+              holo_codec.BufferCodec(holo_codec.CODEC_ZLIB, quant_step=1e-3)]
+    print(f"{'step':28s} {'codec':44s} {'ratio':>7s} {'enc MB/s':>9s} {'dec MB/s':>9s}")
+    for step in STEP:
+        if step == STEP.STEP_UNDEFINED:
+            continue
+        data = synthetic_step_data(step, size)
+        for codec in codecs:
+            if codec.quant_step and not numpy.issubdtype(data.real.dtype, numpy.floating):
+                continue
+            out = numpy.empty_like(data)
+            t_enc, t_dec = [], []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                chunks = codec.encode(data)
+                t_enc.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                codec.decode_into(chunks, out)
+                t_dec.append(time.perf_counter() - start)
+            mb = data.nbytes / 1e6
+            ratio = data.nbytes / sum(len(c) for c in chunks)
+            print(f"{step.name:28s} {str(codec):44s} {ratio:7.2f} {mb / min(t_enc):9.1f} {mb / min(t_dec):9.1f}")
+
+
+def benchmark_phase_shifting(size=2048, repeats=3, num_lasers=4, num_steps=4):
+    '''Megapixels/s (of output fields, all lasers) of the CPU CAI temporal phase shifting.'''
+    frame = synthetic_step_data(STEP.STEP_CAM_IMAGE, size)
+    stack = numpy.stack([numpy.roll(frame, k, axis=1) for k in range(num_lasers * num_steps)])
+    print(f"{num_lasers} lasers x {num_steps} steps, {size}x{size} px")
+    for out_dtype in (numpy.complex64, numpy.float32):
+        out = numpy.empty((num_lasers, size, size), dtype=out_dtype)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            phase_shifting.temporal_phase_shift(stack, num_steps, out_dtype=out_dtype, out=out)
+            times.append(time.perf_counter() - start)
+        print(f"{numpy.dtype(out_dtype).name:10s} {num_lasers * size * size / 1e6 / min(times):8.1f} MP/s")
+
+
+def benchmark_propagation(size=1024, repeats=2, num_lasers=4, num_distances=16):
+    '''Time of a sweep over distances for all lasers, with kernels built per distance or taken from the cache.'''
+    rng = numpy.random.default_rng(0)
+    fields = numpy.exp(1j * rng.uniform(-numpy.pi, numpy.pi, (num_lasers, size, size))).astype(numpy.complex64)
+    wavelengths = 780e-9 + 0.5e-9 * numpy.arange(num_lasers)
+    distances = numpy.linspace(-2e-3, 2e-3, num_distances)
+    print(f"{num_lasers} lasers, {num_distances} distances, {size}x{size} px")
+    for method in propagation.METHOD:
+        cache = ArrayCache(4 << 30)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _distance, _out in propagation.propagate_distances(fields, 3.45e-6, wavelengths, distances,
+                                                                   method, 1.2, cache):
+                pass
+            times.append(time.perf_counter() - start)
+        print(f"{method.name:30s} cold {times[0]:6.2f} s, cached {min(times[1:]):6.2f} s")
+
+
+def benchmark_autofocus(size=2048, repeats=3, roi=256):
+    '''Runtime of the autofocus per criterion on a size x size frame of two lasers with a roi x roi ROI.'''
+    rng = numpy.random.default_rng(0)
+    fields = numpy.exp(1j * rng.uniform(-numpy.pi, numpy.pi, (2, size, size))).astype(numpy.complex64)
+    setting = cuda_holo.AutoFocusSetting()
+    setting.roi.x_center = setting.roi.y_center = size // 2
+    setting.roi.width = setting.roi.height = roi
+    setting.do_additional_fine_focus = True
+    print(f"{setting.num_steps} steps + fine search, ROI {roi}x{roi} of {size}x{size} px")
+    for criterion in autofocus.CRITERIA:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            autofocus.autofocus(fields, 3.45e-6, [780e-9, 781e-9], setting, criterion)
+            times.append(time.perf_counter() - start)
+        print(f"{criterion.name:22s} {min(times) * 1e3:8.1f} ms")
+
+
+def benchmark_filters(size=1024, repeats=2, radii=(2, 8, 32)):
+    '''Runtime of each FilterType on a complex field (STEP_SYN_PHASES_RAW phasors) over the filter radius.'''
+    phase = synthetic_step_data(STEP.STEP_SYN_PHASES_RAW, size)
+    field = numpy.exp(1j * phase).astype(numpy.complex64)
+    setting = cuda_holo.Filters()
+    print(f"{size}x{size} px, radii {', '.join(map(str, radii))}")
+    for filter_type in cuda_holo.FilterType:
+        for round_kernel in ((False, True) if filter_type == cuda_holo.FilterType.mean_filter else (False,)):
+            setting.filter_type = filter_type
+            setting.round_average_kernel = round_kernel
+            results = []
+            for radius in radii:
+                setting.filterRadius = setting.filterRadius_median = radius
+                times = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    filters.apply_filter(field, setting)
+                    times.append(time.perf_counter() - start)
+                results.append(min(times))
+            name = filter_type.name + (" (round)" if round_kernel else "")
+            print(f"{name:22s} {' '.join(f'{t * 1e3:8.1f} ms' for t in results)}"
+                  f"   x{results[-1] / results[0]:.1f} from radius {radii[0]} to {radii[-1]}")
+
+
+def benchmark_noise_reduction(size=1024, repeats=2, num_lasers=2, radii=(1, 3, 8)):
+    '''Megapixels/s (of all lasers) of each NoiseDetectionMethods over the detection radius.'''
+    phase = synthetic_step_data(STEP.STEP_SYN_PHASES_RAW, size)
+    fields = numpy.exp(1j * phase)[None].repeat(num_lasers, axis=0).astype(numpy.complex64)
+    settings = cuda_holo.NoiseDetectionSettings()
+    megapixels = fields.size / 1e6
+    print(f"{num_lasers} lasers, {size}x{size} px, radii {', '.join(map(str, radii))}")
+    for method in list(noise_reduction.METHODS)[1:]:
+        settings.method = method
+        results = []
+        for radius in radii:
+            settings.filter_radius_noise_detection = radius
+            reducer = noise_reduction.NoiseReducer(settings)
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                reducer.reduce(fields)
+                times.append(time.perf_counter() - start)
+            results.append(f"{megapixels / min(times):8.1f} MP/s")
+        print(f"{method.name:22s} {' '.join(results)}")
+
+
+def benchmark_raw_quality(size=4096, repeats=3, num_lasers=4, num_steps=4):
+    '''Milliseconds of the raw quality gate with all criteria enabled, against the phase shifting it guards.'''
+    frame = synthetic_step_data(STEP.STEP_CAM_IMAGE, size)
+    stack = numpy.stack([numpy.roll(frame, k, axis=1) for k in range(num_lasers * num_steps)])
+    thresholds = cuda_holo.RawImageQualityThresholds()
+    for flag in ("flag_stddev_grayvals_as_criterion", "flag_phasesteps_as_criterion", "flag_modulation_as_criterion",
+                 "flag_smoothness_as_criterion", "flag_snr_as_criterion"):
+        setattr(thresholds, flag, True)
+    print(f"{num_lasers} lasers x {num_steps} steps, {size}x{size} px")
+    for name, run in (("quality gate", lambda: raw_quality.check_raw_quality(stack, num_steps, thresholds)),
+                      ("phase shifting", lambda: phase_shifting.temporal_phase_shift(stack, num_steps))):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        print(f"{name:15s} {min(times) * 1e3:8.1f} ms")
+
+
+BENCHMARKS = {"codec": benchmark_codec,
+              "autofocus": benchmark_autofocus,
+              "filters": benchmark_filters,
+              "noise_reduction": benchmark_noise_reduction,
+              "phase_shifting": benchmark_phase_shifting,
+              "propagation": benchmark_propagation,
+              "raw_quality": benchmark_raw_quality}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--size", type=int, default=2048, help="edge length of the synthetic images")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](size=args.size)
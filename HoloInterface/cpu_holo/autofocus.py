@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+CPU autofocus per AutoFocusSetting.
+
+The fields are cropped to the ROI (plus a guard band against wrap-around of the propagation), all
+num_steps distances around dist_estimate_mm are propagated as one FFT stack and the focus criterion
+is evaluated for the whole stack at once. The best step is refined by a parabola through its
+neighbours; with do_additional_fine_focus a second sweep over +-1 step of the first one follows.
+
+Focus criteria (cuda_holo.constants, "focus_criteria"); all are turned into "larger is sharper":
+    amp_single_laser     contrast (std / mean) of the amplitude of laser idx_laser
+    phase_gradient       mean absolute (wrapped) phase gradient of laser idx_laser
+    amp_diff             mean |A1 - A2| / mean (A1 + A2) of lasers idx_laser and idx_laser + 1
+    correlation_amp      correlation coefficient of the amplitudes A1, A2
+    correlation_cpx      normalised magnitude of the complex correlation of both fields
+    std_dev_amp_diff     std(A1 - A2) / mean (A1 + A2)
+    normed_std_dev_amps  contrast of the amplitude, averaged over all lasers
+    gradient_of_amps     mean squared amplitude gradient divided by the mean intensity
+Mirror-like surfaces are in focus where the amplitude is most uniform and the phase is smoothest,
+so contrast, gradient and difference criteria are minimised for them (is_mirrorlike_surface) and
+maximised otherwise; phase_gradient, amp_diff and std_dev_amp_diff are always minimised and the
+correlations always maximised.
+"""
+
+from typing import Sequence
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.holo_tcp_globals as holo_dll
+import globals.IPM_Holo_Globals as holo_globals
+from cpu_holo import filters, propagation
+from cpu_holo.cache import ArrayCache
+from globals.holo_result_buffer import roi_as_tuple
+
+CRITERIA = cuda_holo.constants  # the generated header names the focus_criteria enum "constants"
+
+PAIR_CRITERIA = (CRITERIA.amp_diff, CRITERIA.correlation_amp, CRITERIA.correlation_cpx,
+                 CRITERIA.std_dev_amp_diff)
+ALL_LASER_CRITERIA = (CRITERIA.normed_std_dev_amps,)
+# criteria whose value drops towards the focus independent of the surface
+_ALWAYS_MINIMISED = (CRITERIA.phase_gradient, CRITERIA.amp_diff, CRITERIA.std_dev_amp_diff)
+_ALWAYS_MAXIMISED = (CRITERIA.correlation_amp, CRITERIA.correlation_cpx)
+
+DEFAULT_MEMORY_BUDGET = 256 << 20
+
+# Keylist.csv names of the autofocus settings (no Keys* struct exists)
+KEY_AUTOFOCUS_DISTANCE_ESTIMATE_MM = "distance_estimate_mm_af"
+KEY_AUTOFOCUS_SEARCH_RANGE_MM_AF = "search_range_mm_af"
+KEY_AUTOFOCUS_IDX_LASER = "idx_laser_af"
+KEY_AUTOFOCUS_NUMBER_OF_STEPS_AF = "number_of_steps_af"
+KEY_AUTOFOCUS_FILTER_RADIUS = "filter_radius_af"
+KEY_AUTOFOCUS_PROPAGATION_METHOD = "propagation_method_af"
+KEY_AUTOFOCUS_ADDITIONAL_FINE_SEARC = "additional_fine_search_af"
+KEY_AUTOFOCUS_CENTER_ROI_TO_REF_POIN = "center_af_ROI_from_ref_point"
+KEY_AUTOFOCUS_ROI_W = "w_of_ROI_for_af"
+KEY_AUTOFOCUS_ROI_H = "h_of_ROI_for_af"
+KEY_AUTOFOCUS_ROI_CENTER_X = "center_x_for_af"
+KEY_AUTOFOCUS_ROI_CENTER_Y = "center_y_for_af"
+KEY_AUTOFOCUS_IS_MIRRORLIKE = "mirrorlike_seurface_af"
+KEY_AUTOFOCUS_USE_PHASE_IMAGE = "use_phase_image"
+
+
+def setting_from_jso(jso: dict, reference_point=None) -> cuda_holo.AutoFocusSetting:
+    """
+    AutoFocusSetting from the "autofocus_settings" of a measurement json; missing keys keep their defaults.
+    The ROI is centered on reference_point (x, y) with center_af_ROI_from_ref_point; without a ROI
+    size in the json it covers the whole frame (width and height 0, see autofocus).
+    """
+    setting = cuda_holo.AutoFocusSetting()
+    setting.do_autofocus = True
+    setting.roi.width = setting.roi.height = 0
+    for key, attribute, convert in ((KEY_AUTOFOCUS_DISTANCE_ESTIMATE_MM, "dist_estimate_mm", float),
+                                    (KEY_AUTOFOCUS_SEARCH_RANGE_MM_AF, "range_mm", float),
+                                    (KEY_AUTOFOCUS_IDX_LASER, "idx_laser", int),
+                                    (KEY_AUTOFOCUS_NUMBER_OF_STEPS_AF, "num_steps", int),
+                                    (KEY_AUTOFOCUS_FILTER_RADIUS, "filter_radius", int),
+                                    (KEY_AUTOFOCUS_PROPAGATION_METHOD, "prop_method", int),
+                                    (KEY_AUTOFOCUS_ADDITIONAL_FINE_SEARC, "do_additional_fine_focus", bool),
+                                    (KEY_AUTOFOCUS_IS_MIRRORLIKE, "is_mirrorlike_surface", bool),
+                                    (KEY_AUTOFOCUS_USE_PHASE_IMAGE, "use_phase_image", bool)):
+        if key in jso:
+            setattr(setting, attribute, convert(jso[key]))
+    for key, attribute in ((KEY_AUTOFOCUS_ROI_W, "width"), (KEY_AUTOFOCUS_ROI_H, "height"),
+                           (KEY_AUTOFOCUS_ROI_CENTER_X, "x_center"), (KEY_AUTOFOCUS_ROI_CENTER_Y, "y_center")):
+        if key in jso:
+            setattr(setting.roi, attribute, max(int(jso[key]), 0))
+    if jso.get(KEY_AUTOFOCUS_CENTER_ROI_TO_REF_POIN) and reference_point is not None:
+        setting.roi.x_center, setting.roi.y_center = (max(int(v), 0) for v in reference_point)
+    return setting
+
+
+def roi_in_frame(roi, shape):
+    """(x, y, w, h) of a ROI (see roi_as_tuple) clipped to a frame (h, w); a ROI of size 0 is the whole frame."""
+    x, y, w, h = roi_as_tuple(roi)
+    height, width = shape[-2:]
+    if w <= 0 or h <= 0:
+        return 0, 0, width, height
+    left, top = min(max(x, 0), width - 1), min(max(y, 0), height - 1)
+    return left, top, max(min(x + w, width) - left, 1), max(min(y + h, height) - top, 1)
+
+
+class AutoFocusResult:
+    """Focus distance and the criterion curve(s) of the sweep(s); distances in mm."""
+
+    def __init__(self, criterion):
+        self.criterion = CRITERIA(criterion)
+        self.distance_mm = None
+        self.distances_mm = []  # one array per sweep (coarse, fine)
+        self.curves = []
+
+    def __repr__(self):
+        return f"<AutoFocusResult {self.criterion.name}: {self.distance_mm:.4f} mm, {len(self.curves)} sweep(s)>"
+
+    def function_ready_jso(self) -> dict:
+        """FUNCTION_READY message for FunctionId.auto_focus_finished, optional_double is the distance in micron."""
+        keys = holo_dll.KeysFunctionReady()
+        return {holo_dll.KeysServerToClient().command: holo_dll.ServerToClientCommand.FUNCTION_READY.value,
+                keys.KEY_FUNCTION_ID: holo_globals.FunctionId.auto_focus_finished.value,
+                keys.KEY_ERROR_CODE: holo_globals.error_codes_IPM.HOLO_SUCCESS.value,
+                keys.KEY_OPTIONAL_DOUBLE: self.distance_mm * 1e3}
+
+
+def lasers_for_criterion(criterion, idx_laser: int, num_lasers: int) -> list:
+    criterion = CRITERIA(criterion)
+    if criterion in ALL_LASER_CRITERIA:
+        return list(range(num_lasers))
+    if criterion in PAIR_CRITERIA:
+        if num_lasers < 2:
+            raise ValueError(f"focus criterion {criterion.name} needs two lasers")
+        return [idx_laser % num_lasers, (idx_laser + 1) % num_lasers]
+    return [idx_laser % num_lasers]
+
+
+def _mean(values):
+    return values.mean(axis=(-2, -1))
+
+
+def _contrast(amp):
+    return numpy.sqrt(_mean(numpy.square(amp)) - numpy.square(_mean(amp))) / _mean(amp)
+
+
+def focus_measure(fields: numpy.ndarray, criterion, filter_radius=0, is_mirrorlike_surface=True) -> numpy.ndarray:
+    """
+    Sharpness for a stack of fields (steps, lasers, h, w) with the lasers from lasers_for_criterion;
+    returns one value per step, larger is sharper.
+    """
+    criterion = CRITERIA(criterion)
+    amp = numpy.abs(fields)
+    if filter_radius > 0 and criterion != CRITERIA.correlation_cpx:
+        amp = filters.box_mean(amp, filter_radius)
+    if criterion == CRITERIA.amp_single_laser:
+        value = _contrast(amp[:, 0])
+    elif criterion == CRITERIA.normed_std_dev_amps:
+        value = _contrast(amp).mean(axis=1)
+    elif criterion == CRITERIA.gradient_of_amps:
+        a = amp[:, 0]
+        gradient = _mean(numpy.square(numpy.diff(a, axis=-1)[..., :-1, :])
+                         + numpy.square(numpy.diff(a, axis=-2)[..., :, :-1]))
+        value = gradient / _mean(numpy.square(a))
+    elif criterion == CRITERIA.phase_gradient:
+        f = fields[:, 0]
+        value = (_mean(numpy.abs(numpy.angle(f[..., :, 1:] * numpy.conj(f[..., :, :-1]))))
+                 + _mean(numpy.abs(numpy.angle(f[..., 1:, :] * numpy.conj(f[..., :-1, :])))))
+    elif criterion == CRITERIA.amp_diff:
+        value = _mean(numpy.abs(amp[:, 0] - amp[:, 1])) / _mean(amp[:, 0] + amp[:, 1])
+    elif criterion == CRITERIA.std_dev_amp_diff:
+        value = numpy.std(amp[:, 0] - amp[:, 1], axis=(-2, -1)) / _mean(amp[:, 0] + amp[:, 1])
+    elif criterion == CRITERIA.correlation_amp:
+        a = amp[:, 0] - _mean(amp[:, 0])[:, None, None]
+        b = amp[:, 1] - _mean(amp[:, 1])[:, None, None]
+        value = _mean(a * b) / numpy.sqrt(_mean(a * a) * _mean(b * b))
+    else:  # correlation_cpx
+        a, b = fields[:, 0], fields[:, 1]
+        value = numpy.abs(_mean(a * numpy.conj(b))) / numpy.sqrt(_mean(numpy.square(amp[:, 0]))
+                                                                 * _mean(numpy.square(amp[:, 1])))
+    if criterion in _ALWAYS_MINIMISED or (criterion not in _ALWAYS_MAXIMISED and is_mirrorlike_surface):
+        value = -value
+    return value.astype(numpy.float64)
+
+
+def refine_peak(distances: numpy.ndarray, curve: numpy.ndarray) -> float:
+    """Distance of the maximum of curve, refined by a parabola through the best step and its neighbours."""
+    best = int(numpy.nanargmax(curve))
+    if 0 < best < curve.size - 1:
+        left, center, right = curve[best - 1:best + 2]
+        denominator = left - 2 * center + right
+        if denominator < 0:
+            offset = 0.5 * (left - right) / denominator
+            return float(distances[best] + offset * (distances[best + 1] - distances[best]))
+    return float(distances[best])
+
+
+def crop_with_guard(fields: numpy.ndarray, roi, guard: int):
+    """Crop (lasers, h, w) to the ROI plus guard pixels (clipped to the frame); returns the crop and the ROI in it."""
+    x, y, w, h = roi_as_tuple(roi)
+    height, width = fields.shape[-2:]
+    rows = slice(max(y - guard, 0), min(y + h + guard, height))
+    cols = slice(max(x - guard, 0), min(x + w + guard, width))
+    inner = (slice(y - rows.start, y - rows.start + h), slice(x - cols.start, x - cols.start + w))
+    return fields[..., rows, cols], inner
+
+
+def sweep(fields: numpy.ndarray, inner, pixel_m, wavelengths_m: Sequence[float], distances_mm: numpy.ndarray,
+          setting: cuda_holo.AutoFocusSetting, criterion, cache: ArrayCache,
+          memory_budget=DEFAULT_MEMORY_BUDGET) -> numpy.ndarray:
+    """Criterion curve over distances_mm; the propagations are batched as far as memory_budget allows."""
+    bytes_per_step = fields.size * 8 * 3  # field, spectrum and amplitudes
+    batch = max(1, memory_budget // bytes_per_step)
+    curve = []
+    for start in range(0, len(distances_mm), batch):
+        chunk = distances_mm[start:start + batch] * 1e-3
+        stack = propagation.propagate_batch(fields, pixel_m, wavelengths_m, chunk, setting.prop_method, cache=cache)
+        curve.append(focus_measure(stack[(Ellipsis,) + inner], criterion, setting.filter_radius,
+                                   setting.is_mirrorlike_surface))
+    return numpy.concatenate(curve)
+
+
+def autofocus(fields: numpy.ndarray, pixel_m, wavelengths_m: Sequence[float], setting: cuda_holo.AutoFocusSetting,
+              criterion=CRITERIA.amp_single_laser, guard=None,
+              cache: ArrayCache = propagation.PROPAGATION_CACHE) -> AutoFocusResult:
+    """
+    Focus distance for the complex fields of all lasers (lasers, h, w) at STEP_CAM_CPX.
+    setting.roi selects the evaluated area (HoloArea, center based, clipped to the frame; the whole
+    frame if its size is 0); guard is the number of extra pixels propagated around it (default: a
+    quarter of the ROI size).
+    """
+    criterion = CRITERIA(criterion)
+    if setting.use_phase_image and criterion not in PAIR_CRITERIA:
+        criterion = CRITERIA.phase_gradient
+    if setting.num_steps < 3:
+        raise ValueError(f"autofocus needs at least 3 steps, got {setting.num_steps}")
+    lasers = lasers_for_criterion(criterion, setting.idx_laser, fields.shape[0])
+    roi = roi_in_frame(setting.roi, fields.shape)
+    guard = max(roi[2], roi[3]) // 4 if guard is None else guard
+    cropped, inner = crop_with_guard(fields[lasers], roi, guard)
+    wavelengths = [wavelengths_m[idx] for idx in lasers]
+
+    result = AutoFocusResult(criterion)
+    center, half_range = setting.dist_estimate_mm, setting.range_mm / 2
+    for _ in range(2 if setting.do_additional_fine_focus else 1):
+        distances = numpy.linspace(center - half_range, center + half_range, setting.num_steps)
+        curve = sweep(cropped, inner, pixel_m, wavelengths, distances, setting, criterion, cache)
+        result.distances_mm.append(distances)
+        result.curves.append(curve)
+        center = refine_peak(distances, curve)
+        half_range = distances[1] - distances[0]  # fine sweep over +-1 coarse step
+    result.distance_mm = center
+    return result
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Background and dark image references (BackgroundImageSettings) for the raw camera stack.
+
+ReferenceImages keeps one running average per kind (dark with is_darkimage, else background) and
+exposure_ms, updated with update_background_image: the new frames are added to the mean in bands
+of rows, so a reference grows without keeping its frames. With a directory the averages are .npy
+files opened as memory maps (plus references.json with the frame counts), so they survive restarts
+and are never read as a whole. The low pass (crop of the spectrum to low_pass_ratio_for_mirror_x /
+_y of the frequencies, off for ratios <= 0 or >= 1) is computed once per reference version and kept
+in REFERENCE_CACHE.
+
+apply_background_image subtracts the background of the exposure, or its dark image if there is no
+background (a background already contains the dark signal): applied_reference is passed as reference
+to spatial_phase_shift, which subtracts it frame by frame right before the transform, so the raw stack
+is never converted as a whole. Temporal phase shifting does not need it: the phase step weights sum
+to zero, so a static reference cancels from the field.
+"""
+
+import itertools
+import json
+import os
+import threading
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import tiles
+from cpu_holo.cache import ArrayCache
+
+REFERENCE_CACHE = ArrayCache(256 << 20)
+
+DARK = "dark"
+BACKGROUND = "background"
+INDEX_FILE = "references.json"
+
+_MANAGER_IDS = itertools.count()
+
+
+def reference_kind(settings: cuda_holo.BackgroundImageSettings) -> str:
+    return DARK if settings.is_darkimage else BACKGROUND
+
+
+def low_pass(image: numpy.ndarray, ratio_x, ratio_y) -> numpy.ndarray:
+    """image (h, w) with only the |frequencies| <= ratio / 2 of the sampling rate kept per axis, float32."""
+    image = numpy.asarray(image, dtype=numpy.float32)
+    if not (0 < ratio_x < 1 or 0 < ratio_y < 1):
+        return image.copy()
+    spectrum = numpy.fft.rfft2(image)
+    height, width = image.shape
+    if 0 < ratio_y < 1:
+        keep = int(ratio_y * height / 2)
+        spectrum[keep + 1:height - keep] = 0
+    if 0 < ratio_x < 1:
+        spectrum[:, int(ratio_x * width / 2) + 1:] = 0
+    return numpy.fft.irfft2(spectrum, s=image.shape).astype(numpy.float32)
+
+
+class ReferenceImages:
+    """Running averages of dark and background frames per exposure, in memory or memory mapped in directory."""
+
+    def __init__(self, directory: str = None, cache: ArrayCache = REFERENCE_CACHE):
+        self.directory = directory
+        self.cache = cache
+        self._id = next(_MANAGER_IDS)
+        self._averages = {}
+        self._counts = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            index = os.path.join(directory, INDEX_FILE)
+            if os.path.exists(index):
+                with open(index) as file:
+                    self._counts = {tuple(json.loads(key)): count for key, count in json.load(file).items()}
+
+    def __repr__(self):
+        return f"<ReferenceImages {len(self._counts)} references in {self.directory or 'memory'}>"
+
+    @staticmethod
+    def key(kind: str, exposure_ms, shape):
+        return kind, round(float(exposure_ms), 6), int(shape[-2]), int(shape[-1])
+
+    def _path(self, key) -> str:
+        kind, exposure_ms, height, width = key
+        return os.path.join(self.directory, f"{kind}_{exposure_ms:g}ms_{height}x{width}.npy")
+
+    def _save_index(self):
+        if self.directory is not None:
+            with open(os.path.join(self.directory, INDEX_FILE), "w") as file:
+                json.dump({json.dumps(list(key)): count for key, count in self._counts.items()}, file)
+
+    def count(self, kind: str, exposure_ms, shape) -> int:
+        return self._counts.get(self.key(kind, exposure_ms, shape), 0)
+
+    def average(self, kind: str, exposure_ms, shape):
+        """Mean frame (float32, memory mapped with a directory) or None."""
+        key = self.key(kind, exposure_ms, shape)
+        if key not in self._counts:
+            return None
+        if key not in self._averages:
+            self._averages[key] = numpy.lib.format.open_memmap(self._path(key), mode="r+")
+        return self._averages[key]
+
+    def update(self, frames: numpy.ndarray, settings: cuda_holo.BackgroundImageSettings,
+               band_rows=tiles.DEFAULT_BAND_ROWS, workers=None) -> int:
+        """
+        Adds frames (h, w) or (n, h, w) to the reference of their kind and exposure if
+        update_background_image is set; returns the frame count of the reference.
+        """
+        frames = frames[None] if frames.ndim == 2 else frames
+        key = self.key(reference_kind(settings), settings.exposure_ms, frames.shape)
+        if not settings.update_background_image:
+            return self._counts.get(key, 0)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            mean = self.average(*key[:2], frames.shape)
+            if mean is None:
+                shape, dtype = frames.shape[-2:], numpy.float32
+                mean = (numpy.zeros(shape, dtype) if self.directory is None
+                        else numpy.lib.format.open_memmap(self._path(key), mode="w+", dtype=dtype, shape=shape))
+                self._averages[key] = mean
+            total = count + frames.shape[0]
+
+            def process(band: tiles.RowBand):
+                rows = mean[band.core]
+                added = frames[:, band.core].sum(axis=0, dtype=numpy.float32)
+                rows += (added - frames.shape[0] * rows) / total
+
+            tiles.map_row_bands(process, frames.shape[-2], band_rows, workers=workers)
+            if isinstance(mean, numpy.memmap):
+                mean.flush()
+            self._counts[key] = total
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._save_index()
+        return total
+
+    def reference(self, settings: cuda_holo.BackgroundImageSettings, shape):
+        """Low passed background of the exposure, else its dark image, else None; computed once per version."""
+        for kind in (BACKGROUND, DARK):
+            average = self.average(kind, settings.exposure_ms, shape)
+            if average is not None:
+                key = self.key(kind, settings.exposure_ms, shape)
+                ratios = float(settings.low_pass_ratio_for_mirror_x), float(settings.low_pass_ratio_for_mirror_y)
+                return self.cache.get(("reference", self._id, self._versions.get(key, 0)) + key + ratios,
+                                      lambda: low_pass(average, *ratios))
+        return None
+
+    def applied_reference(self, settings: cuda_holo.BackgroundImageSettings, shape):
+        """reference if apply_background_image is set, else None."""
+        return self.reference(settings, shape) if settings.apply_background_image else None
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Least-recently-used cache for precomputed arrays (masks, kernels, index grids) shared by the CPU
+evaluation stages. Entries are keyed by everything they depend on (shape, geometry, wavelengths,
+...), so repeated measurements with the same settings skip the setup. The total size is capped in
+bytes; the oldest entries are dropped first.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+import numpy
+
+DEFAULT_MAX_BYTES = 512 << 20
+
+
+def nbytes_of(value) -> int:
+    """Memory held by an array, a tuple / list / dict of arrays or an object with an nbytes attribute."""
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes_of(v) for v in value)
+    if isinstance(value, dict):
+        return sum(nbytes_of(v) for v in value.values())
+    return int(getattr(value, "nbytes", 0))
+
+
+class ArrayCache:
+    """Thread safe LRU cache with a memory limit; hits and misses are counted for diagnostics."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"<ArrayCache: {len(self._entries)} entries, {self.nbytes / 1e6:.1f} of {self.max_bytes / 1e6:.1f} MB, "
+                f"{self.hits} hits, {self.misses} misses>")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def get(self, key: Hashable, factory: Callable[[], object]):
+        """Cached value for key; calls factory() on a miss. Values larger than max_bytes are not kept."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+        value = factory()  # outside the lock, factories may be expensive
+        size = nbytes_of(value)
+        with self._lock:
+            if key not in self._entries and size <= self.max_bytes:
+                self._entries[key] = (value, size)
+                self.nbytes += size
+                while self.nbytes > self.max_bytes:
+                    _, (_, dropped) = self._entries.popitem(last=False)
+                    self.nbytes -= dropped
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
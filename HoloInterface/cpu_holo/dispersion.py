@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Dispersion correction of the beam splitter glass (DispersionSettings) for the fields of all lasers.
+
+The refractive index n(l) of type_of_glass_BS (glass_types) follows the Sellmeier equation
+    n^2 = 1 + sum B_k l^2 / (l^2 - C_k)        l in um
+The object beam passes thickness_BS_mm of glass PASSES times more than the reference beam, so each
+laser gets the extra phase 2 pi PASSES (n(l) - 1) d / l, which shifts the synthetic phases:
+    do_dispersion_correction_z     the fields are multiplied with exp(-i phase) of their laser, one
+                                   in-place multiply of the stack with a (lasers, 1, 1) phasor table
+    do_dispersion_correction_xy    the image behind the glass moves by PASSES d (1 - 1 / n(l)), so at
+                                   the image distance z each laser is imaged with the lateral scale
+                                   1 + (shift(l) - shift(0)) / z of laser 0; the lasers are rescaled
+                                   about the frame center onto laser 0 by a separable linear
+                                   interpolation (row and column gathers, no propagation)
+The tables (indices, phasors, focus shifts) are cached per glass, thickness and wavelengths, the
+interpolation tables per frame shape and scale.
+"""
+
+import math
+from typing import Sequence
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo.cache import ArrayCache
+
+GLASS = cuda_holo.glass_types
+
+# (B1, B2, B3), (C1, C2, C3 in um^2)
+SELLMEIER = {
+    GLASS.BK7: ((1.03961212, 0.231792344, 1.01046945), (0.00600069867, 0.0200179144, 103.560653)),
+    GLASS.SIO2: ((0.6961663, 0.4079426, 0.8974794), (0.00467914826, 0.0135120631, 97.9340025)),
+    GLASS.SF2: ((1.40301821, 0.231767504, 0.939056586), (0.0105795466, 0.0493226978, 112.405955)),
+    # one term fitted to the catalogue values nd = 1.72916, vd = 54.67
+    GLASS.H_LAK67: ((1.92290896,), (0.0116381235,)),
+}
+
+# the beam splitter is passed twice (to and from the object) by the object beam only
+PASSES = 2
+
+DISPERSION_CACHE = ArrayCache(1 << 20)
+
+# Keylist.csv name without a Keys* struct
+KEY_DISPERSION_SETTINGS = "dispersion_settings"
+
+
+def settings_from_jso(jso: dict) -> cuda_holo.DispersionSettings:
+    """DispersionSettings from the "dispersion_settings" of a measurement json; missing keys keep their defaults."""
+    settings = cuda_holo.DispersionSettings()
+    for key, convert in (("do_dispersion_correction_z", bool), ("do_dispersion_correction_xy", bool),
+                         ("thickness_BS_mm", float), ("type_of_glass_BS", int)):
+        if key in jso:
+            setattr(settings, key, convert(jso[key]))
+    return settings
+
+
+def refractive_index(glass: cuda_holo.glass_types, wavelengths_m) -> numpy.ndarray:
+    """n of the glass at the wavelengths (m)."""
+    coefficients, resonances = SELLMEIER[GLASS(glass)]
+    squared = (numpy.asarray(wavelengths_m, dtype=numpy.float64) * 1e6) ** 2
+    return numpy.sqrt(1 + sum(b * squared / (squared - c) for b, c in zip(coefficients, resonances)))
+
+
+class DispersionTable:
+    """Indices, z correction phasors (lasers, 1, 1) and xy focus shifts (m, relative to laser 0) of one setup."""
+
+    def __init__(self, glass, thickness_mm, wavelengths_m: Sequence[float]):
+        wavelengths = numpy.asarray(wavelengths_m, dtype=numpy.float64)
+        thickness_m = thickness_mm * 1e-3
+        self.indices = refractive_index(glass, wavelengths)
+        self.phases = 2 * math.pi * PASSES * (self.indices - 1) * thickness_m / wavelengths
+        self.phasors = numpy.exp(-1j * self.phases).astype(numpy.complex64)[:, None, None]
+        focus = PASSES * thickness_m * (1 - 1 / self.indices)
+        self.focus_shifts_m = focus - focus[0]
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.phases.nbytes + self.phasors.nbytes + self.focus_shifts_m.nbytes
+
+
+def dispersion_table(settings: cuda_holo.DispersionSettings, wavelengths_m: Sequence[float],
+                     cache: ArrayCache = DISPERSION_CACHE) -> DispersionTable:
+    glass, thickness = GLASS(settings.type_of_glass_BS), float(settings.thickness_BS_mm)
+    wavelengths = tuple(float(w) for w in numpy.atleast_1d(wavelengths_m))
+    return cache.get(("dispersion", glass, thickness) + wavelengths,
+                     lambda: DispersionTable(glass, thickness, wavelengths))
+
+
+def lateral_scales(table: DispersionTable, image_distance_m: float) -> numpy.ndarray:
+    """Lateral image scale of every laser relative to laser 0 at the image distance (m)."""
+    return 1 + table.focus_shifts_m / image_distance_m
+
+
+class AxisResampling:
+    """Source indices and weights of one axis of length size rescaled by scale about its center."""
+
+    def __init__(self, size: int, scale: float):
+        center = (size - 1) / 2
+        source = numpy.clip(center + (numpy.arange(size) - center) * scale, 0, size - 1)
+        self.lower = numpy.minimum(source.astype(numpy.intp), max(size - 2, 0))
+        self.upper = numpy.minimum(self.lower + 1, size - 1)
+        self.weights = (source - self.lower).astype(numpy.float32)
+
+    @property
+    def nbytes(self):
+        return self.lower.nbytes + self.upper.nbytes + self.weights.nbytes
+
+
+def axis_resampling(size: int, scale: float, cache: ArrayCache = DISPERSION_CACHE) -> AxisResampling:
+    return cache.get(("resampling", size, scale), lambda: AxisResampling(size, scale))
+
+
+def rescale(field: numpy.ndarray, scale: float, cache: ArrayCache = DISPERSION_CACHE) -> numpy.ndarray:
+    """field (h, w) sampled at center + (x - center) * scale on both axes (linear interpolation, edges clamped)."""
+    rows, cols = (axis_resampling(size, scale, cache) for size in field.shape)
+    weights = rows.weights[:, None]
+    field = field[rows.lower] * (1 - weights) + field[rows.upper] * weights
+    return field[:, cols.lower] * (1 - cols.weights) + field[:, cols.upper] * cols.weights
+
+
+def correct_dispersion(fields: numpy.ndarray, settings: cuda_holo.DispersionSettings, wavelengths_m: Sequence[float],
+                       image_distance_m=None, cache: ArrayCache = DISPERSION_CACHE) -> numpy.ndarray:
+    """
+    Fields (lasers, h, w) corrected per DispersionSettings; the z correction works in place, the xy
+    correction (needs the image distance, e.g. the focal length) replaces the rescaled lasers. Returns fields.
+    """
+    if settings.thickness_BS_mm == 0 or not (settings.do_dispersion_correction_z or settings.do_dispersion_correction_xy):
+        return fields
+    table = dispersion_table(settings, wavelengths_m, cache)
+    if settings.do_dispersion_correction_z:
+        fields *= table.phasors
+    if settings.do_dispersion_correction_xy:
+        if not image_distance_m:
+            raise ValueError("the xy dispersion correction needs the image distance")
+        for idx, scale in enumerate(lateral_scales(table, image_distance_m)):
+            if scale != 1:
+                fields[idx] = rescale(fields[idx], float(scale), cache)
+    return fields
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+Local filters of the CPU evaluation, for single images (h, w) or stacks (..., h, w).
+
+The box mean uses running sums (integral images along each axis), so its cost does not depend on
+the radius. NaN pixels (masked) are left out of the mean, and at the borders the mean is taken
+over the pixels inside the frame only. Medians sort the neighbourhood of each pixel and are
+computed in bands of rows; binary morphology uses box sums as well.
+
+The Filters settings (FilterType) are applied to complex phasor fields by apply_filter:
+    mean_filter     box mean, or with round_average_kernel the mean over the octagon closest to
+                    the disk (box sums minus four corners from diagonal integral images, so the
+                    cost does not depend on the radius either)
+    gauss_filter    three box means of different radii (a recursive approximation of a Gaussian
+                    with sigma = filterRadius / 2), independent of the radius
+    median_filter   median of the real and imaginary part with filterRadius_median; from
+                    HISTOGRAM_MEDIAN_MIN_RADIUS on it is taken from box-counted histograms, so the
+                    cost depends on the number of bins instead of the window size. The bins span a
+                    robust range of the frame (MEDIAN_RANGE_PERCENTILE), so outliers do not coarsen
+                    them; pixels whose median lies outside the range are sorted exactly.
+With flag_tilt_compensated_filtering the mean tilt of the field is removed before and restored
+after filtering, so fringes are not averaged out. Bands of rows are filtered in parallel.
+"""
+
+import math
+import warnings
+from typing import List
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import tiles
+
+GAUSS_PASSES = 3
+HISTOGRAM_MEDIAN_MIN_RADIUS = 4
+HISTOGRAM_MEDIAN_BINS = 64
+MEDIAN_RANGE_PERCENTILE = 0.5  # % of the values left out below and above the histogram range
+MEDIAN_RANGE_SAMPLES = 1 << 20
+EXACT_MEDIAN_CHUNK = 4096
+
+
+def _box_sum_axis(data: numpy.ndarray, radius: int, axis: int) -> numpy.ndarray:
+    """Sum over [i - radius, i + radius] along axis, clipped to the frame."""
+    n = data.shape[axis]
+    cumulative = numpy.cumsum(data, axis=axis, dtype=numpy.result_type(data.dtype, numpy.float64))
+    cumulative = numpy.concatenate([numpy.zeros_like(numpy.take(cumulative, [0], axis=axis)), cumulative], axis=axis)
+    upper = numpy.minimum(numpy.arange(n) + radius + 1, n)
+    lower = numpy.maximum(numpy.arange(n) - radius, 0)
+    return numpy.take(cumulative, upper, axis=axis) - numpy.take(cumulative, lower, axis=axis)
+
+
+def box_sum(data: numpy.ndarray, radius: int) -> numpy.ndarray:
+    """Sum over the (2 radius + 1)^2 neighbourhood of each pixel (in double precision), over the last two axes."""
+    return _box_sum_axis(_box_sum_axis(data, radius, data.ndim - 2), radius, data.ndim - 1)
+
+
+def box_mean(data: numpy.ndarray, radius: int, out: numpy.ndarray = None) -> numpy.ndarray:
+    """Mean over the (2 radius + 1)^2 neighbourhood of each pixel, ignoring NaN; complex data is allowed."""
+    if radius <= 0:
+        if out is None:
+            return data.copy()
+        out[...] = data
+        return out
+    nan = numpy.isnan(data)
+    if nan.any():
+        sums = box_sum(numpy.where(nan, 0, data), radius)
+        counts = box_sum((~nan).astype(numpy.float32), radius)
+    else:
+        sums = box_sum(data, radius)
+        counts = box_sum(numpy.ones(data.shape[-2:], dtype=numpy.float32), radius)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+    if out is None:
+        return mean.astype(data.dtype, copy=False)
+    out[...] = mean
+    return out
+
+
+def disk_diagonal(radius: int) -> int:
+    """Diagonal bound c of the octagon |dx|, |dy| <= radius, |dx| + |dy| <= c closest to the disk of the radius."""
+    dy, dx = numpy.abs(numpy.mgrid[-radius:radius + 1, -radius:radius + 1])
+    disk = dy * dy + dx * dx <= radius * radius
+    return min(range(radius, 2 * radius + 1), key=lambda c: int(numpy.count_nonzero((dx + dy <= c) != disk)))
+
+
+def disk_kernel(radius: int) -> numpy.ndarray:
+    """Boolean (2 radius + 1)^2 kernel of disk_sum: the octagon closest to the disk of the radius."""
+    dy, dx = numpy.abs(numpy.mgrid[-radius:radius + 1, -radius:radius + 1])
+    return dx + dy <= disk_diagonal(radius)
+
+
+def _diagonal_tables(data: numpy.ndarray):
+    """
+    Integral images of data (..., h, w) with a leading zero row (and column), in double precision:
+        box[1 + y, 1 + x]       rows <= y, columns <= x
+        falling[1 + y, 1 + s]   rows <= y, columns <= s - row   (s = -1 .. h + w - 2)
+        rising[1 + y, h + t]    rows <= y, columns <= t + row   (t = -h .. w - 1)
+    """
+    height, width = data.shape[-2:]
+    dtype = numpy.result_type(data.dtype, numpy.float64)
+    row_sums = numpy.zeros(data.shape[:-1] + (width + 1,), dtype=dtype)
+    numpy.cumsum(data, axis=-1, dtype=dtype, out=row_sums[..., 1:])
+    rows = numpy.arange(height)[:, None]
+    diagonals = numpy.arange(height + width)[None, :]
+    tables = []
+    for columns in (None, diagonals - 1 - rows, diagonals - height + rows):
+        source = row_sums if columns is None else row_sums[..., rows, numpy.clip(columns, -1, width - 1) + 1]
+        table = numpy.zeros(source.shape[:-2] + (height + 1, source.shape[-1]), dtype=dtype)
+        numpy.cumsum(source, axis=-2, out=table[..., 1:, :])
+        tables.append(table.reshape(table.shape[:-2] + (-1,)))
+    return tables
+
+
+def disk_sum(data: numpy.ndarray, radius: int) -> numpy.ndarray:
+    """
+    Sum over the disk of the given radius around each pixel (in double precision), clipped to the
+    frame. The disk is approximated by the octagon of disk_kernel, |dx|, |dy| <= radius and
+    |dx| + |dy| <= c: the rows of its upper and lower part are bounded by the two diagonals, its
+    middle rows by the box, so the sum takes twelve lookups in the integral images of
+    _diagonal_tables, whatever the radius.
+    """
+    height, width = data.shape[-2:]
+    c = disk_diagonal(radius)
+    box, falling, rising = _diagonal_tables(data)
+    y, x = numpy.arange(height)[:, None], numpy.arange(width)[None, :]
+
+    def row(bound):
+        return numpy.clip(bound, -1, height - 1) + 1
+
+    def lookup(table, row_index, column_index, columns):
+        return numpy.take(table, row_index * columns + column_index, axis=-1)
+
+    def falling_rows(first, last, s):  # rows first + 1 .. last, columns <= s - row
+        s = numpy.clip(s, -1, height + width - 2) + 1
+        return lookup(falling, row(last), s, height + width) - lookup(falling, row(first), s, height + width)
+
+    def rising_rows(first, last, t):  # rows first + 1 .. last, columns <= t + row
+        t = numpy.clip(t, -height, width - 1) + height
+        return lookup(rising, row(last), t, height + width) - lookup(rising, row(first), t, height + width)
+
+    def box_rows(first, last, column):  # rows first + 1 .. last, columns <= column
+        column = numpy.clip(column, -1, width - 1) + 1
+        return lookup(box, row(last), column, width + 1) - lookup(box, row(first), column, width + 1)
+
+    top, bottom = y + radius - c - 1, y - radius + c  # last row of the upper part, row above the lower part
+    above = y - radius - 1
+    return (box_rows(top, bottom, x + radius) - box_rows(top, bottom, x - radius - 1)
+            + rising_rows(above, top, x - y + c) - falling_rows(above, top, x + y - c - 1)
+            + falling_rows(bottom, y + radius, x + y + c) - rising_rows(bottom, y + radius, x - y - c - 1))
+
+
+def _normalized(data: numpy.ndarray, sum_func, out: numpy.ndarray = None) -> numpy.ndarray:
+    """sum_func(data) / sum_func(valid pixels), ignoring NaN."""
+    nan = numpy.isnan(data)
+    if nan.any():
+        sums = sum_func(numpy.where(nan, 0, data))
+        counts = sum_func((~nan).astype(numpy.float32))
+    else:
+        sums = sum_func(data)
+        counts = sum_func(numpy.ones(data.shape[-2:], dtype=numpy.float32))
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+    if out is None:
+        return mean.astype(data.dtype, copy=False)
+    out[...] = mean
+    return out
+
+
+def disk_mean(data: numpy.ndarray, radius: int, out: numpy.ndarray = None) -> numpy.ndarray:
+    """Mean over the disk of the given radius around each pixel, ignoring NaN; complex data is allowed."""
+    if radius <= 0:
+        return box_mean(data, 0, out)
+    return _normalized(data, lambda values: disk_sum(values, radius), out)
+
+
+def gauss_box_radii(sigma: float, passes=GAUSS_PASSES) -> List[int]:
+    """Radii of the box means whose repeated application approximates a Gaussian of the given sigma."""
+    ideal = math.sqrt(12 * sigma * sigma / passes + 1)
+    lower = int(ideal) - (1 - int(ideal) % 2)  # odd box width below the ideal one
+    narrow = round((12 * sigma * sigma - passes * lower * lower - 4 * passes * lower - 3 * passes)
+                   / (-4 * lower - 4))
+    return [(lower - 1) // 2 if idx < narrow else (lower + 1) // 2 for idx in range(passes)]
+
+
+def gauss_filter(data: numpy.ndarray, radius: int, out: numpy.ndarray = None) -> numpy.ndarray:
+    """Gaussian with sigma = radius / 2 from repeated box means, ignoring NaN; complex data is allowed."""
+    if radius <= 0:
+        return box_mean(data, 0, out)
+    result = data
+    for box_radius in gauss_box_radii(radius / 2):
+        result = box_mean(result, box_radius)
+    if out is None:
+        return result
+    out[...] = result
+    return out
+
+
+def gauss_halo(radius: int) -> int:
+    """Rows around a band needed by gauss_filter."""
+    return sum(gauss_box_radii(radius / 2)) if radius > 0 else 0
+
+
+def histogram_median(data: numpy.ndarray, radius: int, value_range=None, bins=HISTOGRAM_MEDIAN_BINS,
+                     out: numpy.ndarray = None) -> numpy.ndarray:
+    """
+    Median over the (2 radius + 1)^2 neighbourhood of a 2d image, ignoring NaN, from the box counted
+    histogram of each neighbourhood; within its bin the median is interpolated linearly.
+    value_range: (low, high) of the bins, e.g. of the whole frame when it is filtered in bands
+    (median_value_range by default). Values outside it are counted below or above the bins, and the
+    pixels whose median falls there are computed exactly.
+    """
+    valid = numpy.isfinite(data)
+    if value_range is None:
+        value_range = median_value_range(data)
+    low, high = float(value_range[0]), float(value_range[1])
+    result = out if out is not None else numpy.empty(data.shape, dtype=numpy.float32)
+    result[...] = numpy.nan
+    half = 0.5 * box_sum(valid.astype(numpy.float32), radius)
+    below = box_sum((valid & (data < low)).astype(numpy.float32), radius)
+    open_pixels = half > 0
+    outside = open_pixels & (below >= half)
+    open_pixels &= ~outside
+    if high > low:
+        bin_width = (high - low) / bins
+        in_range = valid & (data >= low) & (data <= high)
+        index = numpy.full(data.shape, -1, dtype=numpy.intp)
+        index[in_range] = numpy.clip(((data[in_range] - low) / bin_width).astype(numpy.intp), 0, bins - 1)
+        for b in range(bins):
+            if not open_pixels.any():
+                break
+            in_bin = box_sum((index == b).astype(numpy.float32), radius)
+            found = open_pixels & (below + in_bin >= half) & (in_bin > 0)
+            result[found] = low + (b + (half[found] - below[found]) / in_bin[found]) * bin_width
+            open_pixels &= ~found
+            below += in_bin
+    else:
+        at_low = box_sum((valid & (data == low)).astype(numpy.float32), radius)
+        found = open_pixels & (below + at_low >= half)
+        result[found] = low
+        open_pixels &= ~found
+    outside |= open_pixels
+    if outside.any():
+        _exact_median_at(data, radius, outside, result)
+    return result
+
+
+def _exact_median_at(data: numpy.ndarray, radius: int, pixels: numpy.ndarray, out: numpy.ndarray):
+    """Sorted median of the neighbourhoods of the set pixels of a 2d image, written to out."""
+    padded = numpy.pad(data.astype(numpy.float32, copy=False), radius, mode="constant", constant_values=numpy.nan)
+    windows = numpy.lib.stride_tricks.sliding_window_view(padded, (2 * radius + 1, 2 * radius + 1))
+    rows, cols = numpy.nonzero(pixels)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for start in range(0, rows.size, EXACT_MEDIAN_CHUNK):
+            r, c = rows[start:start + EXACT_MEDIAN_CHUNK], cols[start:start + EXACT_MEDIAN_CHUNK]
+            out[r, c] = numpy.nanmedian(windows[r, c].reshape(r.size, -1), axis=-1)
+
+
+def median_filter(data: numpy.ndarray, radius: int, band_rows=None, workers=None,
+                  memory_budget=64 << 20, bins=HISTOGRAM_MEDIAN_BINS) -> numpy.ndarray:
+    """
+    Median over the (2 radius + 1)^2 neighbourhood of each pixel of a 2d image, ignoring NaN.
+    Up to HISTOGRAM_MEDIAN_MIN_RADIUS (or with bins=0) the window is a strided view and bands of
+    rows are sorted in parallel to bound the scratch memory; larger radii use histogram_median.
+    """
+    if radius <= 0:
+        return data.copy()
+    if bins and radius >= HISTOGRAM_MEDIAN_MIN_RADIUS:
+        data = data.astype(numpy.float32, copy=False)
+        value_range = median_value_range(data)
+        out = numpy.empty(data.shape, dtype=numpy.float32)
+
+        def process_histogram(band: tiles.RowBand):
+            out[band.core] = histogram_median(data[band.padded], radius, value_range, bins)[band.core_in_padded]
+
+        tiles.map_row_bands(process_histogram, data.shape[0], band_rows or _band_rows_for_halo(radius), halo=radius,
+                            workers=workers)
+        return out
+    window = 2 * radius + 1
+    if band_rows is None:
+        band_rows = tiles.band_rows_for_budget(data.shape[1] * window * window * data.itemsize * 2, memory_budget)
+    padded = numpy.pad(data.astype(numpy.float32, copy=False), radius, mode="constant", constant_values=numpy.nan)
+    out = numpy.empty(data.shape, dtype=numpy.float32)
+
+    def process(band: tiles.RowBand):
+        rows = padded[band.start:band.stop + 2 * radius]
+        windows = numpy.lib.stride_tricks.sliding_window_view(rows, (window, window))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN windows stay NaN
+            out[band.core] = numpy.nanmedian(windows.reshape(windows.shape[:2] + (-1,)), axis=-1)
+
+    tiles.map_row_bands(process, data.shape[0], band_rows, workers=workers)
+    return out
+
+
+def binary_erode(mask: numpy.ndarray, radius: int) -> numpy.ndarray:
+    """Erosion with a (2 radius + 1)^2 square; pixels outside the frame count as set."""
+    if radius <= 0:
+        return mask.copy()
+    missing = box_sum((~mask).astype(numpy.float32), radius)
+    return missing < 0.5
+
+
+def binary_dilate(mask: numpy.ndarray, radius: int) -> numpy.ndarray:
+    """Dilation with a (2 radius + 1)^2 square."""
+    if radius <= 0:
+        return mask.copy()
+    return box_sum(mask.astype(numpy.float32), radius) > 0.5
+
+
+def binary_open(mask: numpy.ndarray, radius: int) -> numpy.ndarray:
+    """Removes set areas smaller than the square."""
+    return binary_dilate(binary_erode(mask, radius), radius)
+
+
+def binary_close(mask: numpy.ndarray, radius: int) -> numpy.ndarray:
+    """Fills holes smaller than the square."""
+    return binary_erode(binary_dilate(mask, radius), radius)
+
+
+def _band_rows_for_halo(halo: int) -> int:
+    """Bands at least 4 times the halo, so the recomputed rows stay a small part of the work."""
+    return max(tiles.DEFAULT_BAND_ROWS, 4 * halo)
+
+
+def filter_radius(setting: cuda_holo.Filters) -> int:
+    """Radius of the selected filter: filterRadius_median for median_filter, else filterRadius."""
+    if cuda_holo.FilterType(setting.filter_type) == cuda_holo.FilterType.median_filter:
+        return max(int(setting.filterRadius_median), 0)
+    return max(int(setting.filterRadius), 0)
+
+
+def filter_halo(setting: cuda_holo.Filters, radius: int = None) -> int:
+    """Rows around a band that filter_image needs."""
+    radius = filter_radius(setting) if radius is None else radius
+    if cuda_holo.FilterType(setting.filter_type) == cuda_holo.FilterType.gauss_filter:
+        return gauss_halo(radius)
+    return radius
+
+
+def field_tilt(field: numpy.ndarray) -> numpy.ndarray:
+    """
+    Mean phase gradient (rad/pixel along rows, columns) of each complex image of field (..., h, w),
+    shape (..., 2); NaN pixels are ignored.
+    """
+    rows = numpy.nansum(field[..., 1:, :] * numpy.conj(field[..., :-1, :]), axis=(-2, -1))
+    cols = numpy.nansum(field[..., :, 1:] * numpy.conj(field[..., :, :-1]), axis=(-2, -1))
+    return numpy.stack([numpy.angle(rows), numpy.angle(cols)], axis=-1)
+
+
+def _tilt_phasor(shape, tilt: numpy.ndarray, first_row=0) -> numpy.ndarray:
+    tilt = numpy.asarray(tilt)
+    rows = (numpy.arange(shape[0]) + first_row)[:, None] * tilt[..., 0, None, None]
+    cols = numpy.arange(shape[1])[None, :] * tilt[..., 1, None, None]
+    return numpy.exp(1j * (rows + cols)).astype(numpy.complex64)
+
+
+def filter_image(data: numpy.ndarray, setting: cuda_holo.Filters, radius: int = None, tilt=None, first_row=0,
+                 value_range=None) -> numpy.ndarray:
+    """
+    Filter one image or band (..., h, w) per Filters, without threading.
+    tilt: (..., 2) rad/pixel along rows and columns (see field_tilt), removed before and restored
+    after filtering, for complex data; first_row: row of data[0] in the frame, so that the tilt of a band matches the frame.
+    value_range: (low, high) of the histogram median, see histogram_median.
+    """
+    radius = filter_radius(setting) if radius is None else radius
+    if radius <= 0:
+        return data.copy()
+    complex_data = numpy.iscomplexobj(data)
+    phasor = _tilt_phasor(data.shape[-2:], tilt, first_row) if complex_data and tilt is not None else None
+    if phasor is not None:
+        data = data * numpy.conj(phasor)
+    filter_type = cuda_holo.FilterType(setting.filter_type)
+    if filter_type == cuda_holo.FilterType.gauss_filter:
+        result = gauss_filter(data, radius)
+    elif filter_type == cuda_holo.FilterType.median_filter:
+        result = complex_median(data, radius, value_range)
+    elif setting.round_average_kernel:
+        result = disk_mean(data, radius)
+    else:
+        result = box_mean(data, radius)
+    if phasor is not None:
+        result *= phasor
+    return result
+
+
+def complex_median(data: numpy.ndarray, radius: int, value_range=None) -> numpy.ndarray:
+    """Median of a 2d image or stack, of the real and imaginary part for complex data."""
+    value_range = median_value_range(data) if value_range is None else value_range
+    if data.ndim > 2:
+        return numpy.array([complex_median(image, radius, value_range) for image in data])
+    median = histogram_median if radius >= HISTOGRAM_MEDIAN_MIN_RADIUS else _sorted_median
+    if numpy.iscomplexobj(data):
+        real = median(data.real, radius, value_range)
+        imag = median(data.imag, radius, value_range)
+        return (real + 1j * imag).astype(numpy.complex64)
+    return median(data, radius, value_range)
+
+
+def _sorted_median(data, radius, _value_range=None):
+    return median_filter(data, radius, bins=0, workers=1)
+
+
+def median_value_range(data: numpy.ndarray, percentile=MEDIAN_RANGE_PERCENTILE, max_samples=MEDIAN_RANGE_SAMPLES):
+    """
+    Value range of the histogram median for the whole frame, without the lowest and highest
+    percentile % of the values (of at most max_samples regularly spaced ones), so that outliers do
+    not stretch the bins. For complex data +-the upper percentile of |data|, which holds for the real
+    and the imaginary part and does not change when the tilt is removed.
+    """
+    flat = data.reshape(-1)
+    samples = flat[::max(flat.size // max_samples, 1)]
+    samples = samples[numpy.isfinite(samples)]
+    if not samples.size:
+        return 0.0, 0.0
+    if numpy.iscomplexobj(samples):
+        peak = float(numpy.percentile(numpy.abs(samples), 100 - percentile))
+        return -peak, peak
+    low, high = numpy.percentile(samples, (percentile, 100 - percentile))
+    return float(low), float(high)
+
+
+def apply_filter(data: numpy.ndarray, setting: cuda_holo.Filters, radius: int = None, band_rows=None,
+                 workers=None) -> numpy.ndarray:
+    """
+    Filter an image or stack (..., h, w), e.g. a complex phasor field, per Filters in parallel bands of rows.
+    radius: overrides the radius of the setting (see filter_radius).
+    """
+    radius = filter_radius(setting) if radius is None else radius
+    if radius <= 0:
+        return data.copy()
+    tilt = field_tilt(data) if numpy.iscomplexobj(data) and setting.flag_tilt_compensated_filtering else None
+    median = cuda_holo.FilterType(setting.filter_type) == cuda_holo.FilterType.median_filter
+    value_range = median_value_range(data) if median else None
+    out = numpy.empty(data.shape, dtype=numpy.complex64 if numpy.iscomplexobj(data) else numpy.float32)
+
+    def process(band: tiles.RowBand):
+        filtered = filter_image(data[..., band.padded, :], setting, radius, tilt, band.pad_start, value_range)
+        out[..., band.core, :] = filtered[..., band.core_in_padded, :]
+
+    halo = filter_halo(setting, radius)
+    tiles.map_row_bands(process, data.shape[-2], band_rows or _band_rows_for_halo(halo), halo=halo, workers=workers)
+    return out
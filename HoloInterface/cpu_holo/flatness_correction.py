@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Flatness correction and virtual lens (FlatnessCorrection) for the complex fields of all lasers.
+
+The correction phase of a laser with wavelength l on pixels of size p, with x, y in pixels from the
+frame center (h // 2, w // 2), is
+    4 pi / l * p * (tan(tilt_x) x + tan(tilt_y) y)                  surface tilt in degrees (reflection)
+    + 1e-6 * second_order_term * (x^2 + second_order_term_correction_y * y^2)   in rad / px^2
+    - pi * refractive_power_dpt * p^2 * (x^2 + y^2) / l             virtual lens (refractive power in dpt)
+The virtual lens is left out with no_virtual_lens; the whole correction is applied before or after
+propagation per virtual_lens_method (after propagation without virtual lens).
+
+All terms separate into a function of the row times a function of the column, so the correction
+is exp(i phase_y) exp(i phase_x): the two complex vectors are cached per shape, pixel size,
+wavelength and parameter set (LRU, see cache.py) instead of a full mask, and the fields are
+multiplied in place in parallel bands of rows with the outer product of the band, without a
+full-frame temporary.
+"""
+
+import math
+from typing import Sequence, Tuple
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import tiles
+from cpu_holo.cache import ArrayCache
+
+LENS = cuda_holo.VirtualLensMethod
+
+FLATNESS_CACHE = ArrayCache(64 << 20)
+
+
+def correction_stage(settings: cuda_holo.FlatnessCorrection) -> cuda_holo.VirtualLensMethod:
+    """virtual_lens_before_propagation or virtual_lens_after_propagation."""
+    method = LENS(settings.virtual_lens_method)
+    return LENS.virtual_lens_after_propagation if method == LENS.no_virtual_lens else method
+
+
+def settings_key(settings: cuda_holo.FlatnessCorrection) -> Tuple:
+    """The parameters the correction depends on."""
+    lens = settings.refractive_power_dpt if LENS(settings.virtual_lens_method) != LENS.no_virtual_lens else 0.0
+    return (float(settings.tilt_x), float(settings.tilt_y), float(settings.second_order_term),
+            float(settings.second_order_term_correction_y), float(lens))
+
+
+def is_identity(settings: cuda_holo.FlatnessCorrection) -> bool:
+    tilt_x, tilt_y, second_order, _correction_y, lens = settings_key(settings)
+    return tilt_x == tilt_y == second_order == lens == 0
+
+
+def correction_vectors(shape, pixel_m, wavelength_m, settings: cuda_holo.FlatnessCorrection):
+    """exp(i phase_y) (h, 1) and exp(i phase_x) (1, w) of the correction, complex64."""
+    tilt_x, tilt_y, second_order, correction_y, lens = settings_key(settings)
+    y = (numpy.arange(shape[0]) - shape[0] // 2).astype(numpy.float64)
+    x = (numpy.arange(shape[1]) - shape[1] // 2).astype(numpy.float64)
+    slope = 4 * math.pi / wavelength_m * pixel_m
+    curvature = math.pi * lens * pixel_m * pixel_m / wavelength_m
+    phase_y = slope * math.tan(math.radians(tilt_y)) * y + (1e-6 * second_order * correction_y - curvature) * y * y
+    phase_x = slope * math.tan(math.radians(tilt_x)) * x + (1e-6 * second_order - curvature) * x * x
+    return (numpy.exp(1j * phase_y).astype(numpy.complex64)[:, None],
+            numpy.exp(1j * phase_x).astype(numpy.complex64)[None, :])
+
+
+def cached_correction_vectors(shape, pixel_m, wavelength_m, settings: cuda_holo.FlatnessCorrection,
+                              cache: ArrayCache = FLATNESS_CACHE):
+    key = ("flatness", tuple(shape), float(pixel_m), float(wavelength_m)) + settings_key(settings)
+    return cache.get(key, lambda: correction_vectors(shape, pixel_m, wavelength_m, settings))
+
+
+def apply_correction(fields: numpy.ndarray, pixel_m, wavelengths_m: Sequence[float],
+                     settings: cuda_holo.FlatnessCorrection, stage: cuda_holo.VirtualLensMethod = None,
+                     band_rows=tiles.DEFAULT_BAND_ROWS, workers=None, cache: ArrayCache = FLATNESS_CACHE) -> bool:
+    """
+    Multiply the fields (h, w) or (lasers, h, w) in place with the correction of their wavelength.
+    stage: the propagation stage this call is made at; nothing is done if the correction belongs
+    to the other one. Returns whether the fields were changed.
+    """
+    if stage is not None and LENS(stage) != correction_stage(settings) or is_identity(settings):
+        return False
+    stack = fields[None] if fields.ndim == 2 else fields
+    wavelengths = [float(wavelengths_m)] * stack.shape[0] if numpy.isscalar(wavelengths_m) else list(wavelengths_m)
+    if len(wavelengths) != stack.shape[0]:
+        raise ValueError(f"{len(wavelengths)} wavelengths for {stack.shape[0]} fields")
+    vectors = [cached_correction_vectors(stack.shape[-2:], pixel_m, w, settings, cache) for w in wavelengths]
+
+    def process(band: tiles.RowBand):
+        for field, (rows, cols) in zip(stack, vectors):
+            field[band.core] *= rows[band.core] * cols
+
+    tiles.map_row_bands(process, stack.shape[-2], band_rows, workers=workers)
+    return True
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Final evaluation step STEP_SYN_PHASES_COMBINED -> STEP_CONVERTED_TO_HEIGHT (HeightValueConversionSettings).
+
+The combined phase (rad) of the combined wavelength L is converted to a height h = phase L / (4 pi)
+(reflection) in the unit of ConvertToHeightUnits; with revert_untilt the tilt plane removed before
+(see tilt.py) is added back. Both happen in one fused pass: the phase is multiplied with the scale
+into the output (in place if wanted) and the scaled plane is added as a row and a column vector,
+in parallel bands of rows. transpose_image and rotation_type are applied as strided views of that
+buffer; materialize copies a view into a contiguous array, which is only needed for export.
+"""
+
+import math
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.holo_display_renderer as holo_renderer
+import globals.IPM_Holo_Globals as holo_globals
+from cpu_holo import tiles
+
+UNITS = cuda_holo.ConvertToHeightUnits
+
+UNIT_FACTORS = {UNITS.convert_to_m: 1.0, UNITS.convert_to_mm: 1e3, UNITS.convert_to_micron: 1e6}
+
+
+def settings_from_jso(jso: dict) -> cuda_holo.HeightValueConversionSettings:
+    """HeightValueConversionSettings from a measurement json (KeysHeightConversionSettings); missing keys keep their defaults."""
+    keys = holo_globals.KeysHeightConversionSettings()
+    settings = cuda_holo.HeightValueConversionSettings()
+    for key, attribute, convert in ((keys.CONVERT_TO_HEIGHT_UNIT, "convert_to_height_unit", int),
+                                    (keys.REVERT_UNTILT, "revert_untilt", bool),
+                                    (keys.TRANSPOSE, "transpose_image", bool),
+                                    (keys.ROTATION_TYPE, "rotation_type", int)):
+        if key.decode() in jso:
+            setattr(settings, attribute, convert(jso[key.decode()]))
+    return settings
+
+
+def height_scale(unit: cuda_holo.ConvertToHeightUnits, wavelength_m) -> float:
+    """Factor from phase (rad) of the wavelength to the height unit; 1 for convert_none."""
+    unit = UNITS(unit)
+    if unit == UNITS.convert_none:
+        return 1.0
+    return wavelength_m / (4 * math.pi) * UNIT_FACTORS[unit]
+
+
+def oriented_view(data: numpy.ndarray, settings: cuda_holo.HeightValueConversionSettings) -> numpy.ndarray:
+    """transpose_image, then rotation_type, as a strided view of data (h, w); nothing is copied."""
+    view = data.T if settings.transpose_image else data
+    return holo_renderer.rotated_view(view, settings.rotation_type)
+
+
+def materialize(view: numpy.ndarray, out: numpy.ndarray = None) -> numpy.ndarray:
+    """Contiguous copy of an oriented view for export (into out if given)."""
+    if out is None:
+        return numpy.ascontiguousarray(view)
+    out[...] = view
+    return out
+
+
+def convert_to_height(phase: numpy.ndarray, settings: cuda_holo.HeightValueConversionSettings, wavelength_m,
+                      tilt: numpy.ndarray = None, out: numpy.ndarray = None, band_rows=tiles.DEFAULT_BAND_ROWS,
+                      workers=None) -> numpy.ndarray:
+    """
+    Height map of the combined phase (h, w) of wavelength_m (KEY_LDA_COMBINED_) as an oriented view.
+    tilt: (rows, cols, piston) in rad of wavelength_m as returned by tilt.estimate_tilt, added back
+    with revert_untilt. out=phase converts in place; the returned view shares memory with out.
+    """
+    scale = height_scale(settings.convert_to_height_unit, wavelength_m)
+    out = numpy.empty(phase.shape, dtype=numpy.float32) if out is None else out
+    row_term = col_term = None
+    if settings.revert_untilt and tilt is not None:
+        row_term = ((numpy.arange(phase.shape[0]) * tilt[0] + tilt[2]) * scale).astype(out.dtype)[:, None]
+        col_term = (numpy.arange(phase.shape[1]) * tilt[1] * scale).astype(out.dtype)[None, :]
+
+    def process(band: tiles.RowBand):
+        rows = out[band.core]
+        numpy.multiply(phase[band.core], scale, out=rows)
+        if row_term is not None:
+            rows += row_term[band.core]
+            rows += col_term
+
+    tiles.map_row_bands(process, phase.shape[0], band_rows, workers=workers)
+    return oriented_view(out, settings)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Geometric masks of a Ring (GeometricMask.ring_mask, TiltSettings.ring_for_roi, CircleTilt.ring) or
+a HoloArea inside a frame, built once per geometry and frame shape and kept in MASK_CACHE.
+
+A RegionMask holds the bounding box of the region as slices, the boolean mask inside the box and
+the absolute rows, columns and flat indices of its pixels; ring pixels are sorted by their angle
+around the center (the order tilt.py unwraps along). Masked reads and statistics only touch the
+bounding box, so they scale with the ring area instead of the frame size. apply_ring_mask
+multiplies the pixels outside the ring with val_to_multiply: the frame outside the bounding box is
+scaled as plain slices, the mask is only evaluated inside the box.
+"""
+
+import math
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo.cache import ArrayCache
+
+MASK_CACHE = ArrayCache(64 << 20)
+
+
+def ring_key(ring: cuda_holo.Ring):
+    return int(ring.center_x), int(ring.center_y), int(ring.radius), int(ring.width)
+
+
+def area_key(area: cuda_holo.HoloArea):
+    return int(area.x_center), int(area.y_center), int(area.width), int(area.height)
+
+
+def area_slices(area: cuda_holo.HoloArea, shape):
+    """Rows and columns of a HoloArea (centered at x_center, y_center), clipped to the frame."""
+    top = max(int(area.y_center) - int(area.height) // 2, 0)
+    left = max(int(area.x_center) - int(area.width) // 2, 0)
+    rows = slice(top, min(top + max(int(area.height), 1), shape[0]))
+    cols = slice(left, min(left + max(int(area.width), 1), shape[1]))
+    if rows.start >= rows.stop or cols.start >= cols.stop:
+        raise ValueError(f"area at ({area.x_center}, {area.y_center}) is outside the frame {tuple(shape)}")
+    return rows, cols
+
+
+class RegionMask:
+    """Pixels of a region of a frame: bounding box slices, mask in the box, rows / cols / flat indices."""
+
+    def __init__(self, shape, rows: slice, cols: slice, mask: numpy.ndarray, order: numpy.ndarray = None):
+        self.shape = tuple(shape)
+        self.rows = rows
+        self.cols = cols
+        self.mask = mask
+        box_rows, box_cols = numpy.nonzero(mask)
+        if order is not None:
+            box_rows, box_cols = box_rows[order], box_cols[order]
+        self.pixel_rows = (box_rows + rows.start).astype(numpy.intp)
+        self.pixel_cols = (box_cols + cols.start).astype(numpy.intp)
+        self.flat = self.pixel_rows * self.shape[1] + self.pixel_cols
+
+    def __repr__(self):
+        return f"<RegionMask {self.size} pixels in rows {self.rows.start}:{self.rows.stop}, cols {self.cols.start}:{self.cols.stop}>"
+
+    @property
+    def size(self) -> int:
+        return self.flat.size
+
+    @property
+    def box(self):
+        return self.rows, self.cols
+
+    @property
+    def nbytes(self):
+        return self.mask.nbytes + self.pixel_rows.nbytes + self.pixel_cols.nbytes + self.flat.nbytes
+
+
+def _ring_region(shape, ring: cuda_holo.Ring) -> RegionMask:
+    half_width = max(ring.width, 1) / 2
+    outer = int(math.ceil(ring.radius + half_width))
+    rows = slice(max(ring.center_y - outer, 0), max(min(ring.center_y + outer + 1, shape[0]), 0))
+    cols = slice(max(ring.center_x - outer, 0), max(min(ring.center_x + outer + 1, shape[1]), 0))
+    dy = (numpy.arange(rows.start, max(rows.stop, rows.start)) - ring.center_y)[:, None]
+    dx = (numpy.arange(cols.start, max(cols.stop, cols.start)) - ring.center_x)[None, :]
+    distance = numpy.sqrt(dy * dy + dx * dx)
+    mask = (distance >= ring.radius - half_width) & (distance < ring.radius + half_width)
+    box_rows, box_cols = numpy.nonzero(mask)
+    order = numpy.argsort(numpy.arctan2(dy[box_rows, 0], dx[0, box_cols]), kind="stable")
+    return RegionMask(shape, rows, cols, mask, order)
+
+
+def ring_mask(shape, ring: cuda_holo.Ring, cache: ArrayCache = MASK_CACHE) -> RegionMask:
+    """Pixels with |distance to the center - radius| < width / 2, sorted by angle."""
+    shape = tuple(shape[-2:])
+    return cache.get(("ring",) + shape + ring_key(ring), lambda: _ring_region(shape, ring))
+
+
+def area_mask(shape, area: cuda_holo.HoloArea, cache: ArrayCache = MASK_CACHE) -> RegionMask:
+    """Pixels of a HoloArea clipped to the frame, row by row."""
+    shape = tuple(shape[-2:])
+
+    def build():
+        rows, cols = area_slices(area, shape)
+        return RegionMask(shape, rows, cols, numpy.ones((rows.stop - rows.start, cols.stop - cols.start), dtype=bool))
+
+    return cache.get(("area",) + shape + area_key(area), build)
+
+
+def masked_values(data: numpy.ndarray, region: RegionMask) -> numpy.ndarray:
+    """Values of the region in each map of data (..., h, w) -> (..., pixels), read from the bounding box only."""
+    return data[..., region.rows, region.cols][..., region.mask] if region.size else data[..., :0, 0]
+
+
+def masked_mean(data: numpy.ndarray, region: RegionMask, ignore_nan=True) -> numpy.ndarray:
+    """Mean over the region of each map (NaN ignored unless ignore_nan is False)."""
+    values = masked_values(data, region)
+    return (numpy.nanmean if ignore_nan else numpy.mean)(values, axis=-1)
+
+
+def masked_std(data: numpy.ndarray, region: RegionMask, ignore_nan=True) -> numpy.ndarray:
+    values = masked_values(data, region)
+    return (numpy.nanstd if ignore_nan else numpy.std)(values, axis=-1)
+
+
+def apply_ring_mask(data: numpy.ndarray, mask: cuda_holo.GeometricMask, cache: ArrayCache = MASK_CACHE) -> bool:
+    """
+    Multiplies the pixels of data (..., h, w) outside ring_mask with ring_mask.val_to_multiply in
+    place if apply_ring_mask is set. Returns whether data was changed.
+    """
+    if not mask.apply_ring_mask:
+        return False
+    region = ring_mask(data.shape, mask.ring_mask, cache)
+    value = mask.ring_mask.val_to_multiply
+    rows, cols = region.rows, region.cols
+    data[..., :rows.start, :] *= value
+    data[..., rows.stop:, :] *= value
+    data[..., rows, :cols.start] *= value
+    data[..., rows, cols.stop:] *= value
+    box = data[..., rows, cols]
+    box[..., ~region.mask] *= value
+    return True
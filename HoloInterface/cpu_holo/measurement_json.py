@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Access to the settings of a measurement json (as sent to / logged by the HoloSoftware) that the
+CPU evaluation needs. Key names come from the generated Keys* structs where they exist, otherwise
+from Keylist.csv.
+"""
+
+from typing import Dict, List
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.IPM_Holo_Globals as holo_globals
+
+# Keylist.csv names without a Keys* struct
+KEY_HOLO_SETTING = "holography_settings"
+KEY_PROPAGATION_MM = "propagation_mm"
+KEY_PROPGATION_METHO = "propagation_method"
+KEY_LDA_COMBINED = "combined_m"
+
+
+def _str(key) -> str:
+    return key.decode() if isinstance(key, bytes) else key
+
+
+def single_lasers(measurement: dict) -> List[dict]:
+    """Settings of the single lasers, ordered by laser index."""
+    lasers = measurement[_str(holo_globals.KeysTopLevel().KEY_SINGLE_LASERS)]
+    return [lasers[key] for key in sorted(lasers, key=int)]
+
+
+def num_phase_steps(measurement: dict) -> List[int]:
+    """KEY_NUM_PHASE_STEPS per laser."""
+    key = _str(holo_globals.KeysSingleLaser().KEY_NUM_PHASE_STEPS)
+    return [int(laser[key]) for laser in single_lasers(measurement)]
+
+
+def laser_wavelengths_m(measurement: dict) -> List[float]:
+    """KEY_LASER_WL_M per laser."""
+    key = _str(holo_globals.KeysSingleLaser().KEY_LASER_WL_M)
+    return [float(laser[key]) for laser in single_lasers(measurement)]
+
+
+def combined_wavelength_m(measurement: dict):
+    """KEY_LDA_COMBINED_ of the synthetic wavelengths (KEY_LDA_COMBOS), None if it is not set."""
+    combos = measurement.get(_str(holo_globals.KeysTopLevel().KEY_LDA_COMBOS))
+    if not isinstance(combos, dict) or combos.get(KEY_LDA_COMBINED) is None:
+        return None
+    return float(combos[KEY_LDA_COMBINED])
+
+
+def camera_settings(measurement: dict) -> Dict:
+    return measurement[_str(holo_globals.KeysTopLevel().KEY_CAMERA_SETTINGS)]
+
+
+def pixel_size_cam_m(measurement: dict) -> float:
+    """KEY_PIXEL_CAM_UM, converted to m."""
+    return float(camera_settings(measurement)[_str(holo_globals.KeysCameraSettings().KEY_PIXEL_CAM_UM)]) * 1e-6
+
+
+def holography_settings(measurement: dict) -> Dict:
+    return measurement[KEY_HOLO_SETTING]
+
+
+def propagation_settings(measurement: dict):
+    """(PropagationMethod, distance in m) from KEY_PROPGATION_METHO and KEY_PROPAGATION_MM."""
+    settings = holography_settings(measurement)
+    return (cuda_holo.PropagationMethod(int(settings[KEY_PROPGATION_METHO])),
+            float(settings[KEY_PROPAGATION_MM]) * 1e-3)
+
+
+# Keylist.csv names of the extended depth settings (KEY_EXTENDED_DEPTH_SETTINGS) and the ExtendedDepthSetting fields
+KEY_EXTENDED_DEPTH_SETTINGS = "extended_depth_settings"
+_EXTENDED_DEPTH_KEYS = (("extended_depth_active", "do_extended_depth", bool),
+                        ("extended_depth_multiplane_propagation", "do_multi_plane_propagation", bool),
+                        ("extended_depth_interpolate_multiplane", "interpolate_multi_plane", bool),
+                        ("extended_depth_depthrange", "searchrange_mm", float),
+                        ("extended_depth_num_propagation_distances", "num_propagation_distances", int),
+                        ("extended_depth_method", "extended_depth_method", int),
+                        ("extended_depth_prop_planes_selection_method", "prop_planes_selection_method", int),
+                        ("extended_depth_auto_tilt_estimation", "auto_tilt_estimation", bool),
+                        ("extended_depth_tilt_x_deg", "tilt_estimation_x_deg", float),
+                        ("extended_depth_tilt_y_deg", "tilt_estimation_y_deg", float),
+                        ("num_planes_SFF", "num_planes_sff", int),
+                        ("filter_radius_SFF", "filterradius_median_sff", int),
+                        ("smooth_SFF_with_synth", "use_synth_for_smoothing_sff", bool),
+                        ("threshold_SFF", "threshold_sff_quality", float),
+                        ("radius_open_sff_mask", "filter_radius_open_sffmask", int),
+                        ("radius_close_sff_mask", "filter_radius_close_sffmask", int))
+
+
+def extended_depth_setting(jso: dict) -> cuda_holo.ExtendedDepthSetting:
+    """ExtendedDepthSetting from "extended_depth_settings"; missing keys keep their defaults."""
+    setting = cuda_holo.ExtendedDepthSetting()
+    for key, attribute, convert in _EXTENDED_DEPTH_KEYS:
+        if key in jso:
+            setattr(setting, attribute, convert(jso[key]))
+    for key, attribute in (("extended_depth_center_x", "x_center"), ("extended_depth_center_y", "y_center")):
+        if key in jso:
+            setattr(setting.roi, attribute, int(jso[key]))
+    return setting
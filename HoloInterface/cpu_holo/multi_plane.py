@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-plane propagation for extended depth of field (ExtendedDepthSetting.do_multi_plane_propagation).
+
+A coarse height map (usually from the largest synthetic wavelength) gives every pixel the distance
+at which it is in focus. num_propagation_distances planes are selected from these distances
+(PropPlanesSelectionMethod), and every pixel takes its field from the nearest plane, or blended
+linearly between the two planes around it with interpolate_multi_plane.
+
+The frame is divided into tiles. A plane is only propagated for runs of tile rows that contain
+pixels using it, cropped to the needed tiles plus a guard band against wrap-around; the guard grows
+with the propagation distance and the numerical aperture of the optics. A run is split where its
+used tile columns leave a gap wider than two guards. Crops keep their full guard at the frame edges
+(shifted inwards instead of clipped), so crops over the same number of tiles share one shape and
+thus one cached transfer function. Crops are propagated in parallel and merged in plane order.
+"""
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import propagation, tiles
+from cpu_holo.cache import ArrayCache
+
+DEFAULT_TILE = 128
+DEFAULT_NUMERICAL_APERTURE = 0.05
+HISTOGRAM_BINS_PER_PLANE = 4
+
+
+def focus_distance_mm(height_m: numpy.ndarray, setting: cuda_holo.ExtendedDepthSetting) -> numpy.ndarray:
+    """Distance of best focus per pixel: prop_distance_at_roi_mm plus the height (m); NaN stays NaN."""
+    return setting.prop_distance_at_roi_mm + height_m * 1e3
+
+
+def height_from_synthetic_phase(phase: numpy.ndarray, synthetic_wavelength_m) -> numpy.ndarray:
+    """Height (m) of a reflection measurement from a phase (rad) of the given synthetic wavelength."""
+    return phase * (synthetic_wavelength_m / (4 * math.pi))
+
+
+def select_planes(distances_mm: numpy.ndarray, setting: cuda_holo.ExtendedDepthSetting) -> numpy.ndarray:
+    """
+    num_propagation_distances plane distances (mm, ascending) for the valid distances, limited to
+    searchrange_mm around prop_distance_at_roi_mm.
+    uniform_distribution: evenly from the smallest to the largest distance.
+    histogram: mean distance in each of the most populated bins of a histogram with 4 bins per plane.
+    """
+    num_planes = max(int(setting.num_propagation_distances), 1)
+    half_range = setting.searchrange_mm / 2
+    values = distances_mm[numpy.isfinite(distances_mm)]
+    values = values[numpy.abs(values - setting.prop_distance_at_roi_mm) <= half_range]
+    if values.size == 0:
+        return numpy.array([setting.prop_distance_at_roi_mm])
+    low, high = float(values.min()), float(values.max())
+    if num_planes == 1 or high == low:
+        return numpy.array([0.5 * (low + high)])
+    method = cuda_holo.PropPlanesSelectionMethod(setting.prop_planes_selection_method)
+    if method == cuda_holo.PropPlanesSelectionMethod.uniform_distribution:
+        return numpy.linspace(low, high, num_planes)
+    counts, edges = numpy.histogram(values, bins=HISTOGRAM_BINS_PER_PLANE * num_planes, range=(low, high))
+    populated = numpy.flatnonzero(counts)
+    best = populated[numpy.argsort(counts[populated], kind="stable")[::-1][:num_planes]]
+    bin_of_value = numpy.clip(numpy.searchsorted(edges, values, side="right") - 1, 0, counts.size - 1)
+    sums = numpy.bincount(bin_of_value, weights=values, minlength=counts.size)
+    return numpy.sort(sums[best] / counts[best])
+
+
+def plane_weights(distances_mm: numpy.ndarray, planes: numpy.ndarray, interpolate: bool):
+    """
+    Lower plane index and weight of the upper plane per pixel (weight 0 without interpolation, where
+    the index is the nearest plane). Pixels without a distance use the plane nearest the median, or
+    the middle plane if no pixel has a distance.
+    """
+    valid = numpy.isfinite(distances_mm)
+    fallback = numpy.median(distances_mm[valid]) if valid.any() else numpy.median(planes)
+    distances = numpy.where(valid, distances_mm, fallback)
+    if planes.size == 1:
+        return numpy.zeros(distances.shape, dtype=numpy.intp), numpy.zeros(distances.shape, dtype=numpy.float32)
+    lower = numpy.clip(numpy.searchsorted(planes, distances) - 1, 0, planes.size - 2)
+    weight = numpy.clip((distances - planes[lower]) / (planes[lower + 1] - planes[lower]), 0, 1)
+    if not interpolate:
+        lower = lower + (weight > 0.5)
+        weight = numpy.zeros_like(weight)
+    return lower, weight.astype(numpy.float32)
+
+
+def tile_usage(lower: numpy.ndarray, weight: numpy.ndarray, num_planes: int, tile: int) -> numpy.ndarray:
+    """Boolean (planes, tile rows, tile cols): does any pixel of the tile take a contribution from the plane."""
+    height, width = lower.shape
+    tile_rows, tile_cols = -(-height // tile), -(-width // tile)
+    tile_id = (numpy.arange(height)[:, None] // tile) * tile_cols + numpy.arange(width)[None, :] // tile
+    used = numpy.zeros((num_planes, tile_rows * tile_cols), dtype=bool)
+    used[lower[weight < 1], tile_id[weight < 1]] = True
+    upper = weight > 0
+    used[lower[upper] + 1, tile_id[upper]] = True
+    return used.reshape(num_planes, tile_rows, tile_cols)
+
+
+def _runs(indices: numpy.ndarray, max_gap=1) -> List[numpy.ndarray]:
+    """Split ascending indices where consecutive ones are more than max_gap apart."""
+    return numpy.split(indices, numpy.flatnonzero(numpy.diff(indices) > max_gap) + 1)
+
+
+def _crop_slices(first_tile, last_tile, tile, guard, size) -> Tuple[slice, slice]:
+    """(crop, target) along one axis; the crop keeps its length at the frame edges by shifting inwards."""
+    target = slice(first_tile * tile, min((last_tile + 1) * tile, size))
+    length = min((last_tile + 1 - first_tile) * tile + 2 * guard, size)
+    start = min(max(target.start - guard, 0), size - length)
+    return slice(start, start + length), target
+
+
+def plane_crops(used: numpy.ndarray, shape, tile: int, guard: int) -> List[Tuple[slice, slice, slice, slice]]:
+    """
+    (rows, cols) of the crops to propagate for one plane and the part of the frame they deliver:
+    one crop per run of consecutive tile rows using the plane and per group of its used tile columns
+    (split where bridging the gap would cost more than the two guards of a separate crop).
+    Returns (crop rows, crop cols, target rows, target cols).
+    """
+    crops = []
+    rows_used = numpy.flatnonzero(used.any(axis=1))
+    if rows_used.size == 0:
+        return crops
+    max_gap = 2 * guard // tile + 1
+    for run in _runs(rows_used):
+        crop_rows, target_rows = _crop_slices(run[0], run[-1], tile, guard, shape[0])
+        for cols in _runs(numpy.flatnonzero(used[run].any(axis=0)), max_gap):
+            crop_cols, target_cols = _crop_slices(cols[0], cols[-1], tile, guard, shape[1])
+            crops.append((crop_rows, crop_cols, target_rows, target_cols))
+    return crops
+
+
+class MultiPlaneResult:
+    def __init__(self, fields, planes_mm, lower, weight, tiles_propagated, crops_propagated, pixels_propagated):
+        self.fields = fields
+        self.planes_mm = planes_mm
+        self.lower = lower  # plane index per pixel (nearest plane without interpolation)
+        self.weight = weight  # weight of plane lower + 1
+        self.tiles_propagated = tiles_propagated  # sum over planes of the tiles that use the plane
+        self.crops_propagated = crops_propagated  # number of propagations
+        self.pixels_propagated = pixels_propagated  # total area of the propagated crops, guards included
+
+    def __repr__(self):
+        return (f"<MultiPlaneResult {len(self.planes_mm)} planes, {self.crops_propagated} crops of "
+                f"{self.pixels_propagated} pixels propagated>")
+
+
+def multi_plane_propagation(fields: numpy.ndarray, pixel_m, wavelengths_m, distances_mm: numpy.ndarray,
+                            setting: cuda_holo.ExtendedDepthSetting, tile=DEFAULT_TILE,
+                            numerical_aperture=DEFAULT_NUMERICAL_APERTURE, workers=None,
+                            cache: ArrayCache = propagation.PROPAGATION_CACHE) -> MultiPlaneResult:
+    """
+    Fields (lasers, h, w) at STEP_CAM_CPX, each pixel propagated to (or between) the planes around
+    its focus distance distances_mm (h, w), see focus_distance_mm.
+    """
+    single = fields.ndim == 2
+    fields = fields[None] if single else fields
+    shape = fields.shape[-2:]
+    planes = select_planes(distances_mm, setting)
+    lower, weight = plane_weights(distances_mm, planes, setting.interpolate_multi_plane)
+    used = tile_usage(lower, weight, planes.size, tile)
+
+    jobs = []
+    for plane, distance in enumerate(planes):
+        guard = int(math.ceil(abs(distance) * 1e-3 * numerical_aperture / pixel_m)) + 8
+        jobs += [(plane, crop) for crop in plane_crops(used[plane], shape, tile, guard)]
+
+    def propagate_crop(job):
+        plane, (crop_rows, crop_cols, _, _) = job
+        return propagation.propagate(fields[:, crop_rows, crop_cols], pixel_m, wavelengths_m, planes[plane] * 1e-3,
+                                     cache=cache)
+
+    out = numpy.zeros(fields.shape, dtype=numpy.complex64)
+    with ThreadPoolExecutor(workers or tiles.default_workers()) as pool:
+        for (plane, (crop_rows, crop_cols, target_rows, target_cols)), propagated in zip(jobs,
+                                                                                       pool.map(propagate_crop, jobs)):
+            inner = propagated[:, target_rows.start - crop_rows.start:target_rows.stop - crop_rows.start,
+                               target_cols.start - crop_cols.start:target_cols.stop - crop_cols.start]
+            lo, w = lower[target_rows, target_cols], weight[target_rows, target_cols]
+            # contribution of this plane: 1 - w where it is the lower plane, w where it is the upper one
+            factor = numpy.where(lo == plane, 1 - w, 0) + numpy.where(lo + 1 == plane, w, 0)
+            out[:, target_rows, target_cols] += inner * factor.astype(numpy.float32)
+    pixels_propagated = sum((crop_rows.stop - crop_rows.start) * (crop_cols.stop - crop_cols.start)
+                            for _, (crop_rows, crop_cols, _, _) in jobs)
+    return MultiPlaneResult(out[0] if single else out, planes, lower, weight, int(used.sum()), len(jobs),
+                            pixels_propagated)
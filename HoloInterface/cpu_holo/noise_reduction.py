@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Noise reduction of complex fields (NoiseDetectionSettings).
+
+A phasor is an outlier when its phase deviates from the mean phasor of its neighbourhood
+(radius filter_radius_noise_detection). The deviation d is turned into a weight
+    w = 1 / (1 + (d / cutoff)^(2 order))
+i.e. a low pass with the steepness order around the cut off KEY_NOISE_DETECTION_CUTOFF (rad), and
+the method decides what happens with the weight:
+    ReduceAmplitude        the phasor is multiplied with w
+    WeightedNeigbourhood   blended with the neighbourhood mean weighted by w, so outliers are
+                           filled from their consistent neighbours
+    ComplexMedianFilter    blended with the median of the real and imaginary parts
+Bands of rows are processed in parallel with a halo of twice the radius; the scratch of each band
+is kept per worker thread and the output buffer is reused by the next call of the same shape.
+"""
+
+import threading
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import filters, tiles
+
+METHODS = cuda_holo.NoiseDetectionMethods
+
+# Keylist.csv names without a Keys* struct
+KEY_NOISE_DETECTION_SETTING = "noise_reduction_settings"
+KEY_NOISE_DETECTION_METHOD = "key_noise_detection_method"
+KEY_NOISE_DETECTION_FILTER_RADIUS = "key_noise_detection_filter_radius"
+KEY_NOISE_DETECTION_CUTOFF = "key_noise_detection_cutoff"
+KEY_NOISE_DETECTION_ORDER = "key_noise_detection_order"
+
+DEFAULT_CUTOFF = 1.57
+
+
+def settings_from_jso(jso: dict):
+    """(NoiseDetectionSettings, cut off) from the "noise_reduction_settings" of a measurement json."""
+    settings = cuda_holo.NoiseDetectionSettings()
+    for key, attribute, convert in ((KEY_NOISE_DETECTION_METHOD, "method", int),
+                                    (KEY_NOISE_DETECTION_FILTER_RADIUS, "filter_radius_noise_detection", float),
+                                    (KEY_NOISE_DETECTION_ORDER, "order", int)):
+        if key in jso:
+            setattr(settings, attribute, convert(jso[key]))
+    return settings, float(jso.get(KEY_NOISE_DETECTION_CUTOFF, DEFAULT_CUTOFF))
+
+
+def detection_radius(settings: cuda_holo.NoiseDetectionSettings) -> int:
+    return max(int(round(settings.filter_radius_noise_detection)), 0)
+
+
+def phase_deviation(fields: numpy.ndarray, radius: int, neighbourhood: numpy.ndarray = None) -> numpy.ndarray:
+    """|phase difference| (rad) of each phasor to the mean phasor of its neighbourhood."""
+    neighbourhood = filters.box_mean(fields, radius) if neighbourhood is None else neighbourhood
+    return numpy.abs(numpy.angle(fields * numpy.conj(neighbourhood))).astype(numpy.float32)
+
+
+def outlier_weight(deviation: numpy.ndarray, cutoff=DEFAULT_CUTOFF, order=3, out: numpy.ndarray = None) -> numpy.ndarray:
+    """1 for consistent phasors, falling to 0 above cutoff with the steepness order."""
+    out = numpy.divide(deviation, cutoff, out=out)
+    numpy.power(out, 2 * max(int(order), 1), out=out)
+    out += 1
+    return numpy.reciprocal(out, out=out)
+
+
+class NoiseReducer:
+    """Applies one NoiseDetectionSettings repeatedly to fields (h, w) or (lasers, h, w)."""
+
+    def __init__(self, settings: cuda_holo.NoiseDetectionSettings, cutoff=DEFAULT_CUTOFF,
+                 band_rows=tiles.DEFAULT_BAND_ROWS, workers=None):
+        self.method = METHODS(settings.method)
+        self.radius = detection_radius(settings)
+        self.order = settings.order
+        self.cutoff = cutoff
+        self.band_rows = band_rows
+        self.workers = workers
+        self._out = None
+        self._scratch = threading.local()
+
+    def __repr__(self):
+        return f"<NoiseReducer {self.method.name}, radius {self.radius}, cutoff {self.cutoff}, order {self.order}>"
+
+    @property
+    def halo(self) -> int:
+        return self.radius if self.method == METHODS.ReduceAmplitude else 2 * self.radius
+
+    def _weight_buffer(self, shape) -> numpy.ndarray:
+        scratch = self._scratch
+        if getattr(scratch, "shape", None) != shape:
+            scratch.weight = numpy.empty(shape, dtype=numpy.float32)
+            scratch.shape = shape
+        return scratch.weight
+
+    def _reduce_band(self, fields, band: tiles.RowBand, value_range, out):
+        padded = fields[..., band.padded, :]
+        core = band.core_in_padded
+        weight = self._weight_buffer(padded.shape)
+        outlier_weight(phase_deviation(padded, self.radius), self.cutoff, self.order, out=weight)
+        if self.method == METHODS.ReduceAmplitude:
+            numpy.multiply(padded[..., core, :], weight[..., core, :], out=out[..., band.core, :])
+            return
+        if self.method == METHODS.WeightedNeigbourhood:
+            valid = numpy.isfinite(weight)
+            weighted = numpy.where(valid, weight * padded, 0)
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                replacement = (filters.box_sum(weighted, self.radius)
+                               / filters.box_sum(numpy.where(valid, weight, 0), self.radius))[..., core, :]
+        else:
+            replacement = filters.complex_median(padded, self.radius, value_range)[..., core, :]
+        w = weight[..., core, :]
+        out[..., band.core, :] = w * padded[..., core, :] + (1 - w) * replacement
+
+    def reduce(self, fields: numpy.ndarray) -> numpy.ndarray:
+        """Noise reduced fields; the returned buffer is reused by the next call with the same shape."""
+        if self.method == METHODS.NoNoiseReduction or self.radius <= 0:
+            return fields
+        if self._out is None or self._out.shape != fields.shape:
+            self._out = numpy.empty(fields.shape, dtype=numpy.complex64)
+        value_range = filters.median_value_range(fields) if self.method == METHODS.ComplexMedianFilter else None
+        tiles.map_row_bands(lambda band: self._reduce_band(fields, band, value_range, self._out), fields.shape[-2],
+                            max(self.band_rows, 4 * self.halo), halo=self.halo, workers=self.workers)
+        return self._out
+
+
+def reduce_noise(fields: numpy.ndarray, settings: cuda_holo.NoiseDetectionSettings, cutoff=DEFAULT_CUTOFF,
+                 workers=None) -> numpy.ndarray:
+    """NoiseReducer for a single call; returns a new array (or fields itself with NoNoiseReduction)."""
+    return NoiseReducer(settings, cutoff, workers=workers).reduce(fields)
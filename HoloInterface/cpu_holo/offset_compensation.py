@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Offset compensation of wrapped phase maps (OffsetCompensationMethod).
+
+The offset is the phase that is subtracted (wrapped) from the whole map so that
+    OffsetFromRefPoint           the circular mean in the HoloArea of the setting
+    OffsetFromAutoRefPoint       the circular mean in the smoothest window of the HoloArea size
+    OffsetFromHistogram          the most frequent phase
+becomes phase_val_target, or so that
+    OffsetFromGlobalDiff         the circular mean difference to a reference map
+    OffsetFromGlobalDiffROIwise  the difference to the reference in each tile of the HoloArea size
+                                 (one offset per tile)
+vanishes; without reference map the reference is phase_val_target everywhere. With use_mirror_only
+only mirror-like pixels (phase consistent with their neighbours) take part. The offset in the
+HoloArea of the setting (the tile around its center for OffsetFromGlobalDiffROIwise) is reported by
+compensate_offset in phase_offset_roi_combined.
+
+Offsets are statistics, so except for the reference window they are taken from a regular grid of
+at most MAX_SAMPLES pixels (a strided view, no copy). Histograms and means are accumulated over
+bands of rows in one pass (fixed bins on [-pi, pi)), so memory mapped maps are read once. The
+smoothest window is found from integral images of the phasors: the circular variance
+1 - |mean phasor| of every window is a difference of four table entries, evaluated on a grid with
+half the window size as step. The search always runs on the sampled grid (windows of at least 2
+samples), so the tables stay within MAX_SAMPLES entries; windows smaller than the sample step are
+then refined at full resolution in a crop around the coarse window.
+"""
+
+import math
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import tiles
+from cpu_holo.masks import area_slices
+from cpu_holo.tilt import mirror_samples, wrap
+
+METHOD = cuda_holo.OffsetCompensationMethod
+
+HISTOGRAM_BINS = 256
+MAX_SAMPLES = 1 << 18
+
+
+class OffsetResult:
+    def __init__(self, offset, reference_point=None, roi_offset=None):
+        self.offset = offset  # rad, scalar or one per tile (OffsetFromGlobalDiffROIwise)
+        self.reference_point = reference_point  # (x_center, y_center) of the window used, if any
+        self.roi_offset = offset if roi_offset is None else roi_offset  # rad, offset in the HoloArea
+
+    def __repr__(self):
+        return f"<OffsetResult offset {numpy.round(self.offset, 4)}, reference point {self.reference_point}>"
+
+
+def sample_step(shape, max_samples=MAX_SAMPLES, max_step=None) -> int:
+    """Step of the regular grid with at most max_samples pixels (and at most max_step)."""
+    step = max(int(math.ceil(math.sqrt(shape[0] * shape[1] / max_samples))), 1)
+    return min(step, max(int(max_step), 1)) if max_step is not None else step
+
+
+def _samples(phase: numpy.ndarray, step: int, mirror_only: bool, reference: numpy.ndarray = None):
+    """(sampled phase, valid samples) on the grid with the given step; mirror-like is judged at full resolution."""
+    sampled = phase[::step, ::step]
+    valid = numpy.isfinite(sampled)
+    if reference is not None:
+        valid &= numpy.isfinite(reference[::step, ::step])
+    if mirror_only:
+        valid &= mirror_samples(phase, numpy.arange(0, phase.shape[0], step)[:, None],
+                                numpy.arange(0, phase.shape[1], step)[None, :])
+    return sampled, valid
+
+
+def circular_mean(phase: numpy.ndarray, valid: numpy.ndarray = None, band_rows=tiles.DEFAULT_BAND_ROWS) -> float:
+    """Mean direction of the phases (rad), accumulated over bands of rows; NaN without valid pixels."""
+    total = 0j
+    for band in tiles.row_bands(phase.shape[0], band_rows):
+        values = phase[band.core]
+        keep = numpy.isfinite(values) if valid is None else valid[band.core]
+        total += numpy.exp(1j * values[keep].astype(numpy.float64)).sum()
+    return float(numpy.angle(total)) if total != 0 else math.nan
+
+
+def phase_histogram(phase: numpy.ndarray, valid: numpy.ndarray = None, bins=HISTOGRAM_BINS,
+                    band_rows=tiles.DEFAULT_BAND_ROWS):
+    """
+    Counts and phasor sums of the wrapped phases in bins fixed on [-pi, pi), accumulated over bands
+    of rows; the phasor sums give the mean direction within each bin.
+    """
+    counts = numpy.zeros(bins, dtype=numpy.int64)
+    sums = numpy.zeros(bins, dtype=numpy.complex128)
+    for band in tiles.row_bands(phase.shape[0], band_rows):
+        values = phase[band.core]
+        keep = numpy.isfinite(values) if valid is None else valid[band.core]
+        values = values[keep].astype(numpy.float64)
+        index = numpy.clip(((values + math.pi) * (bins / (2 * math.pi))).astype(numpy.intp), 0, bins - 1)
+        counts += numpy.bincount(index, minlength=bins)
+        sums += numpy.bincount(index, weights=numpy.cos(values), minlength=bins) \
+            + 1j * numpy.bincount(index, weights=numpy.sin(values), minlength=bins)
+    return counts, sums
+
+
+def histogram_mode(phase: numpy.ndarray, valid: numpy.ndarray = None, bins=HISTOGRAM_BINS) -> float:
+    """Most frequent phase: the bin with the most counts together with its neighbours (circular), refined by their mean."""
+    counts, sums = phase_histogram(phase, valid, bins)
+    if counts.sum() == 0:
+        return math.nan
+    smoothed = counts + numpy.roll(counts, 1) + numpy.roll(counts, -1)
+    peak = int(smoothed.argmax())
+    return float(numpy.angle(sums[[(peak - 1) % bins, peak, (peak + 1) % bins]].sum()))
+
+
+def smoothest_window(phase: numpy.ndarray, height: int, width: int, valid: numpy.ndarray = None):
+    """
+    (row, col) of the top left corner of the height x width window with the smallest circular
+    variance, searched on a grid with half the window size as step. Windows with invalid pixels
+    are skipped (or count less, if all windows contain some).
+    """
+    shape = phase.shape
+    height, width = min(max(height, 1), shape[0]), min(max(width, 1), shape[1])
+    valid = numpy.isfinite(phase) if valid is None else valid
+    phasors = numpy.where(valid, numpy.exp(1j * numpy.where(valid, phase, 0)), 0)
+    table = numpy.zeros((shape[0] + 1, shape[1] + 1), dtype=numpy.complex128)
+    numpy.cumsum(numpy.cumsum(phasors, axis=0, dtype=numpy.complex128), axis=1, out=table[1:, 1:])
+    count_table = numpy.zeros((shape[0] + 1, shape[1] + 1), dtype=numpy.int64)
+    numpy.cumsum(numpy.cumsum(valid, axis=0, dtype=numpy.int64), axis=1, out=count_table[1:, 1:])
+    rows = numpy.arange(0, shape[0] - height + 1, max(height // 2, 1))[:, None]
+    cols = numpy.arange(0, shape[1] - width + 1, max(width // 2, 1))[None, :]
+
+    def window_sum(t):
+        return t[rows + height, cols + width] - t[rows, cols + width] - t[rows + height, cols] + t[rows, cols]
+
+    counts = window_sum(count_table)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        coherence = numpy.abs(window_sum(table)) / (height * width)  # invalid pixels count as incoherent
+    coherence = numpy.where(counts > 0, coherence, -1)
+    best = numpy.unravel_index(int(coherence.argmax()), coherence.shape)
+    return int(rows[best[0], 0]), int(cols[0, best[1]])
+
+
+def _tile_offsets(difference: numpy.ndarray, valid: numpy.ndarray, tile_h, tile_w, shape, step) -> numpy.ndarray:
+    """
+    Circular mean of the difference sampled with step per tile (tile_h x tile_w pixels) of the
+    frame, shape (tile rows, tile cols); 0 for tiles without valid samples.
+    """
+    tile_rows, tile_cols = -(-shape[0] // tile_h), -(-shape[1] // tile_w)
+    tile_id = ((numpy.arange(difference.shape[0]) * step // tile_h)[:, None] * tile_cols
+               + (numpy.arange(difference.shape[1]) * step // tile_w)[None, :])
+    values = numpy.where(valid, difference, 0)
+    weights = valid.ravel().astype(numpy.float64)
+    cos = numpy.bincount(tile_id.ravel(), weights=numpy.cos(values).ravel() * weights, minlength=tile_rows * tile_cols)
+    sin = numpy.bincount(tile_id.ravel(), weights=numpy.sin(values).ravel() * weights, minlength=tile_rows * tile_cols)
+    return numpy.arctan2(sin, cos).reshape(tile_rows, tile_cols)
+
+
+def _window_mean(phase, rows, cols, mirror_only, target):
+    window, valid = _samples(phase[rows, cols], 1, mirror_only)
+    point = ((cols.start + cols.stop) // 2, (rows.start + rows.stop) // 2)
+    return OffsetResult(float(wrap(circular_mean(window, valid) - target)), point)
+
+
+def _auto_reference_window(phase, height, width, mirror_only, max_samples):
+    """(row, col) of the smoothest height x width window: searched on the sampled grid, refined in a crop."""
+    step = sample_step(phase.shape, max_samples)
+    sampled, valid = _samples(phase, step, mirror_only)
+    coarse_h, coarse_w = max(-(-height // step), 2), max(-(-width // step), 2)
+    top, left = smoothest_window(sampled, coarse_h, coarse_w, valid)
+    top, left = top * step, left * step
+    if step <= min(height, width) // 2:
+        return top, left
+    # the window is smaller than two samples: search it at full resolution around the coarse window
+    rows = slice(max(top - height, 0), min(top + coarse_h * step + height, phase.shape[0]))
+    cols = slice(max(left - width, 0), min(left + coarse_w * step + width, phase.shape[1]))
+    crop, valid = _samples(phase[rows, cols], 1, mirror_only)
+    top, left = smoothest_window(crop, height, width, valid)
+    return rows.start + top, cols.start + left
+
+
+def find_offset(phase: numpy.ndarray, setting: cuda_holo.OffsetCompensation,
+                reference: numpy.ndarray = None, max_samples=MAX_SAMPLES) -> OffsetResult:
+    """Offset of a wrapped phase map (h, w) per setting; see the module docstring."""
+    method = METHOD(setting.method)
+    target = setting.phase_val_target
+    mirror_only = setting.use_mirror_only
+    height, width = max(int(setting.height), 1), max(int(setting.width), 1)
+    if method == METHOD.NoOffsetCompensation:
+        return OffsetResult(0.0)
+    if method == METHOD.OffsetFromRefPoint:
+        return _window_mean(phase, *area_slices(setting, phase.shape), mirror_only, target)
+    if method == METHOD.OffsetFromAutoRefPoint:
+        top, left = _auto_reference_window(phase, height, width, mirror_only, max_samples)
+        rows = slice(top, min(top + height, phase.shape[0]))
+        cols = slice(left, min(left + width, phase.shape[1]))
+        return _window_mean(phase, rows, cols, mirror_only, target)
+    if method == METHOD.OffsetFromHistogram:
+        sampled, valid = _samples(phase, sample_step(phase.shape, max_samples), mirror_only)
+        return OffsetResult(float(wrap(histogram_mode(sampled, valid) - target)))
+    max_step = min(height, width) // 2 if method == METHOD.OffsetFromGlobalDiffROIwise else None
+    step = sample_step(phase.shape, max_samples, max_step)
+    sampled, valid = _samples(phase, step, mirror_only, reference)
+    difference = sampled - (reference[::step, ::step] if reference is not None else target)
+    if method == METHOD.OffsetFromGlobalDiff:
+        return OffsetResult(circular_mean(difference, valid))
+    offsets = _tile_offsets(difference, valid, height, width, phase.shape, step)
+    tile_row = min(max(int(setting.y_center), 0) // height, offsets.shape[0] - 1)
+    tile_col = min(max(int(setting.x_center), 0) // width, offsets.shape[1] - 1)
+    return OffsetResult(offsets, roi_offset=float(offsets[tile_row, tile_col]))
+
+
+def apply_offset(phase: numpy.ndarray, result: OffsetResult, tile_shape=None, out: numpy.ndarray = None,
+                 band_rows=tiles.DEFAULT_BAND_ROWS) -> numpy.ndarray:
+    """
+    phase minus the offset, wrapped, in bands of rows (out=phase works in place). Per tile offsets
+    need the tile_shape (height, width) they were found with.
+    """
+    out = numpy.empty(phase.shape, dtype=numpy.float32) if out is None else out
+    offset = numpy.asarray(result.offset, dtype=numpy.float32)
+    for band in tiles.row_bands(phase.shape[0], band_rows):
+        if offset.ndim:
+            tile_h, tile_w = tile_shape
+            rows = numpy.arange(band.start, band.stop) // tile_h
+            band_offset = offset[rows][:, numpy.arange(phase.shape[1]) // tile_w]
+        else:
+            band_offset = offset
+        numpy.subtract(phase[band.core], band_offset, out=out[band.core])
+        wrap(out[band.core], out=out[band.core])
+    return out
+
+
+def compensate_offset(phase: numpy.ndarray, setting: cuda_holo.OffsetCompensation, reference: numpy.ndarray = None,
+                      in_place=False, max_samples=MAX_SAMPLES):
+    """
+    (compensated phase, OffsetResult) of a wrapped phase map (h, w); for a stack (..., h, w) each
+    map is compensated on its own and a list of OffsetResults is returned. For a single map the
+    offset in the HoloArea is stored in setting.phase_offset_roi_combined.
+    """
+    if phase.ndim > 2:
+        compensated = phase if in_place else numpy.empty(phase.shape, dtype=numpy.float32)
+        results = []
+        for index in numpy.ndindex(phase.shape[:-2]):
+            result = find_offset(phase[index], setting, None if reference is None else reference[index], max_samples)
+            apply_offset(phase[index], result, (max(int(setting.height), 1), max(int(setting.width), 1)),
+                         out=compensated[index])
+            results.append(result)
+        return compensated, results
+    result = find_offset(phase, setting, reference, max_samples)
+    setting.phase_offset_roi_combined = result.roi_offset
+    if METHOD(setting.method) == METHOD.NoOffsetCompensation:
+        return phase, result
+    return apply_offset(phase, result, (max(int(setting.height), 1), max(int(setting.width), 1)),
+                        out=phase if in_place else None), result
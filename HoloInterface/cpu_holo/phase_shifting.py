@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+CPU reference for RawToPhaseMode.CAI_temporal_ps (STEP_CAM_IMAGE -> STEP_CAM_CPX).
+
+For N images I_k = A + B cos(phi + 2 pi k / N) of one laser the complex field is
+    U = 2 / N * sum_k I_k exp(-i 2 pi k / N) = B exp(i phi),
+which holds for any N >= 3. The sum is evaluated as two real matrix products (cos / sin weights
+times the stack) for all lasers with the same step count at once, band by band to bound memory.
+The weights of each laser sum to zero, so a static background or dark image, which adds the same
+image to all its steps, cancels from U and is not subtracted here (see background).
+"""
+
+import functools
+from typing import List, Sequence, Tuple, Union
+
+import numpy
+
+from cpu_holo import measurement_json, tiles
+
+DEFAULT_MEMORY_BUDGET = 64 << 20  # bytes of float32 scratch per band
+
+
+@functools.lru_cache(maxsize=16)
+def phase_step_weights(num_steps: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Real and imaginary weights 2/N cos(2 pi k/N), -2/N sin(2 pi k/N) as float32."""
+    if num_steps < 3:
+        raise ValueError(f"temporal phase shifting needs at least 3 phase steps, got {num_steps}")
+    delta = 2 * numpy.pi * numpy.arange(num_steps) / num_steps
+    weights_re = (2.0 / num_steps * numpy.cos(delta)).astype(numpy.float32)
+    weights_im = (-2.0 / num_steps * numpy.sin(delta)).astype(numpy.float32)
+    weights_re.flags.writeable = False
+    weights_im.flags.writeable = False
+    return weights_re, weights_im
+
+
+def _laser_groups(steps: List[int]):
+    """{num_steps: (laser indices, image indices (lasers × steps))} for a laser-major stack."""
+    offsets = numpy.concatenate(([0], numpy.cumsum(steps)))
+    groups = {}
+    for laser, n in enumerate(steps):
+        groups.setdefault(n, []).append(laser)
+    return {n: (numpy.array(lasers), numpy.array([numpy.arange(offsets[l], offsets[l] + n) for l in lasers]))
+            for n, lasers in groups.items()}
+
+
+def temporal_phase_shift(stack: numpy.ndarray, num_steps: Union[int, Sequence[int]],
+                         out_dtype=numpy.complex64, out: numpy.ndarray = None,
+                         memory_budget=DEFAULT_MEMORY_BUDGET, workers=None) -> numpy.ndarray:
+    """
+    Complex fields (or wrapped phases) of all lasers of a raw camera stack.
+
+    stack: (num_images, h, w) with the phase steps of laser 0 first, then laser 1, ...
+    num_steps: phase steps per laser (KEY_NUM_PHASE_STEPS), one int for all or one per laser.
+    out_dtype: numpy.complex64 (or complex128) for the field, numpy.float32 for its phase only.
+    Returns an array of shape (num_lasers, h, w).
+    """
+    if numpy.isscalar(num_steps):
+        if stack.shape[0] % num_steps:
+            raise ValueError(f"stack of {stack.shape[0]} images does not split into steps of {num_steps}")
+        steps = [int(num_steps)] * (stack.shape[0] // num_steps)
+    else:
+        steps = [int(n) for n in num_steps]
+        if sum(steps) != stack.shape[0]:
+            raise ValueError(f"phase steps {steps} do not add up to the {stack.shape[0]} images of the stack")
+    out_dtype = numpy.dtype(out_dtype)
+    height, width = stack.shape[-2:]
+    if out is None:
+        out = numpy.empty((len(steps), height, width), dtype=out_dtype)
+    groups = _laser_groups(steps)
+    band_rows = tiles.band_rows_for_budget(max(steps) * len(steps) * width * 4, memory_budget)
+
+    def process(band: tiles.RowBand):
+        for n, (lasers, images) in groups.items():
+            weights_re, weights_im = phase_step_weights(n)
+            raw = stack[images.ravel(), band.core].astype(numpy.float32, copy=False)
+            raw = raw.reshape(len(lasers), n, -1)
+            real = numpy.matmul(weights_re, raw)  # (lasers, pixels)
+            imag = numpy.matmul(weights_im, raw)
+            for idx, laser in enumerate(lasers):
+                target = out[laser, band.core]  # a view, also for an out that is not contiguous
+                if out_dtype.kind == "c":
+                    target.real = real[idx].reshape(target.shape)
+                    target.imag = imag[idx].reshape(target.shape)
+                else:
+                    numpy.arctan2(imag[idx].reshape(target.shape), real[idx].reshape(target.shape), out=target)
+
+    tiles.map_row_bands(process, height, band_rows, workers=workers)
+    return out
+
+
+def field_from_measurement(stack: numpy.ndarray, measurement: dict, **kwargs) -> numpy.ndarray:
+    """temporal_phase_shift with the step counts of a measurement json (KEY_SINGLE_LASERS)."""
+    return temporal_phase_shift(stack, measurement_json.num_phase_steps(measurement), **kwargs)
+
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable CPU evaluation with on-disk checkpoints per ProcessingStep.
+
+A Pipeline is a list of Stages in ProcessingStep order; each stage takes the named arrays of the
+previous one and returns its own. Like HoloModes on the sensor, step_load_as says at which step the
+input data is (STEP_UNDEFINED / STEP_CAM_IMAGE: raw camera stack) and step_return_after where to
+stop. The outputs of the stages are checkpointed in a content-addressed CheckpointStore: the key of
+a stage is the hash of the key of the previous one (the input digest for the first) and of the
+settings that stage depends on, so a key stays valid exactly as long as the input and all settings
+up to that step are unchanged. A run looks for the latest stage whose checkpoint exists, loads it
+and only computes the stages after it, e.g. tuning the filters of the synthetic wavelengths on
+archived data resumes from STEP_VIS_PHASES_RAW instead of propagating again.
+
+default_stages wires the CPU engines: temporal phase shifting (STEP_CAM_CPX), propagation
+(STEP_VIS_PHASES_RAW), the fused synthetic wavelength combination (raw, filtered, fine and
+combined phases in one pass, checkpointed together at STEP_SYN_PHASES_COMBINED) and the height
+conversion (STEP_CONVERTED_TO_HEIGHT). Each of them depends on the settings that settings_fingerprint
+assigns to the steps after the previous stage up to its own.
+"""
+
+import hashlib
+import os
+from typing import Callable, Dict, List, Sequence
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import (height_conversion, measurement_json, phase_shifting, propagation, settings_fingerprint,
+                      synthetic_wavelengths)
+from cpu_holo.settings_fingerprint import settings_digest
+
+STEP = cuda_holo.ProcessingStep
+
+DATA = "data"
+HASH_CHUNK = 64 << 20
+
+# Keylist.csv name without a Keys* struct
+KEY_HEIGHT_CONVERSION_SETTINGS = "height_conversion_settings"
+
+
+def array_digest(arrays: Dict[str, numpy.ndarray]) -> str:
+    """Hash of named arrays (names, dtypes, shapes and contents), read in chunks."""
+    digest = hashlib.blake2b(digest_size=20)
+    for name in sorted(arrays):
+        array = numpy.ascontiguousarray(arrays[name])
+        digest.update(f"{name}:{array.dtype.str}:{array.shape};".encode())
+        flat = array.reshape(-1).view(numpy.uint8)
+        for start in range(0, flat.size, HASH_CHUNK):
+            digest.update(flat[start:start + HASH_CHUNK])
+    return digest.hexdigest()
+
+
+def chain_key(previous_key: str, step: cuda_holo.ProcessingStep, settings_hash: str) -> str:
+    return hashlib.blake2b(f"{previous_key}|{STEP(step).name}|{settings_hash}".encode(), digest_size=20).hexdigest()
+
+
+class Stage:
+    """
+    One evaluation step: run(inputs, measurement) -> {name: array} producing step.
+    settings(measurement): what the stage depends on (json-like), the whole measurement if None.
+    """
+
+    def __init__(self, step: cuda_holo.ProcessingStep, run: Callable[[dict, dict], dict],
+                 settings: Callable[[dict], object] = None):
+        self.step = STEP(step)
+        self.run = run
+        self.settings = settings
+
+    def __repr__(self):
+        return f"<Stage {self.step.name}>"
+
+    def settings_hash(self, measurement: dict) -> str:
+        return settings_digest(measurement if self.settings is None else self.settings(measurement))
+
+
+class CheckpointStore:
+    """Named arrays as .npz files under directory, by key (two character fan out)."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"<CheckpointStore {self.directory}>"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".npz")
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def load(self, key: str) -> Dict[str, numpy.ndarray]:
+        with numpy.load(self.path(key)) as archive:
+            return {name: archive[name] for name in archive.files}
+
+    def save(self, key: str, arrays: Dict[str, numpy.ndarray]):
+        """Written to a temporary file and renamed, so an interrupted run leaves no partial checkpoint."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+        numpy.savez(temporary, **{name: numpy.asarray(a) for name, a in arrays.items()})
+        os.replace(temporary, path)
+
+
+class PipelineResult:
+    def __init__(self, step, outputs: Dict[str, numpy.ndarray], resumed_from, computed: List):
+        self.step = step  # ProcessingStep of the outputs
+        self.outputs = outputs
+        self.resumed_from = resumed_from  # ProcessingStep of the checkpoint loaded, None if none
+        self.computed = computed  # ProcessingSteps evaluated in this run
+
+    def __repr__(self):
+        resumed = self.resumed_from.name if self.resumed_from is not None else "input"
+        return f"<PipelineResult {STEP(self.step).name} from {resumed}, computed {[s.name for s in self.computed]}>"
+
+
+class Pipeline:
+    """
+    Stages in ProcessingStep order with an optional CheckpointStore.
+    checkpoint_steps: steps whose outputs are saved (default all).
+    """
+
+    def __init__(self, stages: Sequence[Stage], store: CheckpointStore = None,
+                 checkpoint_steps: Sequence[cuda_holo.ProcessingStep] = None):
+        self.stages = sorted(stages, key=lambda stage: stage.step)
+        self.store = store
+        self.checkpoint_steps = None if checkpoint_steps is None else {STEP(s) for s in checkpoint_steps}
+
+    def __repr__(self):
+        return f"<Pipeline {' -> '.join(stage.step.name for stage in self.stages)}>"
+
+    def _selected(self, load_as, return_after) -> List[Stage]:
+        return [stage for stage in self.stages if load_as < stage.step <= return_after]
+
+    def keys(self, data: Dict[str, numpy.ndarray], measurement: dict, load_as=STEP.STEP_CAM_IMAGE,
+             return_after=STEP.STEP_CONVERTED_TO_HEIGHT) -> List[tuple]:
+        """[(stage, checkpoint key)] of the stages that run for this input and measurement."""
+        key = f"{STEP(load_as).name}:{array_digest(data)}"
+        keys = []
+        for stage in self._selected(load_as, return_after):
+            key = chain_key(key, stage.step, stage.settings_hash(measurement))
+            keys.append((stage, key))
+        return keys
+
+    def run(self, data, measurement: dict, modes: cuda_holo.HoloModes = None) -> PipelineResult:
+        """
+        Evaluate data (an array or named arrays) per HoloModes.step_load_as / step_return_after
+        (all stages without modes), resuming from the latest valid checkpoint.
+        """
+        load_as = STEP(modes.step_load_as) if modes is not None else STEP.STEP_CAM_IMAGE
+        load_as = max(load_as, STEP.STEP_CAM_IMAGE)
+        return_after = STEP(modes.step_return_after) if modes is not None else STEP.STEP_CONVERTED_TO_HEIGHT
+        outputs = dict(data) if isinstance(data, dict) else {DATA: data}
+        keys = self.keys(outputs, measurement, load_as, return_after)
+        start, resumed_from = 0, None
+        if self.store is not None:
+            for idx in range(len(keys) - 1, -1, -1):
+                if keys[idx][1] in self.store:
+                    outputs = self.store.load(keys[idx][1])
+                    start, resumed_from = idx + 1, keys[idx][0].step
+                    break
+        computed = []
+        for stage, key in keys[start:]:
+            outputs = stage.run(outputs, measurement)
+            computed.append(stage.step)
+            if self.store is not None and (self.checkpoint_steps is None or stage.step in self.checkpoint_steps):
+                self.store.save(key, outputs)
+        step = keys[-1][0].step if keys else load_as
+        return PipelineResult(step, outputs, resumed_from, computed)
+
+
+def _phase_shift(inputs: dict, measurement: dict) -> dict:
+    return {DATA: phase_shifting.field_from_measurement(inputs[DATA], measurement)}
+
+
+def _propagate(inputs: dict, measurement: dict) -> dict:
+    method, distance_m = measurement_json.propagation_settings(measurement)
+    return {DATA: propagation.propagate(inputs[DATA], measurement_json.pixel_size_cam_m(measurement),
+                                        measurement_json.laser_wavelengths_m(measurement), distance_m, method)}
+
+
+def _combine(inputs: dict, measurement: dict) -> dict:
+    combiner = synthetic_wavelengths.combiner_from_measurement(measurement)
+    result = combiner.combine(inputs[DATA])
+    return {"raw": result.raw, "filtered": result.filtered, "fine": result.fine, "combined": result.combined,
+            "error": result.error, "combined_m": numpy.float64(combiner.combined_m)}
+
+
+def _convert_to_height(inputs: dict, measurement: dict) -> dict:
+    settings = height_conversion.settings_from_jso(measurement.get(KEY_HEIGHT_CONVERSION_SETTINGS, {}))
+    height = height_conversion.convert_to_height(inputs["combined"], settings, float(inputs["combined_m"]))
+    return {DATA: height_conversion.materialize(height)}
+
+
+def _step_settings(after, step):
+    """Getter of the settings of the measurement that first affect a step in (after, step]."""
+    return lambda measurement: settings_fingerprint.settings_at_step(measurement, step, after)
+
+
+def default_stages() -> List[Stage]:
+    """The CPU engines from the raw stack to the height map, with the parts of the measurement each depends on."""
+    runs = ((STEP.STEP_CAM_CPX, _phase_shift), (STEP.STEP_VIS_PHASES_RAW, _propagate),
+            (STEP.STEP_SYN_PHASES_COMBINED, _combine), (STEP.STEP_CONVERTED_TO_HEIGHT, _convert_to_height))
+    stages, after = [], STEP.STEP_CAM_IMAGE
+    for step, run in runs:
+        stages.append(Stage(step, run, _step_settings(after, step)))
+        after = step
+    return stages
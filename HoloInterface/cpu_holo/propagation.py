@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Numerical propagation of complex fields (PropagationMethod), for all lasers of a measurement at once.
+
+propagate_convolution: angular spectrum method, the pixel size is kept.
+propagate_convolution_scaled: Fresnel convolution with a magnification m of the pixel size; the
+    field is multiplied with a chirp, convolved over z / m and multiplied with a second chirp.
+propagate_fresnel_2_step: two single FFT Fresnel transforms over z / (1 + m) and m z / (1 + m); the
+    intermediate plane has a pixel size of lambda z1 / (n dx), so this is for "large" distances.
+
+The constant phase 2 pi z / lambda is left out, so propagated phases stay comparable to the
+unpropagated ones. All multiplications (transfer functions, chirps) depend only on frame shape,
+pixel size, wavelength, distance and magnification and are kept in an ArrayCache; the fields of all
+lasers are transformed with one batched FFT per step. The Fresnel transfer function and the chirps
+are separable (r^2 = y^2 + x^2) and kept as one vector per axis; the angular spectrum kernel is
+not, it is a full complex64 frame (about 520 MB at 65 MP). The cache keeps its fixed cap
+(PROPAGATION_CACHE_BYTES, or max_bytes of the cache passed in): kernels that do not fit are built
+without the cache, and a sweep caches the kernels of as many distances as fit and builds the rest,
+so repeated sweeps hit on those instead of evicting each kernel before it is used again.
+"""
+
+from typing import Iterator, Optional, Sequence, Tuple, Union
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo.cache import ArrayCache
+
+PROPAGATION_CACHE_BYTES = 256 << 20
+PROPAGATION_CACHE = ArrayCache(PROPAGATION_CACHE_BYTES)
+
+METHOD = cuda_holo.PropagationMethod
+
+
+def _frequencies_squared(shape, pixel_m):
+    """Squared spatial frequencies (1/m^2) in FFT order."""
+    fy = numpy.fft.fftfreq(shape[0], pixel_m)[:, None]
+    fx = numpy.fft.fftfreq(shape[1], pixel_m)[None, :]
+    return fy * fy + fx * fx
+
+
+def angular_spectrum_kernel(shape, pixel_m, wavelength_m, distance_m) -> numpy.ndarray:
+    """exp(i 2 pi z (sqrt(1/lambda^2 - f^2) - 1/lambda)); evanescent frequencies are set to 0."""
+    arg = 1.0 / wavelength_m ** 2 - _frequencies_squared(shape, pixel_m)
+    propagating = arg > 0
+    phase = 2 * numpy.pi * distance_m * (numpy.sqrt(numpy.where(propagating, arg, 0.0)) - 1.0 / wavelength_m)
+    return numpy.where(propagating, numpy.exp(1j * phase), 0).astype(numpy.complex64)
+
+
+class SeparableFactor:
+    """rows[:, None] * cols[None, :] without forming the frame; applied with two broadcast multiplications."""
+
+    def __init__(self, rows: numpy.ndarray, cols: numpy.ndarray):
+        self.rows = rows
+        self.cols = cols
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.cols.nbytes
+
+    @property
+    def shape(self):
+        return self.rows.size, self.cols.size
+
+    def full(self) -> numpy.ndarray:
+        return self.rows[:, None] * self.cols[None, :]
+
+    def apply(self, field: numpy.ndarray):
+        """field (..., h, w) *= the factor, in place."""
+        field *= self.rows[:, None]
+        field *= self.cols
+
+
+def _axis_coordinates(n, pixel_m):
+    return (numpy.arange(n) - n // 2) * pixel_m
+
+
+def fresnel_kernel(shape, pixel_m, wavelength_m, distance_m) -> SeparableFactor:
+    """Fresnel transfer function exp(-i pi lambda z f^2)."""
+    factor = -numpy.pi * wavelength_m * distance_m
+    fy, fx = numpy.fft.fftfreq(shape[0], pixel_m), numpy.fft.fftfreq(shape[1], pixel_m)
+    return SeparableFactor(numpy.exp(1j * factor * fy * fy).astype(numpy.complex64),
+                           numpy.exp(1j * factor * fx * fx).astype(numpy.complex64))
+
+
+def chirp(shape, pixel_yx, wavelength_m, curvature_m, factor=1.0) -> SeparableFactor:
+    """factor * exp(i pi r^2 / (lambda R)) on a centered grid, R = curvature_m."""
+    scale = numpy.pi / (wavelength_m * curvature_m)
+    y, x = _axis_coordinates(shape[0], pixel_yx[0]), _axis_coordinates(shape[1], pixel_yx[1])
+    return SeparableFactor((factor * numpy.exp(1j * scale * y * y)).astype(numpy.complex64),
+                           numpy.exp(1j * scale * x * x).astype(numpy.complex64))
+
+
+def output_pixel_m(method: cuda_holo.PropagationMethod, pixel_m, magnification=1.0) -> float:
+    """Pixel size of the propagated field; all methods keep it except for the magnification."""
+    return pixel_m if METHOD(method) == METHOD.propagate_convolution else pixel_m * magnification
+
+
+class PropagationKernels:
+    """
+    Multiplications of one propagation for one wavelength:
+    convolution methods: pre, FFT, transfer, inverse FFT, post
+    propagate_fresnel_2_step: pre, centered FFT, mid, centered FFT, post
+    Entries that are not needed are None; identity is set for a distance of 0 without magnification,
+    where the field is kept as it is.
+    """
+
+    def __init__(self, method, shape, pixel_m, wavelength_m, distance_m, magnification=1.0):
+        self.method = METHOD(method)
+        self.pre = self.transfer = self.mid = self.post = None
+        self.identity = distance_m == 0 and magnification == 1
+        m = magnification
+        if self.method == METHOD.propagate_convolution:
+            self.transfer = angular_spectrum_kernel(shape, pixel_m, wavelength_m, distance_m)
+        elif self.method == METHOD.propagate_convolution_scaled:
+            # (m xi - x)^2 = m (xi - x)^2 + (1 - m) x^2 + m (m - 1) xi^2, with xi on the input grid
+            self.transfer = fresnel_kernel(shape, pixel_m, wavelength_m, distance_m / m)
+            if m != 1:
+                self.pre = chirp(shape, (pixel_m, pixel_m), wavelength_m, distance_m / (1 - m))
+                self.post = chirp(shape, (pixel_m, pixel_m), wavelength_m, distance_m / (m * (m - 1)), 1.0 / m)
+        elif not self.identity:
+            if distance_m == 0:
+                raise ValueError("propagate_fresnel_2_step cannot magnify over a distance of 0")
+            z1 = distance_m / (1 + m)
+            z2 = distance_m - z1
+            # pixel sizes of the intermediate plane (signed: a negative size is a mirrored grid)
+            pixel_1 = (wavelength_m * z1 / (shape[0] * pixel_m), wavelength_m * z1 / (shape[1] * pixel_m))
+            pixel_2 = (m * pixel_m, m * pixel_m)
+            self.pre = chirp(shape, (pixel_m, pixel_m), wavelength_m, z1)
+            # output chirp of step 1 times input chirp of step 2, and the constants dx dy / (i lambda z)
+            self.mid = chirp(shape, pixel_1, wavelength_m, z1 * z2 / distance_m,
+                             pixel_m * pixel_m / (1j * wavelength_m * z1))
+            self.post = chirp(shape, pixel_2, wavelength_m, z2,
+                              abs(pixel_1[0] * pixel_1[1]) / (1j * wavelength_m * z2))
+
+    @property
+    def nbytes(self):
+        return sum(k.nbytes for k in (self.pre, self.transfer, self.mid, self.post) if k is not None)
+
+
+def propagation_kernels(method, shape, pixel_m, wavelength_m, distance_m, magnification=1.0,
+                        cache: Optional[ArrayCache] = PROPAGATION_CACHE) -> PropagationKernels:
+    """Kernels of one propagation, from the cache (built without caching if cache is None)."""
+    if METHOD(method) == METHOD.propagate_convolution:
+        magnification = 1.0
+    if cache is None:
+        return PropagationKernels(method, shape, pixel_m, wavelength_m, distance_m, magnification)
+    key = (int(method), tuple(shape), float(pixel_m), float(wavelength_m), float(distance_m), float(magnification))
+    return cache.get(key, lambda: PropagationKernels(method, shape, pixel_m, wavelength_m, distance_m, magnification))
+
+
+def kernel_nbytes(method, shape) -> int:
+    """Memory of the kernels of one propagation of a frame (h, w) for one wavelength."""
+    if METHOD(method) == METHOD.propagate_convolution:
+        return shape[-2] * shape[-1] * numpy.dtype(numpy.complex64).itemsize
+    return 3 * (shape[-2] + shape[-1]) * numpy.dtype(numpy.complex64).itemsize  # pre, mid / transfer, post
+
+
+def cached_distances(cache: Optional[ArrayCache], method, shape, num_wavelengths) -> int:
+    """Number of distances whose kernels (for all wavelengths) fit into the cap of the cache."""
+    if cache is None:
+        return 0
+    return cache.max_bytes // max(kernel_nbytes(method, shape) * num_wavelengths, 1)
+
+
+def _centered_fft2(fields):
+    return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(fields, axes=(-2, -1))), axes=(-2, -1))
+
+
+def _multiply(fields, kernels, name):
+    for idx, k in enumerate(kernels):
+        factor = getattr(k, name)
+        if isinstance(factor, SeparableFactor):
+            factor.apply(fields[idx])
+        elif factor is not None:
+            fields[idx] *= factor
+
+
+def _wavelength_list(num_fields, wavelengths_m) -> list:
+    if numpy.isscalar(wavelengths_m):
+        return [float(wavelengths_m)] * num_fields
+    if len(wavelengths_m) != num_fields:
+        raise ValueError(f"{len(wavelengths_m)} wavelengths for {num_fields} fields")
+    return [float(w) for w in wavelengths_m]
+
+
+def propagate(fields: numpy.ndarray, pixel_m, wavelengths_m: Union[float, Sequence[float]], distance_m,
+              method=METHOD.propagate_convolution, magnification=1.0,
+              cache: ArrayCache = PROPAGATION_CACHE) -> numpy.ndarray:
+    """
+    Propagate one field (h, w) or the fields of all lasers (lasers, h, w) by distance_m.
+    pixel_m: KEY_PIXEL_CAM_UM in m; wavelengths_m: KEY_LASER_WL_M, one per laser or one for all.
+    magnification: ratio of output to input pixel size (see output_pixel_m), ignored by
+    propagate_convolution. Returns a new complex64 array of the input shape.
+    """
+    single = fields.ndim == 2
+    out = numpy.array(fields[None] if single else fields, dtype=numpy.complex64)
+    wavelengths = _wavelength_list(out.shape[0], wavelengths_m)
+    method = METHOD(method)
+    if distance_m == 0 and (magnification == 1 or method == METHOD.propagate_convolution):
+        return out[0] if single else out
+    if not cached_distances(cache, method, out.shape, len(wavelengths)):
+        cache = None  # larger than the cap: keep the cached entries of the other propagations
+    kernels = [propagation_kernels(method, out.shape[-2:], pixel_m, w, distance_m, magnification, cache)
+               for w in wavelengths]
+    _multiply(out, kernels, "pre")
+    if method == METHOD.propagate_fresnel_2_step:
+        out = _centered_fft2(out)
+        _multiply(out, kernels, "mid")
+        out = _centered_fft2(out)
+    else:
+        out = numpy.fft.fft2(out)
+        _multiply(out, kernels, "transfer")
+        out = numpy.fft.ifft2(out)
+    _multiply(out, kernels, "post")
+    return out[0] if single else out
+
+
+def propagate_batch(fields: numpy.ndarray, pixel_m, wavelengths_m, distances_m,
+                    method=METHOD.propagate_convolution, magnification=1.0,
+                    cache: ArrayCache = PROPAGATION_CACHE) -> numpy.ndarray:
+    """
+    Fields (lasers, h, w) propagated to all distances_m as one FFT stack; returns (distances, lasers, h, w).
+    Meant for small frames (ROIs) where one FFT per distance would be dominated by overhead.
+    """
+    method = METHOD(method)
+    wavelengths = _wavelength_list(fields.shape[0], wavelengths_m)
+    shape = fields.shape[-2:]
+    cached = cached_distances(cache, method, shape, len(wavelengths))
+    kernels = [propagation_kernels(method, shape, pixel_m, w, d, magnification, cache if idx < cached else None)
+               for idx, d in enumerate(distances_m) for w in wavelengths]
+    if method == METHOD.propagate_convolution:
+        # the input spectrum is the same for all distances
+        spectrum = numpy.fft.fft2(numpy.asarray(fields, dtype=numpy.complex64))
+        out = numpy.broadcast_to(spectrum, (len(distances_m),) + spectrum.shape).reshape((-1,) + shape).copy()
+        _multiply(out, kernels, "transfer")
+        return numpy.fft.ifft2(out).reshape((len(distances_m),) + fields.shape)
+    out = numpy.broadcast_to(fields, (len(distances_m),) + fields.shape).reshape((-1,) + shape)
+    out = out.astype(numpy.complex64)
+    _multiply(out, kernels, "pre")
+    if method == METHOD.propagate_fresnel_2_step:
+        out = _centered_fft2(out)
+        _multiply(out, kernels, "mid")
+        out = _centered_fft2(out)
+    else:
+        out = numpy.fft.fft2(out)
+        _multiply(out, kernels, "transfer")
+        out = numpy.fft.ifft2(out)
+    _multiply(out, kernels, "post")
+    out = out.reshape((len(distances_m),) + fields.shape)
+    for idx in range(len(distances_m)):
+        if kernels[idx * len(wavelengths)].identity:
+            out[idx] = fields  # the FFTs of propagate_fresnel_2_step do not cancel without the chirps
+    return out
+
+
+def propagate_distances(fields: numpy.ndarray, pixel_m, wavelengths_m, distances_m,
+                        method=METHOD.propagate_convolution, magnification=1.0,
+                        cache: ArrayCache = PROPAGATION_CACHE) -> Iterator[Tuple[float, numpy.ndarray]]:
+    """
+    (distance, propagated fields) for a sweep over distances_m, e.g. for autofocus.
+    With propagate_convolution the spectrum of the input is computed only once.
+    The kernels of the first distances are cached as far as the cap of the cache allows, the others
+    are built for every sweep.
+    """
+    if METHOD(method) != METHOD.propagate_convolution:
+        for distance in distances_m:
+            yield distance, propagate(fields, pixel_m, wavelengths_m, distance, method, magnification, cache)
+        return
+    single = fields.ndim == 2
+    spectrum = numpy.fft.fft2(numpy.asarray(fields[None] if single else fields, dtype=numpy.complex64))
+    wavelengths = _wavelength_list(spectrum.shape[0], wavelengths_m)
+    cached = cached_distances(cache, method, spectrum.shape, len(wavelengths))
+    for idx, distance in enumerate(distances_m):
+        kernels = [propagation_kernels(method, spectrum.shape[-2:], pixel_m, w, distance,
+                                       cache=cache if idx < cached else None) for w in wavelengths]
+        out = spectrum.copy()
+        _multiply(out, kernels, "transfer")
+        out = numpy.fft.ifft2(out)
+        yield distance, out[0] if single else out
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Quality gate for a raw camera stack before the evaluation (RawImageQualityThresholds, KeysRawQuality).
+
+All criteria are evaluated on a regular grid of at most MAX_SAMPLES pixels of the stack (laser
+major, see phase_shifting.py); the field U = B exp(i phi) of each laser comes from the phase step
+weights at these pixels and their right and lower neighbours only. Each criterion gives one value
+per stack (the worst laser), the reference over the pixels is the mean or median
+(QualityReferenceMethods):
+    gray values    max_k |mean(I_k) - reference| / reference in % over the frames of a laser
+    phase steps    max |step_k - 2 pi / N| / (2 pi / N); step_k from the phase of
+                   sum (I_k - A) conj(U), A the mean over the steps
+    modulation     1 - reference(B / A), the lost fringe contrast
+    smoothness     1 - reference(|mean phasor difference to the neighbours|), the phase roughness
+    snr            peak / mean of the spectrum magnitude outside the DC of a central SNR_CROP crop
+                   of the first frame (spatial phase shifting); the only criterion with a minimum
+The criteria run in parallel threads. A stack fails if any enabled criterion fails; it is repeated
+while current_num_repeats < max_num_repeats.
+"""
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Union
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.IPM_Holo_Globals as holo_globals
+from cpu_holo import tiles
+from cpu_holo.phase_shifting import phase_step_weights
+
+MAX_SAMPLES = 1 << 14
+SNR_CROP = 256
+SNR_DC_RADIUS = 4
+
+# QualityReferenceMethods
+REFERENCE_MEAN = 0
+REFERENCE_MEDIAN = 1
+
+
+def settings_from_jso(jso: dict):
+    """(RawImageQualityThresholds, {criterion: reference method}) from a measurement json (KeysRawQuality)."""
+    keys = holo_globals.KeysRawQuality()
+    thresholds = cuda_holo.RawImageQualityThresholds()
+    for key, attribute, convert in ((keys.MAX_NUM_REPEATS, "max_num_repeats", int),
+                                    (keys.CURRENT_NUM_REPEATS, "current_num_repeats", int),
+                                    (keys.FLAG_VARIATION_OF_GRAYVALS_AS_CRITERION, "flag_stddev_grayvals_as_criterion", bool),
+                                    (keys.REL_THRESHOLD_VARIATION_GRAYVALS, "threshold_stddev_grayvals", float),
+                                    (keys.FLAG_DEVIATION_PHASESTEPS_AS_CRITERION, "flag_phasesteps_as_criterion", bool),
+                                    (keys.REL_THRESHOLD_DEVIATION_PHASESTEPS, "threshold_variation_phasesteps", float),
+                                    (keys.FLAG_MODULATION_AS_CRITERION, "flag_modulation_as_criterion", bool),
+                                    (keys.THRESHOLD_VARIATION_MODULATION, "threshold_variation_modulation", float),
+                                    (keys.FLAG_SMOOTHNESS_AS_CRITERION, "flag_smoothness_as_criterion", bool),
+                                    (keys.THRESHOLD_VARIATION_SMOOTHENESS, "threshold_variation_smootheness", float),
+                                    (keys.FLAG_SNR_FFT_AS_CRITERION, "flag_snr_as_criterion", bool),
+                                    (keys.THRESHOLD_SNR_FFT, "threshold_snr", float)):
+        if jso.get(key.decode()) not in (None, ""):
+            setattr(thresholds, attribute, convert(jso[key.decode()]))
+    references = {}
+    for criterion, key, default in (("grayvals", keys.VARATION_OF_GRAYVALS_REFERENCE_METHOD, REFERENCE_MEDIAN),
+                                    ("modulation", keys.MODULATION_REFERENCE_METHOD, REFERENCE_MEAN),
+                                    ("smoothness", keys.SNOOTHNESS_REFERENCE_METHOD, REFERENCE_MEAN)):
+        references[criterion] = int(jso.get(key.decode(), default))
+    return thresholds, references
+
+
+def enabled_criteria(thresholds: cuda_holo.RawImageQualityThresholds) -> Dict[str, tuple]:
+    """{criterion: (threshold, is_minimum)} of the enabled criteria."""
+    criteria = {}
+    for name, flag, threshold in (("grayvals", "flag_stddev_grayvals_as_criterion", "threshold_stddev_grayvals"),
+                                  ("phasesteps", "flag_phasesteps_as_criterion", "threshold_variation_phasesteps"),
+                                  ("modulation", "flag_modulation_as_criterion", "threshold_variation_modulation"),
+                                  ("smoothness", "flag_smoothness_as_criterion", "threshold_variation_smootheness"),
+                                  ("snr", "flag_snr_as_criterion", "threshold_snr")):
+        if getattr(thresholds, flag):
+            criteria[name] = (getattr(thresholds, threshold), name == "snr")
+    return criteria
+
+
+def _reference(values: numpy.ndarray, method: int, axis=-1):
+    return (numpy.median if method == REFERENCE_MEDIAN else numpy.mean)(values, axis=axis)
+
+
+class StackSamples:
+    """Raw values and fields of each laser on the sample grid and at its right and lower neighbours."""
+
+    def __init__(self, stack: numpy.ndarray, steps: List[int], max_samples=MAX_SAMPLES):
+        height, width = stack.shape[-2:]
+        step = max(int(math.ceil(math.sqrt(height * width / max_samples))), 1)
+        rows = numpy.arange(0, height - 1, step)[:, None]
+        cols = numpy.arange(0, width - 1, step)[None, :]
+        raw = {(dy, dx): stack[:, rows + dy, cols + dx].reshape(stack.shape[0], -1).astype(numpy.float32)
+               for dy, dx in ((0, 0), (1, 0), (0, 1))}
+        offsets = numpy.concatenate(([0], numpy.cumsum(steps)))
+        self.raw = [raw[0, 0][offsets[l]:offsets[l + 1]] for l in range(len(steps))]
+        self.fields = {}
+        for shift, values in raw.items():
+            fields = []
+            for laser, n in enumerate(steps):
+                weights_re, weights_im = phase_step_weights(n)
+                frames = values[offsets[laser]:offsets[laser + 1]]
+                fields.append(weights_re @ frames + 1j * (weights_im @ frames))
+            self.fields[shift] = fields
+
+
+def gray_value_variation(samples: StackSamples, reference=REFERENCE_MEDIAN) -> float:
+    variation = 0.0
+    for raw in samples.raw:
+        means = raw.mean(axis=1)
+        center = _reference(means, reference)
+        variation = max(variation, float(numpy.max(numpy.abs(means - center)) / max(center, 1e-12) * 100))
+    return variation
+
+
+def phase_step_deviation(samples: StackSamples) -> float:
+    deviation = 0.0
+    for raw, field in zip(samples.raw, samples.fields[0, 0]):
+        nominal = 2 * math.pi / raw.shape[0]
+        projections = (raw - raw.mean(axis=0)) @ numpy.conj(field)
+        steps = numpy.diff(numpy.unwrap(numpy.angle(projections)))
+        deviation = max(deviation, float(numpy.max(numpy.abs(steps - nominal)) / nominal))
+    return deviation
+
+
+def modulation_loss(samples: StackSamples, reference=REFERENCE_MEAN) -> float:
+    loss = 0.0
+    for raw, field in zip(samples.raw, samples.fields[0, 0]):
+        modulation = numpy.abs(field) / numpy.maximum(raw.mean(axis=0), 1e-12)
+        loss = max(loss, float(1 - _reference(numpy.minimum(modulation, 1), reference)))
+    return loss
+
+
+def phase_roughness(samples: StackSamples, reference=REFERENCE_MEAN) -> float:
+    roughness = 0.0
+    for center, below, right in zip(samples.fields[0, 0], samples.fields[1, 0], samples.fields[0, 1]):
+        phasor = numpy.exp(1j * numpy.angle(center))
+        agreement = numpy.abs(numpy.exp(1j * numpy.angle(below)) * numpy.conj(phasor)
+                              + numpy.exp(1j * numpy.angle(right)) * numpy.conj(phasor)) / 2
+        roughness = max(roughness, float(1 - _reference(agreement, reference)))
+    return roughness
+
+
+def spectrum_snr(frame: numpy.ndarray, crop=SNR_CROP, dc_radius=SNR_DC_RADIUS) -> float:
+    """Peak / mean magnitude of the spectrum of a central crop without its DC neighbourhood."""
+    height, width = frame.shape
+    crop_h, crop_w = min(crop, height), min(crop, width)
+    top, left = (height - crop_h) // 2, (width - crop_w) // 2
+    window = frame[top:top + crop_h, left:left + crop_w].astype(numpy.float32)
+    magnitude = numpy.abs(numpy.fft.fft2(window - window.mean()))
+    fy = numpy.abs(numpy.fft.fftfreq(crop_h) * crop_h)[:, None]
+    fx = numpy.abs(numpy.fft.fftfreq(crop_w) * crop_w)[None, :]
+    outside = magnitude[(fy > dc_radius) | (fx > dc_radius)]
+    return float(outside.max() / max(outside.mean(), 1e-12)) if outside.size else 0.0
+
+
+class QualityReport:
+    def __init__(self, values: Dict[str, float], failed: List[str], repeat: bool):
+        self.values = values
+        self.failed = failed
+        self.repeat = repeat
+
+    @property
+    def accepted(self) -> bool:
+        return not self.failed
+
+    def __repr__(self):
+        verdict = "accepted" if self.accepted else ("repeat" if self.repeat else "rejected")
+        return f"<QualityReport {verdict}: {self.values}>"
+
+
+def check_raw_quality(stack: numpy.ndarray, num_steps: Union[int, Sequence[int]],
+                      thresholds: cuda_holo.RawImageQualityThresholds, references: Dict[str, int] = None,
+                      max_samples=MAX_SAMPLES, workers=None) -> QualityReport:
+    """
+    QualityReport of a raw stack (num_images, h, w) with num_steps phase steps per laser (laser
+    major). Only the enabled criteria are evaluated.
+    """
+    references = references or {}
+    criteria = enabled_criteria(thresholds)
+    if not criteria:
+        return QualityReport({}, [], False)
+    steps = [int(num_steps)] * (stack.shape[0] // int(num_steps)) if numpy.isscalar(num_steps) else list(num_steps)
+    if sum(steps) != stack.shape[0]:
+        raise ValueError(f"phase steps {steps} do not add up to the {stack.shape[0]} images of the stack")
+    samples = StackSamples(stack, steps, max_samples) if set(criteria) - {"snr"} else None
+    evaluate = {
+        "grayvals": lambda: gray_value_variation(samples, references.get("grayvals", REFERENCE_MEDIAN)),
+        "phasesteps": lambda: phase_step_deviation(samples),
+        "modulation": lambda: modulation_loss(samples, references.get("modulation", REFERENCE_MEAN)),
+        "smoothness": lambda: phase_roughness(samples, references.get("smoothness", REFERENCE_MEAN)),
+        "snr": lambda: spectrum_snr(stack[0]),
+    }
+    names = list(criteria)
+    with ThreadPoolExecutor(min(len(names), workers or tiles.default_workers())) as pool:
+        values = dict(zip(names, pool.map(lambda name: evaluate[name](), names)))
+    failed = [name for name, (threshold, is_minimum) in criteria.items()
+              if (values[name] < threshold if is_minimum else values[name] > threshold)]
+    return QualityReport(values, failed, bool(failed) and thresholds.current_num_repeats < thresholds.max_num_repeats)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Which ProcessingStep each setting of a measurement json (Keylist.csv) and each ctypes settings
+struct first affects, and stable fingerprints of the settings per step.
+
+KEY_STEPS maps every Keylist.csv name to the earliest step whose result changes with it:
+STEP_CAM_IMAGE for the acquisition (camera, lasers, wavemeter, quality gate; the raw stack itself
+changes), the evaluation steps from STEP_CAM_CPX on, or None for what does not change any result
+(display, file names, buffers, indicators written back). Collections carry the earliest step of
+their members; a member never counts before its collection (several names, e.g. the reference
+point ROI, appear in collections of different steps), indices of lasers and synthetic wavelengths
+take the step of their collection. Names missing from Keylist.csv are taken as UNKNOWN_STEP, the
+first step of the evaluation, so an unknown setting can only cause a recomputation, never a stale
+result.
+
+fingerprint(measurement, step) hashes the settings up to step; two measurements with equal
+fingerprints give the same result at step for the same raw data, and invalidated_steps lists the
+steps whose results a change of settings invalidates. The stages of pipeline.default_stages depend
+on the settings after the previous stage up to their own step (settings_at_step).
+"""
+
+import csv
+import hashlib
+import json
+import os
+from typing import Dict, List, Sequence
+
+import globals.cuda_holo_definitions as cuda_holo
+
+STEP = cuda_holo.ProcessingStep
+
+KEYLIST = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Keylist.csv")
+
+UNKNOWN_STEP = STEP.STEP_CAM_CPX
+
+_KEYS_BY_STEP = {
+    STEP.STEP_CAM_IMAGE: (
+        "single lasers", "camera settings", "object_data", "cam type", "trigger_type", "cam_w", "cam_h",
+        "cam_offset_x", "cam_offset_y", "cam_rotation_angle", "cam_mirror_lr", "cam_mirror_ud",
+        "calibrate_from_wavemeter", "exposure_ms", "auto_expsoure", "target_brightness", "max_allowed_exposure_ms",
+        "min_allowed_exposure_ms", "camera_gain", "auto_external_voltage", "eom_amplitude", "eom_offset",
+        "piezo_amplitude", "piezo_voltage_scale_positive", "piezo_delay", "fiber_delay_ms", "use_multichannel_switch",
+        "flag_dual_port_switch", "wavelength_tolerance_nm", "exposure_wavemeter_laser_at_port_",
+        "default_exposure_wavemeter", "max_exposure_wavemeter", "wavemeter_settings", "init settings", "port",
+        "wavemeter_port", "Ext. Voltage", "rel exposure", "trigger_bitmask", "SPS_raw_image_index",
+        "connected_to_attenuator", "use_this_laser", "update_lambda", "update_voltage", "update_rel_exposure",
+        "search_by_index", "search_by_lambda", "search_by_port", "search_by_raw_img_idx", "rotary motor degree",
+        "laser holoport", "set_dark_image", "dark_without_object", "raw_quality_thresholds", "max_num_repeats",
+        "flag_sigma_grayvals_as_criterion", "rel_threshold_variation_grayvals", "variation_reference_method",
+        "flag_deviation_phase_steps_as_criterion", "rel_threshold_deviation_phasesteps",
+        "flag_modulation_as_criterion", "threshold_variation_modulation", "modulation_reference_method",
+        "flag_smoothness_as_criterion", "threshold_variation_smootheness", "smoothness_reference_method",
+        "flag_snr_fft_steps_as_criterion", "threshold_snr_fft", "lambdas_m", "hardware_data_obj", "load_instead_of",
+        "load_filename", "hardware settings", "sim_tiff_path", "is_espi_measurement"),
+    STEP.STEP_CAM_CPX: (
+        "holography_settings", "auto_downsampling_SPS", "mask_circular_SPS", "num phase steps", "SPS_angles", "y",
+        "x", "height_y", "width_x", "minimum modulation", "mask overexposed", "phase_shifts_multi_roi",
+        "apply_dark_image", "darkimage_low_pass_ratio_for_mirror_x", "darkimage_low_pass_ratio_for_mirror_y"),
+    STEP.STEP_VIS_PHASES_RAW: (
+        "pixel_size_cam_um", "pixel_size_conjugated_plane", "focal_length_mm", "f_number", "lda_m",
+        "cad_model_wavelength", "cad_load_model", "cad_model_buffer", "set_section_autotilt_x",
+        "set_section_autotilt_y", "section_start_x", "section_start_y", "section_length", "propagation_mm",
+        "propagation_method", "normalize_brightness", "filter_before_propagation", "tilt_x", "tilt_y",
+        "tilt_second_order", "tilt_second_order_xy", "activate_higher_order_polynomial",
+        "refractive_power_virtual_lens", "virt_lens_method", "auto_tilt_correction", "auto_tilt_on_circle",
+        "tilt_circle_mirroronly", "tilt_circle_use_low_pass", "dispersion_settings", "do_dispersion_correction_z",
+        "do_dispersion_correction_xy", "thickness_BS_mm", "type_of_glass_BS", "tilt_detection_settings",
+        "auto_tilt_method", "tilt_mirror_only", "tilt_lowpass_before", "ring_mask_settings", "ring_mask_set_active",
+        "ring_mask_center_x", "ring_mask_center_y", "ring_radius", "ring_width", "ring_val_to_multiply",
+        "ring_center_follows_ref", "autofocus_settings", "distance_estimate_mm_af", "search_range_mm_af",
+        "idx_laser_af", "number_of_steps_af", "filter_radius_af", "propagation_method_af",
+        "additional_fine_search_af", "continuous autofocus", "center_af_ROI_from_ref_point", "w_of_ROI_for_af",
+        "h_of_ROI_for_af", "center_x_for_af", "center_y_for_af", "mirrorlike_seurface_af", "use_phase_image",
+        "extended_depth_settings", "extended_depth_active", "extended_depth_multiplane_propagation",
+        "extended_depth_interpolate_multiplane", "extended_depth_depthrange",
+        "extended_depth_num_propagation_distances", "extended_depth_method", "extended_depth_auto_tilt_estimation",
+        "extended_depth_tilt_x_deg", "extended_depth_tilt_y_deg", "extended_depth_prop_planes_selection_method",
+        "num_planes_SFF", "filter_radius_SFF", "threshold_SFF", "smooth_SFF_with_synth", "radius_open_sff_mask",
+        "radius_close_sff_mask", "extended_depth_center_ROI_to_refpoint", "extended_depth_center_x",
+        "extended_depth_center_y", "extended_depth_cad_load_model", "geometrical corrections",
+        "apply_aperture_correction", "apply_sensitivity", "radius_mirror_filter", "threshold_mirror_filter",
+        "gradual_aperture_correction", "noise_reduction_settings", "key_noise_detection_method",
+        "key_noise_detection_filter_radius", "key_noise_detection_cutoff", "key_noise_detection_order",
+        "threshold_led_mask", "apply_led_mask", "led_mask_image_index", "px_size_m"),
+    STEP.STEP_SYN_PHASES_RAW: (
+        "synthetic wavelengths", "synth_lambda_max_mm", "synth_lambda_min_mm", "threshold_amplitude",
+        "threshold_amplitude_synth", "tilt_each_synth_individ"),
+    STEP.STEP_SYN_PHASES_FILTERED: (
+        "filter radius", "key_filter_scale_rough_signal", "filter type", "filter_average_round_kernel",
+        "use_tilt_compensated_filter"),
+    STEP.STEP_APPLIED_FINE_SIGNALS: (
+        "threshold finer signal error", "detect_in_focus_settings", "use_for_global_reference",
+        "use_for_offset_combination", "radius_smooth", "binning_factor", "threshold_object_mask",
+        "reference_combination_settings", "reference_point_offset_combination_method",
+        "x_center_roi_reference_point", "y_center_roi_reference_point", "w_reference_point_roi",
+        "h_reference_point_roi", "phase_value_reference_point", "mirror_only_for_reference"),
+    STEP.STEP_SYN_PHASES_COMBINED: (
+        "combined_m", "median filter radius", "remove outliers", "reference_offset_result_settings",
+        "reference_point_offset_result_method", "list of mask polygons", "polygon_points", "mask_value", "polygon_nr",
+        "post_procssessing_data_obj"),
+    STEP.STEP_CONVERTED_TO_HEIGHT: (
+        "korrekturfaktor Pixelgroesse", "height_conversion_settings", "convert_to_height_unit", "revert_untilt",
+        "do_transpose", "rotation_type"),
+    None: (
+        "serial_number_camera", "cam_timeout_s", "file_name_mask_raw_image", "file_name_mask_result_image",
+        "output mode", "save_interference_pattern", "result_image_selections", "_auto_adjusted", "num_fine_signals",
+        "number of phase images", "number of amplitude images", "synth_lambda_display_mm",
+        "max_fps_reported_by_camer", "pixel_size_propagiert_mm", "width_result_image", "height_result_image",
+        "loaded_from_disk", "rescale_factor", "file_name_calibration_image", "file_name_result_image",
+        "file_name_raw_image", "abspath_save_raw", "save_folder", "sequence_subolder", "save_all_raw",
+        "prefix_for_save", "tag_document_name", "num_holded_requests", "num_frame_buffers", "num_result_buffers",
+        "rotate image", "maximumvalue_in_data", "minimumvalue_in_data", "current_num_repeats",
+        "autofocus_result_dist_mm", "extended_depth_display_diff_with_cad", "image display number", "display phase",
+        "display_mode", "pause_mode", "modulation", "mean_brightness", "median_brightness", "cai_phase_steps",
+        "count_over_exposed", "smoothness_ref_single_lasers", "variation sigmas of grayvals",
+        "modulation in valid range", "smoothness in valid range", "phase steps in valid range",
+        "sigmas of grayvals in valid range", "SNR (SPS) in valid range", "snr fft", "signal-quality-indicators",
+        "combined (amp)", "combined (phase)"),
+}
+
+KEY_STEPS = {key: step for step, keys in _KEYS_BY_STEP.items() for key in keys}
+
+STRUCT_STEPS = {
+    cuda_holo.RawImageQualityThresholds: STEP.STEP_CAM_IMAGE,
+    cuda_holo.HoloModes: STEP.STEP_CAM_CPX,
+    cuda_holo.BackgroundImageSettings: STEP.STEP_CAM_CPX,
+    cuda_holo.Thresholds: STEP.STEP_CAM_CPX,
+    cuda_holo.Filters: STEP.STEP_VIS_PHASES_RAW,  # flag_filter_before_propagate, LED mask
+    cuda_holo.FlatnessCorrection: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.DispersionSettings: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.AutoFocusSetting: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.ExtendedDepthSetting: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.GeometricalCorrectionSettings: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.NoiseDetectionSettings: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.TiltSettings: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.CircleTilt: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.LineTilt: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.GeometricMask: STEP.STEP_VIS_PHASES_RAW,
+    cuda_holo.DetectInFocusSettings: STEP.STEP_APPLIED_FINE_SIGNALS,
+    cuda_holo.OffsetCompensation: STEP.STEP_APPLIED_FINE_SIGNALS,
+    cuda_holo.HeightValueConversionSettings: STEP.STEP_CONVERTED_TO_HEIGHT,
+    cuda_holo.HoloDisplaySetting: None,
+}
+
+# fields that select what is evaluated or count attempts, not how
+IGNORED_FIELDS = {
+    cuda_holo.HoloModes: ("step_load_as", "step_return_after"),
+    cuda_holo.RawImageQualityThresholds: ("current_num_repeats",),
+}
+
+
+def keylist_keys(path: str = KEYLIST) -> List[str]:
+    """Json names of Keylist.csv in file order, without duplicates."""
+    with open(path, mode="r", encoding="utf-8", newline="") as file:
+        reader = csv.reader(file, delimiter=";")
+        next(reader)
+        keys = [row[0] for row in reader if row and row[0]]
+    return list(dict.fromkeys(keys))
+
+
+def unmapped_keys(keys: Sequence[str] = None) -> List[str]:
+    """Keylist.csv names (or keys) missing from KEY_STEPS."""
+    return [key for key in (keylist_keys() if keys is None else keys) if key not in KEY_STEPS]
+
+
+def key_step(key: str, parent=None):
+    """Earliest step affected by key inside a collection of step parent (None at the top level)."""
+    if key.isdigit():
+        return parent
+    step = KEY_STEPS[key] if key in KEY_STEPS else UNKNOWN_STEP
+    if step is None or parent is None:
+        return step
+    return max(step, parent)
+
+
+def leaf_steps(measurement: dict, parent=None):
+    """(path, step, value) of all leaves of a measurement json whose step is not None."""
+    for key, value in measurement.items():
+        step = key_step(str(key), parent)
+        if step is None:
+            continue
+        if isinstance(value, dict):
+            for path, leaf_step, leaf in leaf_steps(value, step):
+                yield (key,) + path, leaf_step, leaf
+        else:
+            yield (key,), step, value
+
+
+def settings_at_step(measurement: dict, step, after=STEP.STEP_UNDEFINED) -> dict:
+    """The settings of a measurement json (nested like it) that first affect a step in (after, step]."""
+    selected = {}
+    for path, leaf_step, value in leaf_steps(measurement):
+        if after < leaf_step <= step:
+            entry = selected
+            for key in path[:-1]:
+                entry = entry.setdefault(key, {})
+            entry[path[-1]] = value
+    return selected
+
+
+def struct_step(settings):
+    """Earliest step affected by a ctypes settings struct (UNKNOWN_STEP for structs not in STRUCT_STEPS)."""
+    return STRUCT_STEPS.get(type(settings), UNKNOWN_STEP)
+
+
+def settings_digest(settings) -> str:
+    """Hash of json-like settings (dict keys sorted, everything else by str)."""
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+
+def struct_settings(settings) -> dict:
+    """Fields of a ctypes settings struct as json-like values (nested structs and arrays included)."""
+    ignored = IGNORED_FIELDS.get(type(settings), ())
+    return {name: _plain(getattr(settings, name)) for name, *_ in settings._fields_ if name not in ignored}
+
+
+def _plain(value):
+    if hasattr(value, "_fields_"):
+        return struct_settings(value)
+    if hasattr(value, "_length_"):
+        return [_plain(item) for item in value]
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    return value
+
+
+def fingerprint(measurement: dict, step, structs: Sequence = ()) -> str:
+    """
+    Hash of the settings of a measurement json and of ctypes settings structs up to step; the structs
+    are ordered by type name and digest, so their order does not matter.
+    """
+    selected = [(type(s).__name__, settings_digest(struct_settings(s))) for s in structs
+                if struct_step(s) is not None and struct_step(s) <= step]
+    return settings_digest([settings_at_step(measurement, step), sorted(selected)])
+
+
+def step_fingerprints(measurement: dict, structs: Sequence = (), steps: Sequence = None) -> Dict:
+    """{step: fingerprint} for steps (all ProcessingSteps after STEP_UNDEFINED by default)."""
+    steps = [s for s in STEP if s > STEP.STEP_UNDEFINED] if steps is None else [STEP(s) for s in steps]
+    return {step: fingerprint(measurement, step, structs) for step in steps}
+
+
+def invalidated_steps(old: dict, new: dict, old_structs: Sequence = (), new_structs: Sequence = ()) -> List:
+    """Steps whose results differ between the settings old and new (in ProcessingStep order)."""
+    before = step_fingerprints(old, old_structs)
+    after = step_fingerprints(new, new_structs)
+    return [step for step in before if before[step] != after[step]]
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming shape from focus (ExtendedDepthMethod.shape_from_focus).
+
+The field is propagated to num_planes_sff planes over searchrange_mm around prop_distance_at_roi_mm,
+one plane at a time (the input spectrum and the transfer functions are reused). For every plane a
+per pixel sharpness (local amplitude contrast) is computed in parallel bands of rows and merged into
+running accumulators, so memory does not grow with the number of planes:
+    best       largest sharpness so far, and the sharpness of the planes before / after it
+    best_plane index of that plane
+    total      sum of the sharpness over all planes
+The depth is the best plane refined by a parabola through its neighbours; with only 2 planes (as
+shipped in Keylist.csv) no plane has neighbours on both sides and the depth is the sharper plane.
+The quality of a pixel is the prominence of its peak, 1 - mean / max of the sharpness (at most
+1 - 1 / planes); pixels below threshold_sff_quality are masked (NaN). The depth map is median
+filtered (filterradius_median_sff) and the mask is opened and closed with
+filter_radius_open_sffmask / filter_radius_close_sffmask.
+"""
+
+from typing import Sequence
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import filters, propagation, tiles
+from cpu_holo.cache import ArrayCache
+
+DEFAULT_FOCUS_RADIUS = 3
+
+
+def plane_distances_mm(setting: cuda_holo.ExtendedDepthSetting) -> numpy.ndarray:
+    half_range = setting.searchrange_mm / 2
+    return numpy.linspace(setting.prop_distance_at_roi_mm - half_range, setting.prop_distance_at_roi_mm + half_range,
+                          setting.num_planes_sff)
+
+
+class FocusAccumulator:
+    """Running per pixel maximum of the sharpness over planes, with its neighbours for sub-plane refinement."""
+
+    def __init__(self, shape):
+        self.planes = 0
+        self.best = numpy.full(shape, -numpy.inf, dtype=numpy.float32)
+        self.before_best = numpy.zeros(shape, dtype=numpy.float32)
+        self.after_best = numpy.zeros(shape, dtype=numpy.float32)
+        self.best_plane = numpy.zeros(shape, dtype=numpy.int16)
+        self.total = numpy.zeros(shape, dtype=numpy.float32)
+        self._previous = numpy.zeros(shape, dtype=numpy.float32)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.best, self.before_best, self.after_best, self.best_plane, self.total,
+                                      self._previous))
+
+    def update_rows(self, rows: slice, sharpness: numpy.ndarray, plane: int):
+        """Merge the sharpness of plane for the given rows (bands of one plane may be merged in parallel)."""
+        best, previous = self.best[rows], self._previous[rows]
+        # the plane after the current best is the one just before this one
+        following = self.best_plane[rows] == plane - 1
+        self.after_best[rows][following] = sharpness[following]
+        better = sharpness > best
+        best[better] = sharpness[better]
+        self.before_best[rows][better] = previous[better]
+        self.best_plane[rows][better] = plane
+        self.after_best[rows][better] = 0
+        self.total[rows] += sharpness
+        previous[...] = sharpness
+
+    def depth_and_quality(self, distances: Sequence[float]):
+        """Refined depth (in the unit of distances) and peak quality per pixel."""
+        distances = numpy.asarray(distances, dtype=numpy.float64)
+        step = distances[1] - distances[0] if distances.size > 1 else 0.0
+        plane = self.best_plane.astype(numpy.intp)
+        inner = (plane > 0) & (plane < self.planes - 1)
+        denominator = self.before_best - 2 * self.best + self.after_best
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            offset = numpy.where(inner & (denominator < 0),
+                                 0.5 * (self.before_best - self.after_best) / denominator, 0.0)
+            quality = 1 - self.total / (self.planes * self.best)
+        depth = (distances[plane] + numpy.clip(offset, -0.5, 0.5) * step).astype(numpy.float32)
+        return depth, quality.astype(numpy.float32)
+
+
+def local_sharpness(amplitude: numpy.ndarray, radius=DEFAULT_FOCUS_RADIUS) -> numpy.ndarray:
+    """Squared local contrast var / mean^2 of the amplitude in a (2 radius + 1)^2 window."""
+    mean = filters.box_mean(amplitude, radius)
+    mean_square = filters.box_mean(numpy.square(amplitude), radius)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return ((mean_square - numpy.square(mean)) / numpy.square(mean)).astype(numpy.float32)
+
+
+class ShapeFromFocusResult:
+    def __init__(self, depth_mm, quality, mask, distances_mm):
+        self.depth_mm = depth_mm  # NaN outside the mask
+        self.quality = quality
+        self.mask = mask
+        self.distances_mm = distances_mm
+
+    def __repr__(self):
+        return (f"<ShapeFromFocusResult {self.depth_mm.shape}, {len(self.distances_mm)} planes, "
+                f"{self.mask.mean():.0%} valid>")
+
+
+def shape_from_focus(fields: numpy.ndarray, pixel_m, wavelengths_m, setting: cuda_holo.ExtendedDepthSetting,
+                     focus_radius=DEFAULT_FOCUS_RADIUS, band_rows=tiles.DEFAULT_BAND_ROWS, workers=None,
+                     cache: ArrayCache = propagation.PROPAGATION_CACHE) -> ShapeFromFocusResult:
+    """
+    Depth map (mm, propagation distance of the sharpest plane) from complex fields (h, w) or (lasers, h, w)
+    at STEP_CAM_CPX. With several lasers the sharpness is taken from the mean amplitude, which
+    reduces speckle.
+    """
+    if setting.num_planes_sff < 2:
+        raise ValueError(f"shape from focus needs at least 2 planes, got {setting.num_planes_sff}")
+    fields = fields[None] if fields.ndim == 2 else fields
+    distances = plane_distances_mm(setting)
+    accumulator = FocusAccumulator(fields.shape[-2:])
+    for plane, (_distance, propagated) in enumerate(propagation.propagate_distances(
+            fields, pixel_m, wavelengths_m, distances * 1e-3, cache=cache)):
+
+        def process(band: tiles.RowBand):
+            amplitude = numpy.abs(propagated[:, band.padded]).mean(axis=0)
+            sharpness = local_sharpness(amplitude, focus_radius)[band.core_in_padded]
+            accumulator.update_rows(band.core, sharpness, plane)
+
+        tiles.map_row_bands(process, fields.shape[-2], band_rows, halo=focus_radius, workers=workers)
+        accumulator.planes = plane + 1
+
+    depth, quality = accumulator.depth_and_quality(distances)
+    mask = quality >= setting.threshold_sff_quality
+    mask = filters.binary_open(mask, setting.filter_radius_open_sffmask)
+    mask = filters.binary_close(mask, setting.filter_radius_close_sffmask)
+    depth[~mask] = numpy.nan
+    depth = filters.median_filter(depth, setting.filterradius_median_sff, workers=workers)
+    depth[~mask] = numpy.nan
+    return ShapeFromFocusResult(depth, quality, mask, distances)
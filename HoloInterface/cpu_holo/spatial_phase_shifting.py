@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+CPU reference for RawToPhaseMode.FFT_spatial_ps (single shot hologram -> STEP_CAM_CPX).
+
+The hologram is Fourier transformed, the first order is cut out with the KeysSPSAngles window and
+transformed back with its carrier removed. With HoloModes.auto_downsampling_SPS only the window is
+transformed back, i.e. the field is downsampled by cropping in the frequency domain; otherwise the
+window is zero padded to the full frame. Index grids and aperture masks depend only on the frame
+shape and the window and are kept in an ArrayCache.
+
+Real holograms have a Hermitian spectrum, so only the half with non-negative x frequencies is
+computed (rfft2); a first order with x < 0 is taken as the conjugate of its mirror image.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.IPM_Holo_Globals as holo_globals
+from cpu_holo import measurement_json, tiles
+from cpu_holo.cache import ArrayCache
+
+SPS_CACHE = ArrayCache(64 << 20)
+
+
+class SPSWindow:
+    """
+    Position (x, y) and extension (width_x, height_y) of the first order, in cycles per pixel
+    (fractions of the sampling frequency, -0.5 ... 0.5), so a window is valid for any frame size.
+    """
+
+    def __init__(self, x, y, width_x, height_y):
+        self.x = float(x)
+        self.y = float(y)
+        self.width_x = float(width_x)
+        self.height_y = float(height_y)
+
+    def __repr__(self):
+        return f"<SPSWindow x={self.x:g}, y={self.y:g}, {self.width_x:g} x {self.height_y:g}>"
+
+    def key(self):
+        return self.x, self.y, self.width_x, self.height_y
+
+    def __eq__(self, other):
+        return isinstance(other, SPSWindow) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    @classmethod
+    def from_jso(cls, jso: dict):
+        keys = holo_globals.KeysSPSAngles()
+        return cls(*(jso[measurement_json._str(k)] for k in (keys.x, keys.y, keys.width_x, keys.height_y)))
+
+
+def windows_from_measurement(measurement: dict) -> List[Optional[SPSWindow]]:
+    """KeysSingleLaser.SPS_angles per laser (None for lasers without)."""
+    key = measurement_json._str(holo_globals.KeysSingleLaser().SPS_angles)
+    return [SPSWindow.from_jso(laser[key]) if key in laser else None
+            for laser in measurement_json.single_lasers(measurement)]
+
+
+class SidebandGeometry:
+    """Where the window lies in the rfft2 spectrum of a frame and where it goes in the output spectrum."""
+
+    def __init__(self, shape, window: SPSWindow, round_aperture=False, downsample=False):
+        height, width = shape
+        self.conjugate = window.x < 0  # use the mirrored order in the computed half spectrum
+        x, y = (-window.x, -window.y) if self.conjugate else (window.x, window.y)
+        half_h = max(int(round(window.height_y * height / 2)), 1)
+        half_w = max(int(round(window.width_x * width / 2)), 1)
+        center_r, center_c = int(round(y * height)), int(round(x * width))
+        offsets_r = numpy.arange(-half_h, half_h + 1)
+        offsets_c = numpy.arange(-half_w, half_w + 1)
+        cols = center_c + offsets_c
+        inside = (cols >= 0) & (cols <= width // 2)  # parts reaching past x = 0 are cut off
+        if not inside.any():
+            raise ValueError(f"{window} lies outside the spectrum of a {width}x{height} frame")
+        offsets_c, cols = offsets_c[inside], cols[inside]
+        self.rows = ((center_r + offsets_r) % height)[:, None]
+        self.cols = cols[None, :]
+        if round_aperture:
+            ellipse = (offsets_r[:, None] / (half_h + 0.5)) ** 2 + (offsets_c[None, :] / (half_w + 0.5)) ** 2
+            self.mask = (ellipse <= 1).astype(numpy.float32)
+        else:
+            self.mask = None
+        self.out_shape = (offsets_r.size, 2 * half_w + 1) if downsample else (height, width)
+        self.dest_rows = (offsets_r % self.out_shape[0])[:, None]
+        self.dest_cols = (offsets_c % self.out_shape[1])[None, :]
+        # first order of A + B cos(phi + 2 pi f x) is B / 2 exp(i phi) * h * w; ifft2 divides by the output size
+        self.scale = 2.0 * self.out_shape[0] * self.out_shape[1] / (height * width)
+
+    @property
+    def nbytes(self):
+        arrays = (self.rows, self.cols, self.dest_rows, self.dest_cols, self.mask)
+        return sum(a.nbytes for a in arrays if a is not None)
+
+
+def sideband_geometry(shape, window: SPSWindow, round_aperture=False, downsample=False,
+                      cache: ArrayCache = SPS_CACHE) -> SidebandGeometry:
+    key = (tuple(shape), window.key(), bool(round_aperture), bool(downsample))
+    return cache.get(key, lambda: SidebandGeometry(shape, window, round_aperture, downsample))
+
+
+def _single_field(hologram: numpy.ndarray, geometry: SidebandGeometry, out: numpy.ndarray, reference=None):
+    if reference is not None:
+        hologram = numpy.subtract(hologram, reference, dtype=numpy.float32)
+    spectrum = numpy.fft.rfft2(hologram)
+    crop = spectrum[geometry.rows, geometry.cols]
+    if geometry.mask is not None:
+        crop *= geometry.mask
+    padded = numpy.zeros(geometry.out_shape, dtype=spectrum.dtype)
+    padded[geometry.dest_rows, geometry.dest_cols] = crop
+    field = numpy.fft.ifft2(padded)
+    field *= geometry.scale
+    if geometry.conjugate:
+        numpy.conjugate(field, out=field)
+    out[...] = field
+
+
+def spatial_phase_shift(holograms: numpy.ndarray, window: SPSWindow, modes: cuda_holo.HoloModes = None,
+                        dtype=numpy.complex64, cache: ArrayCache = SPS_CACHE, reference: numpy.ndarray = None,
+                        workers=None) -> numpy.ndarray:
+    """
+    Complex field of the first order of one hologram (h, w) or of a stack (..., h, w).
+    modes: auto_downsampling_SPS and round_aperture are taken from it (both off if None).
+    reference: background or dark image (h, w) subtracted from every hologram before its transform
+    (background.ReferenceImages.applied_reference).
+    The output has the shape of the window with downsampling, else the shape of the hologram.
+    """
+    downsample = bool(modes.auto_downsampling_SPS) if modes is not None else False
+    round_aperture = bool(modes.round_aperture) if modes is not None else False
+    stack_shape, shape = tiles.split_shape(holograms.shape)
+    geometry = sideband_geometry(shape, window, round_aperture, downsample, cache)
+    out = numpy.empty(stack_shape + geometry.out_shape, dtype=dtype)
+    flat_in = holograms.reshape((-1,) + shape)
+    flat_out = out.reshape((-1,) + geometry.out_shape)
+    workers = min(workers or tiles.default_workers(), flat_in.shape[0])
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(lambda idx: _single_field(flat_in[idx], geometry, flat_out[idx], reference),
+                          range(flat_in.shape[0])))
+    else:
+        for idx in range(flat_in.shape[0]):
+            _single_field(flat_in[idx], geometry, flat_out[idx], reference)
+    return out
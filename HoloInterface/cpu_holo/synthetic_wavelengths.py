@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Hierarchical combination of synthetic wavelengths (STEP_VIS_PHASES_RAW -> STEP_SYN_PHASES_COMBINED).
+
+For every pair of lasers (i, j) the synthetic field U_i conj(U_j) has the phase of the synthetic
+wavelength L = l_i l_j / |l_i - l_j| (STEP_SYN_PHASES_RAW). The synthetic fields are filtered as
+complex values per Filters (see filters.apply_filter; the coarsest one with the radius scaled by
+filter_scale_rough_signal), STEP_SYN_PHASES_FILTERED. Starting from the coarsest, each finer synthetic phase is unwrapped with
+the height of the coarser ones: the fringe order is the rounded difference to the predicted phase
+and the remaining difference is the combination error. Pixels whose error exceeds
+Thresholds.threshold_combination_error are masked (NaN). The unwrapped phase of the finest synthetic
+wavelength is STEP_APPLIED_FINE_SIGNALS, expressed in the combined wavelength (KEY_LDA_COMBINED_,
+"combined_m") it is STEP_SYN_PHASES_COMBINED.
+
+All synthetic wavelengths are evaluated at once per band of rows; bands are processed in parallel
+with a halo of the filter radius. Output buffers are kept by the SyntheticCombiner and reused by
+the next call with the same frame shape.
+"""
+
+import math
+import threading
+from typing import List, Sequence, Tuple
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import filters, measurement_json, tiles
+
+# Keylist.csv names (holography_settings) without a Keys* struct
+KEY_FILTER_RADIU = "filter radius"
+KEY_FILTER_SCALE_ROUGH_SIGNA = "key_filter_scale_rough_signal"
+KEY_FILTER_TYP = "filter type"
+KEY_FILTER_AVERAGE_ROUND_KERNE = "filter_average_round_kernel"
+KEY_THRESHOLD_FINERSIGNAL_ERRO = "threshold finer signal error"
+
+
+def synthetic_wavelength(wavelength_1, wavelength_2) -> float:
+    return wavelength_1 * wavelength_2 / abs(wavelength_1 - wavelength_2)
+
+
+def default_pairs(laser_wavelengths_m: Sequence[float]) -> List[Tuple[int, int]]:
+    """Laser 0 with every other laser."""
+    return [(0, idx) for idx in range(1, len(laser_wavelengths_m))]
+
+
+class CombinationResult:
+    """Views of the combiner's buffers; copy them before the next call to SyntheticCombiner.combine."""
+
+    def __init__(self, synthetic_m, raw, filtered, fine, combined, error):
+        self.synthetic_m = synthetic_m  # coarse to fine
+        self.raw = raw  # STEP_SYN_PHASES_RAW, (synthetic, h, w)
+        self.filtered = filtered  # STEP_SYN_PHASES_FILTERED
+        self.fine = fine  # STEP_APPLIED_FINE_SIGNALS, unwrapped phase of the finest synthetic wavelength
+        self.combined = combined  # STEP_SYN_PHASES_COMBINED, phase of the combined wavelength
+        self.error = error  # largest combination error (rad) per pixel
+
+    def __repr__(self):
+        return f"<CombinationResult {len(self.synthetic_m)} synthetic wavelengths, {self.combined.shape}>"
+
+    def buffer_for_step(self, step: cuda_holo.ProcessingStep) -> numpy.ndarray:
+        return {cuda_holo.ProcessingStep.STEP_SYN_PHASES_RAW: self.raw,
+                cuda_holo.ProcessingStep.STEP_SYN_PHASES_FILTERED: self.filtered,
+                cuda_holo.ProcessingStep.STEP_APPLIED_FINE_SIGNALS: self.fine,
+                cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED: self.combined}[step]
+
+
+class SyntheticCombiner:
+    """
+    Combines the fields (lasers, h, w) of one measurement setup repeatedly.
+    pairs: laser index pairs of the synthetic wavelengths (default: laser 0 with each other laser).
+    combined_m: wavelength of the combined phase (default: the coarsest synthetic wavelength).
+    """
+
+    def __init__(self, laser_wavelengths_m: Sequence[float], pairs: Sequence[Tuple[int, int]] = None,
+                 filter_setting: cuda_holo.Filters = None, thresholds: cuda_holo.Thresholds = None,
+                 combined_m=None, band_rows=tiles.DEFAULT_BAND_ROWS, workers=None):
+        pairs = list(pairs) if pairs is not None else default_pairs(laser_wavelengths_m)
+        synthetic = [synthetic_wavelength(laser_wavelengths_m[i], laser_wavelengths_m[j]) for i, j in pairs]
+        order = numpy.argsort(synthetic)[::-1]
+        self.pairs = [pairs[idx] for idx in order]
+        self.synthetic_m = [synthetic[idx] for idx in order]
+        self.filter_setting = filter_setting if filter_setting is not None else cuda_holo.Filters()
+        self.thresholds = thresholds if thresholds is not None else cuda_holo.Thresholds()
+        self.combined_m = combined_m if combined_m is not None else self.synthetic_m[0]
+        self.band_rows = band_rows
+        self.workers = workers
+        self._buffers = None
+        self._scratch = threading.local()
+
+    def __repr__(self):
+        return f"<SyntheticCombiner {', '.join(f'{w * 1e3:.3f}' for w in self.synthetic_m)} mm>"
+
+    def filter_radii(self) -> List[int]:
+        """Filter radius per synthetic wavelength; the coarsest one is scaled by filter_scale_rough_signal."""
+        radius = filters.filter_radius(self.filter_setting)
+        rough = int(round(radius * self.filter_setting.filter_scale_rough_signal))
+        return [rough] + [radius] * (len(self.pairs) - 1)
+
+    def _output_buffers(self, shape):
+        if self._buffers is None or self._buffers[0].shape[1:] != shape:
+            stack = (len(self.pairs),) + shape
+            self._buffers = (numpy.empty(stack, dtype=numpy.float32), numpy.empty(stack, dtype=numpy.float32),
+                             numpy.empty(shape, dtype=numpy.float32), numpy.empty(shape, dtype=numpy.float32),
+                             numpy.empty(shape, dtype=numpy.float32))
+        return self._buffers
+
+    def _band_scratch(self, shape) -> numpy.ndarray:
+        """Synthetic fields of one padded band, kept per worker thread."""
+        scratch = self._scratch
+        if getattr(scratch, "shape", None) != shape:
+            scratch.synthetic = numpy.empty((len(self.pairs),) + shape, dtype=numpy.complex64)
+            scratch.shape = shape
+        return scratch.synthetic
+
+    def _filter_context(self, fields):
+        """Tilt (see filters.field_tilt) and median value range of each synthetic field, for the whole frame."""
+        tilt = value_ranges = None
+        if self.filter_setting.flag_tilt_compensated_filtering:
+            laser_tilt = filters.field_tilt(fields)
+            tilt = [numpy.angle(numpy.exp(1j * (laser_tilt[i] - laser_tilt[j]))) for i, j in self.pairs]
+        if cuda_holo.FilterType(self.filter_setting.filter_type) == cuda_holo.FilterType.median_filter:
+            peak = numpy.nanmax(numpy.abs(fields), axis=(-2, -1))
+            value_ranges = [(-p, p) for p in (float(peak[i] * peak[j]) for i, j in self.pairs)]
+        return [(tilt[idx] if tilt else None, value_ranges[idx] if value_ranges else None)
+                for idx in range(len(self.pairs))]
+
+    def _combine_band(self, fields, band: tiles.RowBand, radii, context, outputs):
+        raw, filtered, fine, combined, error = outputs
+        padded = fields[:, band.padded]
+        synthetic = self._band_scratch(padded.shape[1:])
+        first = [i for i, _ in self.pairs]
+        second = [j for _, j in self.pairs]
+        numpy.multiply(padded[first], numpy.conj(padded[second]), out=synthetic)
+        core = band.core_in_padded
+        raw[:, band.core] = numpy.angle(synthetic[:, core])
+        for idx, (radius, (tilt, value_range)) in enumerate(zip(radii, context)):
+            if radius > 0:
+                smooth = filters.filter_image(synthetic[idx], self.filter_setting, radius, tilt, band.pad_start,
+                                              value_range)
+                filtered[idx, band.core] = numpy.angle(smooth[core])
+            else:
+                filtered[idx, band.core] = raw[idx, band.core]
+        self._unwrap(filtered[:, band.core], fine[band.core], combined[band.core], error[band.core],
+                     numpy.abs(synthetic[:, core]))
+
+    def _unwrap(self, phases, fine, combined, error, amplitudes):
+        """Hierarchical unwrapping of phases (synthetic, rows, w), coarse to fine, into the output rows."""
+        height = fine  # height (m), kept in the fine buffer while iterating
+        numpy.multiply(phases[0], self.synthetic_m[0] / (4 * math.pi), out=height)
+        error[...] = 0
+        predicted = numpy.empty_like(height)
+        for idx in range(1, len(self.synthetic_m)):
+            scale = 4 * math.pi / self.synthetic_m[idx]
+            numpy.multiply(height, scale, out=predicted)
+            predicted -= phases[idx]
+            order = numpy.rint(predicted / (2 * math.pi))
+            predicted -= 2 * math.pi * order  # now the combination error
+            numpy.fmax(error, numpy.abs(predicted), out=error)
+            order *= 2 * math.pi
+            order += phases[idx]
+            numpy.multiply(order, 1 / scale, out=height)
+        invalid = error > self.thresholds.threshold_combination_error
+        if self.thresholds.use_threshold and self.thresholds.threshold_amplitude > 0:
+            invalid |= (amplitudes < self.thresholds.threshold_amplitude).any(axis=0)
+        numpy.multiply(height, 4 * math.pi / self.combined_m, out=combined)
+        numpy.multiply(height, 4 * math.pi / self.synthetic_m[-1], out=fine)
+        combined[invalid] = numpy.nan
+        fine[invalid] = numpy.nan
+
+    def combine(self, fields: numpy.ndarray) -> CombinationResult:
+        """Evaluate the complex fields (lasers, h, w) at STEP_VIS_PHASES_RAW."""
+        shape = fields.shape[-2:]
+        outputs = self._output_buffers(shape)
+        radii = self.filter_radii()
+        context = self._filter_context(fields)
+        tiles.map_row_bands(lambda band: self._combine_band(fields, band, radii, context, outputs), shape[0],
+                            self.band_rows, halo=filters.filter_halo(self.filter_setting, max(radii)),
+                            workers=self.workers)
+        return CombinationResult(self.synthetic_m, *outputs)
+
+
+def settings_from_jso(jso: dict) -> Tuple[cuda_holo.Filters, cuda_holo.Thresholds]:
+    """
+    (Filters, Thresholds) of the combination from the holography_settings of a measurement json;
+    missing keys keep their defaults, a threshold finer signal error of 0 (off) keeps the default.
+    """
+    filter_setting, thresholds = cuda_holo.Filters(), cuda_holo.Thresholds()
+    for key, attribute, convert in ((KEY_FILTER_RADIU, "filterRadius", lambda value: int(round(float(value)))),
+                                    (KEY_FILTER_SCALE_ROUGH_SIGNA, "filter_scale_rough_signal", float),
+                                    (KEY_FILTER_TYP, "filter_type", int),
+                                    (KEY_FILTER_AVERAGE_ROUND_KERNE, "round_average_kernel", bool)):
+        if key in jso:
+            setattr(filter_setting, attribute, convert(jso[key]))
+    if float(jso.get(KEY_THRESHOLD_FINERSIGNAL_ERRO, 0)) > 0:
+        thresholds.threshold_combination_error = float(jso[KEY_THRESHOLD_FINERSIGNAL_ERRO])
+    return filter_setting, thresholds
+
+
+def combiner_from_measurement(measurement: dict, **kwargs) -> SyntheticCombiner:
+    """
+    SyntheticCombiner for the lasers (KEY_LASER_WL_M) and KEY_LDA_COMBINED_ of a measurement json,
+    filtered and thresholded per its holography_settings (see settings_from_jso) unless given.
+    """
+    filter_setting, thresholds = settings_from_jso(measurement.get(measurement_json.KEY_HOLO_SETTING, {}))
+    kwargs.setdefault("filter_setting", filter_setting)
+    kwargs.setdefault("thresholds", thresholds)
+    return SyntheticCombiner(measurement_json.laser_wavelengths_m(measurement),
+                             combined_m=measurement_json.combined_wavelength_m(measurement), **kwargs)
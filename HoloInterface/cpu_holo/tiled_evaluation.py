@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core evaluation of full-resolution frames (e.g. 9344 x 7000 with several lasers) in tiles.
+
+The frame is split into tiles with a halo of extra pixels on all sides; the halo of a chain of
+neighbourhood stages is the sum of their halos (chain_halo, filters_halo). The stage chain is a
+picklable callable that takes the padded tiles of all inputs (..., th + 2 halo, tw + 2 halo) and
+returns an array of the same spatial shape; only its core is written to the output. Inputs and
+output are memory mapped .npy files (numpy.lib.format.open_memmap): worker processes reopen them
+from their file name, read their padded tile and write their core tile, so nothing of frame size is
+ever held in memory and peak memory is bounded by tile size x workers. With workers=1 (or in-memory
+arrays) the tiles run in the calling process.
+"""
+
+import math
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Sequence, Tuple
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import filters, tiles
+
+DEFAULT_TILE = 1024
+DEFAULT_TILE_BUDGET = 256 << 20  # bytes of stage memory per tile and worker
+
+
+class Tile:
+    """Rows and columns of a tile, each a tiles.RowBand (core plus halo, clipped to the frame)."""
+
+    def __init__(self, rows: tiles.RowBand, cols: tiles.RowBand):
+        self.rows = rows
+        self.cols = cols
+
+    def __repr__(self):
+        return f"<Tile rows {self.rows.start}:{self.rows.stop}, cols {self.cols.start}:{self.cols.stop}>"
+
+    @property
+    def core(self) -> Tuple[slice, slice]:
+        return self.rows.core, self.cols.core
+
+    @property
+    def padded(self) -> Tuple[slice, slice]:
+        return self.rows.padded, self.cols.padded
+
+    @property
+    def core_in_padded(self) -> Tuple[slice, slice]:
+        return self.rows.core_in_padded, self.cols.core_in_padded
+
+
+def frame_tiles(shape, tile_shape=(DEFAULT_TILE, DEFAULT_TILE), halo=0) -> List[Tile]:
+    """Tiles covering a frame (h, w) row by row."""
+    return [Tile(rows, cols) for rows in tiles.row_bands(shape[0], tile_shape[0], halo)
+            for cols in tiles.row_bands(shape[1], tile_shape[1], halo)]
+
+
+def chain_halo(*halos: int) -> int:
+    """Halo of stages applied one after the other."""
+    return sum(int(h) for h in halos)
+
+
+def filters_halo(*settings: cuda_holo.Filters) -> int:
+    """Halo of a chain of Filters stages (filter_radius / filter_halo of each)."""
+    return chain_halo(*(filters.filter_halo(s) for s in settings))
+
+
+def tile_shape_for_budget(bytes_per_pixel: int, halo=0, budget_bytes=DEFAULT_TILE_BUDGET, minimum=64) -> Tuple[int, int]:
+    """Square tile whose padded pixels times bytes_per_pixel (all inputs, outputs, scratch) fit the budget."""
+    side = int(math.sqrt(budget_bytes / max(bytes_per_pixel, 1))) - 2 * halo
+    return (max(side, minimum),) * 2
+
+
+class StageChain:
+    """Stages applied one after the other to the padded tiles: stages[0](*tiles), then each to the result."""
+
+    def __init__(self, *stages: Callable):
+        self.stages = stages
+
+    def __repr__(self):
+        return f"<StageChain {' -> '.join(getattr(s, '__name__', type(s).__name__) for s in self.stages)}>"
+
+    def __call__(self, *padded):
+        result = self.stages[0](*padded)
+        for stage in self.stages[1:]:
+            result = stage(result)
+        return result
+
+
+class ArraySpec:
+    """
+    File, dtype, shape and offset of a memory mapped array, to reopen it in a worker process. For a
+    view of a memmap (e.g. stack[1] or a slice of columns) the file is mapped like its root memmap
+    and the view is rebuilt from its byte offset and strides inside that mapping.
+    """
+
+    def __init__(self, array: numpy.memmap):
+        root = _root_memmap(array)
+        self.filename = root.filename
+        self.root_dtype = root.dtype
+        self.root_shape = root.shape
+        self.root_offset = root.offset
+        self.root_order = "F" if root.flags.f_contiguous and not root.flags.c_contiguous else "C"
+        self.view_offset = array.__array_interface__["data"][0] - root.__array_interface__["data"][0]
+        self.dtype = array.dtype
+        self.shape = array.shape
+        self.strides = array.strides
+
+    def open(self, mode="r") -> numpy.ndarray:
+        root = numpy.memmap(self.filename, dtype=self.root_dtype, mode=mode, shape=self.root_shape,
+                            offset=self.root_offset, order=self.root_order)
+        return numpy.ndarray(self.shape, self.dtype, buffer=root, offset=self.view_offset, strides=self.strides)
+
+
+def _root_memmap(array: numpy.memmap) -> numpy.memmap:
+    """The memmap that owns the mapping of array (array itself unless it is a view)."""
+    root = array
+    while isinstance(root.base, numpy.memmap):
+        root = root.base
+    if not isinstance(root, numpy.memmap) or isinstance(root.base, numpy.ndarray):
+        raise ValueError("array is not a view of a memory mapped file")
+    return root
+
+
+def _is_mapped(array) -> bool:
+    return isinstance(array, numpy.memmap) and array.filename is not None
+
+
+def _run_tile(stages: Callable, inputs: Sequence, out, tile: Tile):
+    padded = [data[(...,) + tile.padded] for data in inputs]
+    result = stages(*padded)
+    out[(...,) + tile.core] = result[(...,) + tile.core_in_padded]
+
+
+def _run_tiles_in_worker(stages: Callable, input_specs: Sequence[ArraySpec], out_spec: ArraySpec, tile_list: List[Tile]):
+    inputs = [spec.open("r") for spec in input_specs]
+    out = out_spec.open("r+")
+    for tile in tile_list:
+        _run_tile(stages, inputs, out, tile)
+    out.base.flush()
+
+
+def create_output(path: str, shape, dtype=numpy.complex64) -> numpy.memmap:
+    """Memory mapped .npy file for the stitched result."""
+    return numpy.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+
+
+def run_tiled(stages: Callable, inputs: Sequence[numpy.ndarray], out: numpy.ndarray, halo=0,
+              tile_shape=(DEFAULT_TILE, DEFAULT_TILE), workers=None) -> numpy.ndarray:
+    """
+    Evaluate stages(*padded input tiles) over the frame (the last two axes of all inputs and out)
+    and stitch the core tiles into out. With more than one worker and all arrays memory mapped, the
+    tiles are distributed over a process pool, every worker process taking an equal share.
+    Returns out.
+    """
+    shape = out.shape[-2:]
+    for data in inputs:
+        if data.shape[-2:] != shape:
+            raise ValueError(f"input of frame shape {data.shape[-2:]} for an output of {shape}")
+    tile_list = frame_tiles(shape, tile_shape, halo)
+    workers = min(workers or tiles.default_workers(), len(tile_list))
+    if workers <= 1 or not all(_is_mapped(a) for a in list(inputs) + [out]):
+        for tile in tile_list:
+            _run_tile(stages, inputs, out, tile)
+        return out
+    out.flush()
+    input_specs = [ArraySpec(a) for a in inputs]
+    out_spec = ArraySpec(out)
+    runs = [tile_list[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(workers) as pool:
+        for done in [pool.submit(_run_tiles_in_worker, stages, input_specs, out_spec, run) for run in runs]:
+            done.result()
+    return out
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting of frames into bands of rows for the CPU evaluation stages.
+
+Stages that only look at a pixel's neighbourhood get each band with a halo of extra rows, compute
+on the padded band and write back the core rows. Bands are processed in a thread pool; numpy
+releases the GIL in its inner loops, so this scales for all but the smallest bands. The pools are
+shared per worker count for the lifetime of the process, so per-thread scratch (threading.local)
+of a stage is allocated once per worker thread and reused by every later frame.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+DEFAULT_BAND_ROWS = 256
+
+
+POOL_THREAD_PREFIX = "row_bands"
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def default_workers():
+    return min(8, os.cpu_count() or 1)
+
+
+def shared_pool(workers: int) -> ThreadPoolExecutor:
+    """The process wide thread pool with that many workers."""
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = _pools[workers] = ThreadPoolExecutor(workers, thread_name_prefix=f"{POOL_THREAD_PREFIX}_{workers}")
+        return pool
+
+
+def in_pool_thread() -> bool:
+    return threading.current_thread().name.startswith(POOL_THREAD_PREFIX)
+
+
+class RowBand:
+    """Rows [start, stop) of a frame plus the padded rows [pad_start, pad_stop) including the halo."""
+
+    def __init__(self, start, stop, pad_start, pad_stop):
+        self.start = start
+        self.stop = stop
+        self.pad_start = pad_start
+        self.pad_stop = pad_stop
+
+    def __repr__(self):
+        return f"<RowBand {self.start}:{self.stop} (padded {self.pad_start}:{self.pad_stop})>"
+
+    @property
+    def core(self) -> slice:
+        """Rows of the frame written by this band."""
+        return slice(self.start, self.stop)
+
+    @property
+    def padded(self) -> slice:
+        """Rows of the frame read by this band."""
+        return slice(self.pad_start, self.pad_stop)
+
+    @property
+    def core_in_padded(self) -> slice:
+        """The core rows, relative to the padded band."""
+        return slice(self.start - self.pad_start, self.stop - self.pad_start)
+
+
+def row_bands(rows: int, band_rows=DEFAULT_BAND_ROWS, halo=0) -> List[RowBand]:
+    return [RowBand(start, min(start + band_rows, rows), max(start - halo, 0), min(start + band_rows + halo, rows))
+            for start in range(0, rows, band_rows)]
+
+
+def map_row_bands(func: Callable[[RowBand], object], rows: int, band_rows=DEFAULT_BAND_ROWS, halo=0,
+                  workers=None) -> list:
+    """
+    Call func for every band (in parallel on the shared pool if workers > 1) and return the results
+    in band order. Calls from inside a pool thread run serially, so nested stages cannot deadlock.
+    """
+    bands = row_bands(rows, band_rows, halo)
+    workers = workers or default_workers()
+    if workers == 1 or len(bands) == 1 or in_pool_thread():
+        return [func(band) for band in bands]
+    return list(shared_pool(workers).map(func, bands))
+
+
+def band_rows_for_budget(bytes_per_row: int, budget_bytes: int, minimum=16) -> int:
+    """Rows per band such that one band's scratch memory stays within budget_bytes."""
+    return max(minimum, budget_bytes // max(bytes_per_row, 1))
+
+
+def split_shape(shape: Tuple[int, ...]) -> Tuple[Tuple[int, ...], Tuple[int, int]]:
+    """Split (..., h, w) into the leading (stack) dimensions and the image shape."""
+    return tuple(shape[:-2]), tuple(shape[-2:])
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Tilt correction of wrapped phase maps (TiltCorrectionMethod), for one map (h, w) or the maps of all
+synthetic wavelengths (synthetic, h, w) at once.
+
+A tilt is the plane piston + rows * y + cols * x (rad, rad/pixel, absolute pixel coordinates),
+returned as an array (..., 3) = (rows, cols, piston). It is estimated from samples only:
+    tilt_correction_on_ring        plane fitted to the phase unwrapped along the ring (Ring), with the
+                                   pixel indices sorted by angle (masks.py) and the pseudo inverse
+                                   of the fit cached per frame shape and ring geometry
+    tilt_correction_from_gradient  median of the wrapped phase differences on a sparse grid, robust
+                                   against steps and noisy areas, refined like the FFT estimate
+    tilt_correction_from_fft       peak of the spectrum of a central crop, interpolated between bins
+                                   and refined by the mean phase difference over the whole frame on a
+                                   sparse grid
+use_low_pass_filter averages the phasors around each sample, use_mirror_only keeps the samples
+whose phase agrees with their neighbours. Without untilt_each_synth the tilt of the coarsest
+synthetic wavelength is scaled to the others; the piston is determined per map. Removing the tilt
+is one in-place pass over the maps.
+"""
+
+import math
+from typing import Sequence
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+from cpu_holo import masks
+from cpu_holo.cache import ArrayCache
+
+METHOD = cuda_holo.TiltCorrectionMethod
+
+TILT_CACHE = ArrayCache(32 << 20)
+GRID_SAMPLES = 1 << 14
+FFT_CROP = 256
+LOW_PASS_RADIUS = 2
+MIRROR_COHERENCE = 0.9
+
+
+def wrap(phase, out=None):
+    """Phase wrapped to [-pi, pi)."""
+    if out is None and numpy.ndim(phase) == 0:
+        return (phase + math.pi) % (2 * math.pi) - math.pi
+    out = numpy.add(phase, math.pi, out=out)
+    numpy.remainder(out, 2 * math.pi, out=out)
+    out -= math.pi
+    return out
+
+
+class RingSamples:
+    """Pixels of a Ring inside a frame sorted by angle (see masks.ring_mask), with the pseudo inverse of the plane fit."""
+
+    def __init__(self, shape, ring: cuda_holo.Ring):
+        region = masks.ring_mask(shape, ring)
+        self.rows = region.pixel_rows
+        self.cols = region.pixel_cols
+        if self.rows.size < 3:
+            raise ValueError(f"ring {masks.ring_key(ring)} has {self.rows.size} pixels in a frame of {tuple(shape)}")
+        design = numpy.stack([self.rows, self.cols, numpy.ones(self.rows.size)], axis=1).astype(numpy.float64)
+        self.pinv = numpy.linalg.pinv(design)
+
+    @property
+    def nbytes(self):
+        return self.pinv.nbytes
+
+
+def ring_samples(shape, ring: cuda_holo.Ring, cache: ArrayCache = TILT_CACHE) -> RingSamples:
+    return cache.get(("ring", tuple(shape)) + masks.ring_key(ring), lambda: RingSamples(shape, ring))
+
+
+def grid_samples(shape, samples=GRID_SAMPLES, margin=1):
+    """Rows and columns (broadcastable) of a regular grid of about samples points and its step."""
+    step = max(int(math.ceil(math.sqrt(shape[0] * shape[1] / samples))), 1)
+    rows = numpy.arange(0, shape[0] - margin, step)[:, None]
+    cols = numpy.arange(0, shape[1] - margin, step)[None, :]
+    return rows, cols, step
+
+
+def sample_phasors(phases: numpy.ndarray, rows, cols, low_pass=False) -> numpy.ndarray:
+    """exp(i phase) at (rows, cols) of each map, averaged over the (2 LOW_PASS_RADIUS + 1)^2 neighbours with low_pass."""
+    if not low_pass:
+        return numpy.exp(1j * phases[..., rows, cols])
+    height, width = phases.shape[-2:]
+    total = 0
+    for dy in range(-LOW_PASS_RADIUS, LOW_PASS_RADIUS + 1):
+        for dx in range(-LOW_PASS_RADIUS, LOW_PASS_RADIUS + 1):
+            total = total + numpy.exp(1j * phases[..., numpy.clip(rows + dy, 0, height - 1),
+                                                  numpy.clip(cols + dx, 0, width - 1)])
+    return total / (2 * LOW_PASS_RADIUS + 1) ** 2
+
+
+def mirror_samples(phases: numpy.ndarray, rows, cols) -> numpy.ndarray:
+    """
+    True where the phase of all maps agrees with the 4 neighbours (mirror-like, not diffuse): the
+    mean of the neighbour phasor differences has a magnitude of at least MIRROR_COHERENCE. Tilt
+    does not change the magnitude.
+    """
+    height, width = phases.shape[-2:]
+    center = phases[..., rows, cols]
+    coherent = True
+    for dy, dx in ((0, 1), (1, 0)):
+        forward = phases[..., numpy.clip(rows + dy, 0, height - 1), numpy.clip(cols + dx, 0, width - 1)]
+        backward = phases[..., numpy.clip(rows - dy, 0, height - 1), numpy.clip(cols - dx, 0, width - 1)]
+        agreement = numpy.abs(numpy.exp(1j * (forward - center)) + numpy.exp(1j * (center - backward))) / 2
+        coherent = coherent & (agreement >= MIRROR_COHERENCE)
+    coherent = numpy.asarray(coherent)
+    return coherent.all(axis=tuple(range(coherent.ndim - numpy.broadcast(rows, cols).ndim)))
+
+
+def _ring_tilt(phases, settings: cuda_holo.TiltSettings, ring: cuda_holo.Ring, cache) -> numpy.ndarray:
+    samples = ring_samples(phases.shape[-2:], ring, cache)
+    phasors = sample_phasors(phases, samples.rows, samples.cols, settings.use_low_pass_filter)
+    unwrapped = numpy.unwrap(numpy.angle(phasors), axis=-1)
+    if settings.use_mirror_only:
+        keep = mirror_samples(phases, samples.rows, samples.cols)
+        if keep.sum() < 3:
+            raise ValueError("less than 3 mirror-like pixels on the tilt ring")
+        design = numpy.stack([samples.rows[keep], samples.cols[keep], numpy.ones(keep.sum())], axis=1)
+        return numpy.linalg.lstsq(design, unwrapped[..., keep].reshape(-1, keep.sum()).T, rcond=None)[0].T.reshape(
+            phases.shape[:-2] + (3,))
+    return numpy.einsum("kn,...n->...k", samples.pinv, unwrapped)
+
+
+def _grid_tilt(phases, settings: cuda_holo.TiltSettings) -> numpy.ndarray:
+    rows, cols, _step = grid_samples(phases.shape[-2:])
+    low_pass = settings.use_low_pass_filter
+    center = sample_phasors(phases, rows, cols, low_pass)
+    gradients = [numpy.angle(sample_phasors(phases, rows + dy, cols + dx, low_pass) * numpy.conj(center))
+                 for dy, dx in ((1, 0), (0, 1))]
+    if settings.use_mirror_only:
+        keep = numpy.broadcast_to(mirror_samples(phases, rows, cols), center.shape[-2:])
+        gradients = [g[..., keep] for g in gradients]
+    tilt = numpy.zeros(phases.shape[:-2] + (3,))
+    tilt[..., 0] = numpy.median(gradients[0].reshape(phases.shape[:-2] + (-1,)), axis=-1)
+    tilt[..., 1] = numpy.median(gradients[1].reshape(phases.shape[:-2] + (-1,)), axis=-1)
+    return _refine_on_grid(phases, tilt, settings)
+
+
+def _peak_offset(below, peak, above):
+    """Sub-bin offset of a peak from three log magnitudes (Gaussian interpolation)."""
+    denominator = below - 2 * peak + above
+    return numpy.where(denominator < 0, 0.5 * (below - above) / numpy.where(denominator < 0, denominator, -1), 0.0)
+
+
+def _fft_tilt(phases, settings: cuda_holo.TiltSettings) -> numpy.ndarray:
+    height, width = phases.shape[-2:]
+    crop_h, crop_w = min(FFT_CROP, height), min(FFT_CROP, width)
+    top, left = (height - crop_h) // 2, (width - crop_w) // 2
+    rows = numpy.arange(top, top + crop_h)[:, None]
+    cols = numpy.arange(left, left + crop_w)[None, :]
+    phasors = sample_phasors(phases, rows, cols, settings.use_low_pass_filter)
+    if settings.use_mirror_only:
+        phasors = phasors * mirror_samples(phases, rows, cols)
+    window = numpy.hanning(crop_h)[:, None] * numpy.hanning(crop_w)[None, :]
+    magnitude = numpy.abs(numpy.fft.fft2(phasors * window))
+    stack = magnitude.reshape((-1, crop_h, crop_w))
+    peaks = stack.reshape(stack.shape[0], -1).argmax(axis=1)
+    peak_rows, peak_cols = numpy.unravel_index(peaks, (crop_h, crop_w))
+    index = numpy.arange(stack.shape[0])
+    log = numpy.log(stack + 1e-12)
+    row_offset = _peak_offset(log[index, (peak_rows - 1) % crop_h, peak_cols], log[index, peak_rows, peak_cols],
+                              log[index, (peak_rows + 1) % crop_h, peak_cols])
+    col_offset = _peak_offset(log[index, peak_rows, (peak_cols - 1) % crop_w], log[index, peak_rows, peak_cols],
+                              log[index, peak_rows, (peak_cols + 1) % crop_w])
+    frequency_rows = (peak_rows + row_offset + crop_h / 2) % crop_h - crop_h / 2
+    frequency_cols = (peak_cols + col_offset + crop_w / 2) % crop_w - crop_w / 2
+    tilt = numpy.zeros(phases.shape[:-2] + (3,))
+    tilt[..., 0] = (2 * math.pi * frequency_rows / crop_h).reshape(phases.shape[:-2])
+    tilt[..., 1] = (2 * math.pi * frequency_cols / crop_w).reshape(phases.shape[:-2])
+    return _refine_on_grid(phases, tilt, settings)
+
+
+def _refine_on_grid(phases, tilt, settings: cuda_holo.TiltSettings) -> numpy.ndarray:
+    """Adds the mean residual phase difference between neighbouring points of a sparse grid over the frame."""
+    rows, cols, step = grid_samples(phases.shape[-2:], margin=0)
+    demodulated = sample_phasors(phases, rows, cols, settings.use_low_pass_filter) * numpy.exp(
+        -1j * (tilt[..., 0, None, None] * rows + tilt[..., 1, None, None] * cols))
+    if settings.use_mirror_only:
+        demodulated = demodulated * mirror_samples(phases, rows, cols)
+    refined = tilt.copy()
+    refined[..., 0] += numpy.angle(numpy.sum(demodulated[..., 1:, :] * numpy.conj(demodulated[..., :-1, :]),
+                                             axis=(-2, -1))) / step
+    refined[..., 1] += numpy.angle(numpy.sum(demodulated[..., :, 1:] * numpy.conj(demodulated[..., :, :-1]),
+                                             axis=(-2, -1))) / step
+    return refined
+
+
+def _pistons(phases, tilt) -> numpy.ndarray:
+    """Mean phase of each map after removing the tilt, on a sparse grid."""
+    rows, cols, _step = grid_samples(phases.shape[-2:], margin=0)
+    residual = numpy.exp(1j * (phases[..., rows, cols] - tilt[..., 0, None, None] * rows
+                               - tilt[..., 1, None, None] * cols))
+    return numpy.angle(numpy.nansum(residual, axis=(-2, -1)))
+
+
+def estimate_tilt(phases: numpy.ndarray, settings: cuda_holo.TiltSettings, synthetic_m: Sequence[float] = None,
+                  ring: cuda_holo.Ring = None, cache: ArrayCache = TILT_CACHE) -> numpy.ndarray:
+    """
+    Tilt (..., 3) of wrapped phase maps (h, w) or (synthetic, h, w), see the module docstring.
+    synthetic_m: synthetic wavelengths of the maps, coarse to fine; without untilt_each_synth the
+    tilt of map 0 is scaled to the others (without synthetic_m each map is evaluated on its own).
+    ring: ring of tilt_correction_on_ring, default settings.ring_for_roi.
+    """
+    method = METHOD(settings.method)
+    if method == METHOD.tilt_correction_off:
+        return numpy.zeros(phases.shape[:-2] + (3,))
+    batched = phases.ndim > 2
+    source = phases
+    if batched and not settings.untilt_each_synth and synthetic_m is not None:
+        source = phases[:1]
+    if method == METHOD.tilt_correction_on_ring:
+        tilt = _ring_tilt(source, settings, ring if ring is not None else settings.ring_for_roi, cache)
+    elif method == METHOD.tilt_correction_from_gradient:
+        tilt = _grid_tilt(source, settings)
+    else:
+        tilt = _fft_tilt(source, settings)
+    if source is not phases:
+        scale = synthetic_m[0] / numpy.asarray(synthetic_m, dtype=numpy.float64)
+        tilt = tilt[0] * scale[:, None]
+    tilt[..., 2] = _pistons(phases, tilt)
+    return tilt
+
+
+def remove_tilt(phases: numpy.ndarray, tilt: numpy.ndarray, out: numpy.ndarray = None) -> numpy.ndarray:
+    """Wrapped phases minus the tilt planes; out=phases works in place."""
+    tilt = numpy.asarray(tilt)
+    rows = numpy.arange(phases.shape[-2])[:, None] * tilt[..., 0, None, None] + tilt[..., 2, None, None]
+    cols = (numpy.arange(phases.shape[-1])[None, :] * tilt[..., 1, None, None]).astype(phases.dtype)
+    out = numpy.subtract(phases, rows.astype(phases.dtype), out=out)
+    out -= cols
+    return wrap(out, out=out)
+
+
+def untilt(phases: numpy.ndarray, settings: cuda_holo.TiltSettings, synthetic_m: Sequence[float] = None,
+           ring: cuda_holo.Ring = None, in_place=False, cache: ArrayCache = TILT_CACHE):
+    """(untilted phases, tilt) per TiltSettings; the phases are not changed unless in_place."""
+    tilt = estimate_tilt(phases, settings, synthetic_m, ring, cache)
+    if METHOD(settings.method) == METHOD.tilt_correction_off:
+        return phases, tilt
+    return remove_tilt(phases, tilt, out=phases if in_place else None), tilt
+
+
+def circle_tilt_settings(circle: cuda_holo.CircleTilt) -> cuda_holo.TiltSettings:
+    """TiltSettings equivalent to the older CircleTilt (auto tilt on a circle)."""
+    settings = cuda_holo.TiltSettings()
+    settings.method = METHOD.tilt_correction_on_ring if circle.do_auto_tilt_circle else METHOD.tilt_correction_off
+    settings.use_mirror_only = circle.use_mirror_only
+    settings.use_low_pass_filter = circle.use_low_pass_filter
+    settings.ring_for_roi = circle.ring
+    return settings
+
+
+def line_tilt(phases: numpy.ndarray, line: cuda_holo.LineTilt) -> numpy.ndarray:
+    """
+    Tilt (..., 3) from the phase unwrapped along section_x (a row segment, for the columns) and
+    section_y (a column segment, for the rows); sections of length < 2 give no tilt on their axis.
+    """
+    tilt = numpy.zeros(phases.shape[:-2] + (3,))
+    for axis, section in ((0, line.section_y), (1, line.section_x)):
+        if section.length < 2:
+            continue
+        steps = numpy.arange(section.length)
+        if axis == 0:
+            values = phases[..., section.y_start + steps, section.x_start]
+        else:
+            values = phases[..., section.y_start, section.x_start + steps]
+        centered = steps - steps.mean()
+        tilt[..., axis] = (numpy.unwrap(values, axis=-1) * centered).sum(axis=-1) / (centered * centered).sum()
+    tilt[..., 2] = _pistons(phases, tilt)
+    return tilt
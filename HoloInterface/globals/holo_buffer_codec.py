@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Compression of result buffers for the data channel and for files.
+
+Buffers are split into bands of rows, each band is predicted from its left neighbour (horizontal
+delta), byte-shuffled and compressed with zlib or lzma. Bands are independent, so they are encoded
+and decoded in a thread pool (both libraries release the GIL). Float buffers are stored bit exact
+by default; with quant_step > 0 they are quantised to integers first, with an error of at most
+quant_step / 2 (NaN is kept as NaN).
+"""
+
+import json
+import lzma
+import os
+import struct
+import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List
+
+import numpy
+
+CODEC_ZLIB = "zlib"
+CODEC_LZMA = "lzma"
+
+FILE_MAGIC = b"HOLOBUF1"
+
+# header key (data channel and file) of the list of compressed chunk sizes
+KEY_CHUNK_BYTES = "chunk_bytes"
+
+_NAN_CODE = numpy.iinfo(numpy.int32).min
+_DELTA_TYPES = {1: numpy.uint8, 2: numpy.uint16, 4: numpy.uint32, 8: numpy.uint64}
+
+
+class BufferCodec:
+    """
+    Description of a codec, negotiated via the buffer description (see to_jso / from_jso).
+    Equal settings compare and hash equal, so a ResultBuffer with a codec stays usable in sets.
+    """
+
+    def __init__(self, name=CODEC_ZLIB, level=None, quant_step=0.0, chunk_rows=256, workers=None):
+        if name not in (CODEC_ZLIB, CODEC_LZMA):
+            raise ValueError(f"unknown codec {name}")
+        self.name = name
+        self.level = (1 if name == CODEC_ZLIB else 0) if level is None else int(level)
+        self.quant_step = float(quant_step)
+        self.chunk_rows = int(chunk_rows)
+        self.workers = workers or min(8, os.cpu_count() or 1)
+
+    def _key(self):
+        return self.name, self.level, self.quant_step, self.chunk_rows
+
+    def __eq__(self, other):
+        return isinstance(other, BufferCodec) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        lossy = f", quant_step {self.quant_step}" if self.quant_step else ""
+        return f"<BufferCodec {self.name} level {self.level}{lossy}>"
+
+    def to_jso(self):
+        return {"name": self.name, "level": self.level, "quant_step": self.quant_step,
+                "chunk_rows": self.chunk_rows}
+
+    @classmethod
+    def from_jso(cls, jso):
+        return cls(jso["name"], jso.get("level"), jso.get("quant_step", 0.0), jso.get("chunk_rows", 256))
+
+    # --- single band ---------------------------------------------------------------------------
+
+    def _compress(self, raw: bytes) -> bytes:
+        if self.name == CODEC_ZLIB:
+            return zlib.compress(raw, self.level)
+        return lzma.compress(raw, preset=self.level)
+
+    def _decompress(self, packed: bytes) -> bytes:
+        if self.name == CODEC_ZLIB:
+            return zlib.decompress(packed)
+        return lzma.decompress(packed)
+
+    def _integer_view(self, band: numpy.ndarray) -> numpy.ndarray:
+        """Integers to predict on; complex values are split into real and imaginary planes."""
+        if numpy.iscomplexobj(band):
+            band = band.view(band.real.dtype).reshape(band.shape + (2,))
+        if self.quant_step and numpy.issubdtype(band.dtype, numpy.floating):
+            with numpy.errstate(invalid="ignore"):
+                quantised = numpy.rint(band / self.quant_step)
+                if numpy.nanmax(numpy.abs(quantised), initial=0) >= -_NAN_CODE:
+                    raise ValueError(f"BufferCodec: quant_step {self.quant_step} too small for the value range")
+            return numpy.where(numpy.isnan(quantised), _NAN_CODE, quantised).astype(numpy.int32).view(numpy.uint32)
+        return band.view(_DELTA_TYPES[band.dtype.itemsize])
+
+    def encode_band(self, band: numpy.ndarray) -> bytes:
+        ints = self._integer_view(numpy.ascontiguousarray(band))
+        delta = numpy.empty_like(ints)
+        delta[:, 0] = ints[:, 0]
+        numpy.subtract(ints[:, 1:], ints[:, :-1], out=delta[:, 1:])  # wraps around, exactly invertible
+        shuffled = delta.reshape(-1).view(numpy.uint8).reshape(-1, delta.dtype.itemsize).T
+        return self._compress(numpy.ascontiguousarray(shuffled).tobytes())
+
+    def decode_band(self, packed: bytes, out: numpy.ndarray):
+        """Decode one band into out (a view with the band's shape and dtype)."""
+        template = self._integer_view(out[:0])
+        item = template.dtype.itemsize
+        shuffled = numpy.frombuffer(self._decompress(packed), dtype=numpy.uint8).reshape(item, -1)
+        delta = numpy.ascontiguousarray(shuffled.T).view(template.dtype)
+        delta = delta.reshape((out.shape[0],) + template.shape[1:])
+        ints = numpy.cumsum(delta, axis=1, dtype=template.dtype)
+        if self.quant_step and numpy.issubdtype(out.real.dtype, numpy.floating):
+            codes = ints.view(numpy.int32)
+            values = codes * self.quant_step
+            values[codes == _NAN_CODE] = numpy.nan
+            target = out.view(out.real.dtype).reshape(values.shape) if numpy.iscomplexobj(out) else out
+            target[...] = values
+        else:
+            out.view(template.dtype).reshape(ints.shape)[...] = ints
+
+    # --- whole buffers ---------------------------------------------------------------------------
+
+    def bands(self, rows):
+        return [slice(start, min(start + self.chunk_rows, rows)) for start in range(0, rows, self.chunk_rows)]
+
+    def encode(self, data: numpy.ndarray) -> List[bytes]:
+        """Encode a 2d buffer into one compressed chunk per band of chunk_rows rows."""
+        with ThreadPoolExecutor(self.workers) as pool:
+            return list(pool.map(lambda band: self.encode_band(data[band]), self.bands(data.shape[0])))
+
+    def decode_into(self, chunks: Iterable[bytes], out: numpy.ndarray,
+                    rows_arrived: Callable[[int], None] = None):
+        """
+        Decode chunks (e.g. as they are read from a socket) into out, one per band of chunk_rows.
+        rows_arrived is called with the number of leading rows that are complete. Raises ValueError
+        if there are fewer or more chunks than bands.
+        """
+        bands = self.bands(out.shape[0])
+        chunks = iter(chunks)
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = []
+            done = 0
+            for band, chunk in zip(bands, chunks):
+                futures.append(pool.submit(self.decode_band, chunk, out[band]))
+                while done < len(futures) and futures[done].done():
+                    futures[done].result()
+                    done += 1
+                    if rows_arrived is not None:
+                        rows_arrived(bands[done - 1].stop)
+            for idx in range(done, len(futures)):
+                futures[idx].result()
+                if rows_arrived is not None:
+                    rows_arrived(bands[idx].stop)
+            if len(futures) != len(bands):
+                raise ValueError(f"BufferCodec: got {len(futures)} chunks, expected {len(bands)}")
+            surplus = sum(1 for _ in chunks)
+            if surplus:
+                raise ValueError(f"BufferCodec: got {len(bands) + surplus} chunks, expected {len(bands)}")
+
+
+def write_file_header(f, header: dict):
+    """File layout: magic, little endian uint32 length of the json header, json header, chunks."""
+    raw = json.dumps(header).encode()
+    f.write(FILE_MAGIC + struct.pack("<I", len(raw)) + raw)
+
+
+def read_file_header(f) -> dict:
+    magic = f.read(len(FILE_MAGIC))
+    if magic != FILE_MAGIC:
+        raise ValueError(f"not a holo buffer file (magic {magic!r})")
+    length, = struct.unpack("<I", f.read(4))
+    return json.loads(f.read(length).decode())
+
+
+class TestBufferCodec(unittest.TestCase):
+    rng = numpy.random.default_rng(1)
+    phase = numpy.angle(numpy.exp(1j * (numpy.add.outer(numpy.arange(70) * 0.05, numpy.arange(90) * 0.03)
+                                        + rng.normal(0, 0.05, (70, 90))))).astype(numpy.float32)
+
+    def round_trip(self, data, codec):
+        out = numpy.empty_like(data)
+        rows_seen = []
+        codec.decode_into(codec.encode(data), out, rows_seen.append)
+        self.assertEqual(rows_seen[-1], data.shape[0])
+        return out
+
+    def test_lossless_float_with_nan(self):
+        data = self.phase.copy()
+        data[3, 5] = numpy.nan
+        for name in (CODEC_ZLIB, CODEC_LZMA):
+            numpy.testing.assert_array_equal(self.round_trip(data, BufferCodec(name, chunk_rows=16)), data)
+
+    def test_lossless_complex_and_raw(self):
+        cpx = (self.phase + 1j * self.phase[::-1]).astype(numpy.complex64)
+        numpy.testing.assert_array_equal(self.round_trip(cpx, BufferCodec(chunk_rows=8)), cpx)
+        raw = self.rng.integers(0, 4096, (33, 50)).astype(numpy.uint16)
+        numpy.testing.assert_array_equal(self.round_trip(raw, BufferCodec(chunk_rows=8)), raw)
+
+    def test_quantised_error_bound(self):
+        data = self.phase.copy()
+        data[0, 0] = numpy.nan
+        decoded = self.round_trip(data, BufferCodec(quant_step=1e-3, chunk_rows=32))
+        self.assertTrue(numpy.isnan(decoded[0, 0]))
+        self.assertLessEqual(numpy.nanmax(numpy.abs(decoded - data)), 0.5e-3 + 1e-6)
+
+    def test_chunk_count_must_match_bands(self):
+        codec = BufferCodec(chunk_rows=16)
+        chunks = codec.encode(self.phase)
+        out = numpy.empty_like(self.phase)
+        for wrong in (chunks[:-1], chunks + chunks[:1]):
+            with self.assertRaises(ValueError):
+                codec.decode_into(iter(wrong), out)
+
+    def test_smooth_data_compresses(self):
+        smooth = numpy.add.outer(numpy.arange(256), numpy.arange(256)).astype(numpy.float32)
+        self.assertLess(sum(len(c) for c in BufferCodec().encode(smooth)), smooth.nbytes / 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-resolution preview pyramid for result buffers.
+
+Level 0 is the full buffer, level n is binned by 2**n in both directions. The pyramid is filled
+row by row while the buffer arrives, so a thumbnail is ready as soon as the last row is in.
+"""
+
+import unittest
+from typing import List, Tuple
+
+import numpy
+
+# Values of cuda_holo_definitions.h binning_methods. The ctypes generator emits them as an enum
+# "constants", which is shadowed by the focus criteria of the same name, so they are repeated here.
+BINNING_MEAN = 1
+BINNING_MAX = 2
+
+DEFAULT_MIN_PREVIEW_SIZE = 64
+
+
+def bin_2x2(data: numpy.ndarray, method=BINNING_MEAN, out=None) -> numpy.ndarray:
+    """
+    Bin data by 2 in both directions; an odd last row/column is dropped.
+    NaN pixels (masked values) are ignored, a block becomes NaN only if all four pixels are NaN.
+    """
+    rows, cols = data.shape[0] // 2, data.shape[1] // 2
+    blocks = data[:2 * rows, :2 * cols].reshape(rows, 2, cols, 2)
+    if out is None:
+        out = numpy.empty((rows, cols), dtype=data.dtype)
+
+    if method == BINNING_MAX:
+        if numpy.iscomplexobj(data):
+            raise ValueError("max binning is not defined for complex buffers")
+        with numpy.errstate(invalid="ignore"):
+            numpy.fmax(numpy.fmax(blocks[:, 0, :, 0], blocks[:, 0, :, 1]),
+                       numpy.fmax(blocks[:, 1, :, 0], blocks[:, 1, :, 1]), out=out)
+    elif method == BINNING_MEAN:
+        if numpy.issubdtype(data.dtype, numpy.inexact):
+            valid = ~numpy.isnan(blocks)
+            sums = numpy.where(valid, blocks, 0).sum(axis=(1, 3))
+            counts = valid.sum(axis=(1, 3))
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                numpy.divide(sums, counts, out=out)
+        else:
+            out[...] = blocks.mean(axis=(1, 3))
+    else:
+        raise ValueError(f"unknown binning method {method}")
+    return out
+
+
+def pyramid_shapes(shape: Tuple[int, int], num_levels=None,
+                   min_size=DEFAULT_MIN_PREVIEW_SIZE) -> List[Tuple[int, int]]:
+    """Shapes of levels 1..n; without num_levels, bin until the smaller side would drop below min_size."""
+    shapes = []
+    rows, cols = shape[:2]
+    while True:
+        rows, cols = rows // 2, cols // 2
+        if num_levels is None and min(rows, cols) < min_size:
+            break
+        if num_levels is not None and len(shapes) >= num_levels:
+            break
+        if rows == 0 or cols == 0:
+            break
+        shapes.append((rows, cols))
+    return shapes
+
+
+class BufferPyramid:
+    """
+    Preview levels of a 2d buffer, built incrementally.
+
+    Call update() whenever more rows of the source have arrived; only blocks of rows that are
+    complete and not yet binned are processed, so the total cost is a single pass over the data.
+    """
+
+    def __init__(self, shape, dtype, num_levels=None, method=BINNING_MEAN,
+                 min_size=DEFAULT_MIN_PREVIEW_SIZE):
+        self.source_shape = tuple(shape[:2])
+        self.method = method
+        self.levels = [numpy.empty(s, dtype=dtype) for s in pyramid_shapes(shape, num_levels, min_size)]
+        self.rows_done = [0] * len(self.levels)
+
+    @property
+    def num_levels(self):
+        """Number of binned levels, i.e. without the source itself."""
+        return len(self.levels)
+
+    @property
+    def complete(self):
+        return all(done == level.shape[0] for done, level in zip(self.rows_done, self.levels))
+
+    def update(self, data: numpy.ndarray, rows_filled=None):
+        """Bin all rows of data[:rows_filled] that have not been binned yet."""
+        source, source_rows = data, data.shape[0] if rows_filled is None else rows_filled
+        for idx, level in enumerate(self.levels):
+            rows_ready = min(source_rows // 2, level.shape[0])
+            start = self.rows_done[idx]
+            if rows_ready > start:
+                bin_2x2(source[2 * start:2 * rows_ready, :2 * level.shape[1]], self.method,
+                        out=level[start:rows_ready])
+                self.rows_done[idx] = rows_ready
+            source, source_rows = level, self.rows_done[idx]
+
+    def get_level(self, level: int) -> numpy.ndarray:
+        """Binned image for level >= 1 (binning factor 2**level); rows not yet arrived are undefined."""
+        if not 1 <= level <= self.num_levels:
+            raise IndexError(f"preview level {level} not available, pyramid has levels 1..{self.num_levels}")
+        return self.levels[level - 1]
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+
+class TestBufferPyramid(unittest.TestCase):
+    data = numpy.arange(24 * 34, dtype=numpy.float32).reshape(24, 34)
+
+    def test_mean_binning(self):
+        binned = bin_2x2(self.data)
+        self.assertEqual(binned.shape, (12, 17))
+        self.assertAlmostEqual(binned[0, 0], (0 + 1 + 34 + 35) / 4)
+
+    def test_max_binning_ignores_nan(self):
+        data = self.data.copy()
+        data[1, 1] = numpy.nan
+        self.assertEqual(bin_2x2(data, BINNING_MAX)[0, 0], 34)
+
+    def test_incremental_equals_one_shot(self):
+        one_shot = BufferPyramid(self.data.shape, self.data.dtype, num_levels=3)
+        one_shot.update(self.data)
+        incremental = BufferPyramid(self.data.shape, self.data.dtype, num_levels=3)
+        for rows in (1, 5, 6, 13, 24):
+            incremental.update(self.data, rows)
+        self.assertTrue(incremental.complete)
+        for level in range(1, 4):
+            numpy.testing.assert_array_equal(one_shot.get_level(level), incremental.get_level(level))
+        self.assertEqual(one_shot.get_level(3).shape, (3, 4))
+
+    def test_default_levels_respect_min_size(self):
+        self.assertEqual(pyramid_shapes((7000, 9344)), [(3500, 4672), (1750, 2336), (875, 1168),
+                                                         (437, 584), (218, 292), (109, 146)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics of a result buffer, accumulated band by band while the buffer arrives.
+
+Mean and variance are merged per band (Chan et al.), so the result equals a single pass over the
+whole buffer. Complex buffers are evaluated on their amplitude.
+"""
+
+import math
+import unittest
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+
+DEFAULT_HISTOGRAM_BINS = 256
+
+# hist_range that starts at the range of the first band and doubles whenever a band falls outside
+AUTO_RANGE = "auto"
+
+# Steps whose (non-amplitude) buffers hold phase values wrapped to [-pi, pi):
+WRAPPED_PHASE_STEPS = (cuda_holo.ProcessingStep.STEP_VIS_PHASES_RAW,
+                       cuda_holo.ProcessingStep.STEP_SYN_PHASES_RAW,
+                       cuda_holo.ProcessingStep.STEP_SYN_PHASES_FILTERED)
+
+
+class BufferStatistics:
+    """
+    min/max/mean/std, NaN, infinite and masked pixel counts and a fixed-bin histogram of a 2d buffer.
+    hist_range=None disables the histogram; mask_value (e.g. 0 for amplitudes) counts masked pixels,
+    which are excluded from all other numbers, like NaN and +-inf. Values outside a fixed hist_range are
+    counted in the first / last bin. With AUTO_RANGE the range is set by the first band and doubled
+    (pairs of bins merged, so no counts are lost; values on a bin edge may round into the
+    neighbouring bin) until later bands fit; bins must be even.
+    """
+
+    def __init__(self, hist_range=None, bins=DEFAULT_HISTOGRAM_BINS, mask_value=None):
+        self.auto_range = hist_range == AUTO_RANGE
+        if self.auto_range and bins % 2:
+            raise ValueError("BufferStatistics: an automatic histogram range needs an even number of bins")
+        self.hist_range = None if hist_range is None or self.auto_range else (float(hist_range[0]),
+                                                                              float(hist_range[1]))
+        self.histogram = None if hist_range is None else numpy.zeros(bins, dtype=numpy.int64)
+        self.mask_value = mask_value
+        self.rows_done = 0
+        self.count = 0
+        self.nan_count = 0
+        self.inf_count = 0
+        self.masked_count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    @classmethod
+    def for_buffer(cls, step: cuda_holo.ProcessingStep, is_amp: bool, bins=DEFAULT_HISTOGRAM_BINS,
+                   hist_range=None):
+        """
+        Defaults per buffer type: wrapped phases get a [-pi, pi] histogram, all other buffers one
+        over hist_range or, if None, over their data (AUTO_RANGE); amplitudes mask zeros.
+        """
+        if is_amp:
+            return cls(hist_range or AUTO_RANGE, bins, mask_value=0)
+        if step in WRAPPED_PHASE_STEPS and hist_range is None:
+            return cls((-math.pi, math.pi), bins)
+        return cls(hist_range or AUTO_RANGE, bins)
+
+    def __repr__(self):
+        return (f"<BufferStatistics: n={self.count}, min={self.min:g}, max={self.max:g}, mean={self.mean:g}, "
+                f"std={self.std:g}, nan={self.nan_count}, inf={self.inf_count}, masked={self.masked_count}>")
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / self.count) if self.count else math.nan
+
+    @property
+    def valid_fraction(self):
+        total = self.count + self.nan_count + self.inf_count + self.masked_count
+        return self.count / total if total else 0.0
+
+    def update(self, data: numpy.ndarray, rows_filled=None):
+        """Add all rows of data[:rows_filled] that have not been counted yet."""
+        rows_filled = data.shape[0] if rows_filled is None else rows_filled
+        if rows_filled > self.rows_done:
+            self.add(data[self.rows_done:rows_filled])
+            self.rows_done = rows_filled
+
+    def add(self, chunk: numpy.ndarray):
+        values = numpy.abs(chunk) if numpy.iscomplexobj(chunk) else chunk
+        values = values.reshape(-1)
+        if numpy.issubdtype(values.dtype, numpy.floating):
+            finite = numpy.isfinite(values)
+            if not finite.all():
+                invalid = values[~finite]
+                nan_count = int(numpy.isnan(invalid).sum())
+                self.nan_count += nan_count
+                self.inf_count += invalid.size - nan_count
+                values = values[finite]
+        if self.mask_value is not None:
+            masked = values == self.mask_value
+            masked_count = int(masked.sum())
+            if masked_count:
+                values = values[~masked]
+            self.masked_count += masked_count
+        n = values.size
+        if n == 0:
+            return
+
+        chunk_mean = float(values.mean(dtype=numpy.float64))
+        chunk_m2 = float(numpy.square(numpy.subtract(values, chunk_mean, dtype=numpy.float64)).sum())
+        total = self.count + n
+        delta = chunk_mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += chunk_m2 + delta * delta * self.count * n / total
+        self.count = total
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        if self.histogram is not None:
+            if self.auto_range:
+                self._cover(float(values.min()), float(values.max()))
+            low, high = self.hist_range
+            bins = self.histogram.size
+            idx = ((values - low) * (bins / (high - low))).astype(numpy.int64)
+            numpy.clip(idx, 0, bins - 1, out=idx)
+            self.histogram += numpy.bincount(idx, minlength=bins)
+
+    def _cover(self, low, high):
+        """Grow the automatic histogram range until it contains [low, high]."""
+        if self.hist_range is None:
+            width = high - low or max(abs(low), 1.0) * 1e-6
+            self.hist_range = (low, low + width)
+            return
+        bins = self.histogram.size
+        while low < self.hist_range[0] or high > self.hist_range[1]:
+            start, stop = self.hist_range
+            merged = self.histogram.reshape(-1, 2).sum(axis=1)
+            self.histogram[:] = 0
+            if low < start:
+                self.histogram[bins // 2:] = merged
+                self.hist_range = (2 * start - stop, stop)
+            else:
+                self.histogram[:bins // 2] = merged
+                self.hist_range = (start, 2 * stop - start)
+
+    def percentile(self, q):
+        """Value below which fraction q (0..1) of the valid pixels lie, from the histogram (bin resolution)."""
+        if self.histogram is None or not self.count:
+            raise ValueError("BufferStatistics: percentiles need a histogram range and data")
+        cumulative = numpy.cumsum(self.histogram)
+        idx = int(numpy.searchsorted(cumulative, q * cumulative[-1]))
+        low, high = self.hist_range
+        return low + (idx + 1) * (high - low) / self.histogram.size
+
+    def display_range(self, clip_fraction=0.01):
+        """(min, max) for display scaling; with a histogram, clip_fraction is cut off at both ends."""
+        if self.histogram is None:
+            return self.min, self.max
+        return self.percentile(clip_fraction), self.percentile(1 - clip_fraction)
+
+    def apply_to_display_setting(self, setting: cuda_holo.HoloDisplaySetting, clip_fraction=0.01):
+        setting.min_for_scale, setting.max_for_scale = self.display_range(clip_fraction)
+        return setting
+
+
+class TestBufferStatistics(unittest.TestCase):
+    rng = numpy.random.default_rng(2)
+    data = rng.uniform(-3, 3, (50, 40)).astype(numpy.float32)
+
+    def test_chunked_equals_numpy(self):
+        data = self.data.copy()
+        data[4, 4] = numpy.nan
+        stats = BufferStatistics((-math.pi, math.pi), bins=32)
+        for rows in (3, 3, 17, 50):
+            stats.update(data, rows)
+        self.assertEqual(stats.nan_count, 1)
+        self.assertEqual(stats.count, data.size - 1)
+        self.assertAlmostEqual(stats.mean, float(numpy.nanmean(data.astype(numpy.float64))), places=9)
+        self.assertAlmostEqual(stats.std, float(numpy.nanstd(data.astype(numpy.float64))), places=9)
+        self.assertEqual(stats.max, numpy.nanmax(data))
+        expected, _ = numpy.histogram(data[~numpy.isnan(data)], bins=32, range=(-math.pi, math.pi))
+        self.assertEqual(int(numpy.abs(stats.histogram - expected).sum()), 0)
+
+    def test_infinite_values_are_counted_apart(self):
+        stats = BufferStatistics(AUTO_RANGE, bins=4)
+        stats.add(numpy.array([0, 1, 2], dtype=numpy.float32))
+        stats.add(numpy.array([1, numpy.inf, -numpy.inf, numpy.nan], dtype=numpy.float32))
+        self.assertEqual((stats.count, stats.nan_count, stats.inf_count), (4, 1, 2))
+        self.assertEqual((stats.min, stats.max, stats.mean), (0.0, 2.0, 1.0))
+        self.assertEqual(stats.hist_range, (0.0, 2.0))
+        self.assertEqual(stats.display_range(0), (0.5, 2.0))
+        self.assertEqual(stats.valid_fraction, 4 / 7)
+
+    def test_amplitude_mask_and_display_setting(self):
+        amp = numpy.abs(self.data)
+        amp[:5] = 0
+        stats = BufferStatistics.for_buffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED, is_amp=True)
+        stats.update(amp)
+        self.assertEqual(stats.masked_count, 5 * 40)
+        setting = stats.apply_to_display_setting(cuda_holo.HoloDisplaySetting())
+        bin_width = (stats.hist_range[1] - stats.hist_range[0]) / stats.histogram.size
+        self.assertAlmostEqual(setting.max_for_scale, float(numpy.percentile(amp[5:], 99)), delta=bin_width)
+        self.assertAlmostEqual(stats.display_range(0)[1], float(amp.max()), delta=bin_width)
+
+    def test_automatic_range_grows_with_the_data(self):
+        data = self.data.astype(numpy.float64) * 10
+        data[30:] += 100
+        stats = BufferStatistics.for_buffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED, is_amp=False, bins=32)
+        for rows in (10, 30, 50):
+            stats.update(data, rows)
+        low, high = stats.hist_range
+        self.assertLessEqual(low, data.min())
+        self.assertGreaterEqual(high, data.max())
+        single = BufferStatistics(stats.hist_range, bins=32)
+        single.update(data)
+        self.assertEqual(int(stats.histogram.sum()), data.size)
+        self.assertLessEqual(int(numpy.abs(numpy.cumsum(stats.histogram - single.histogram)).max()), 1)
+        self.assertLess(stats.percentile(0.5), 40)
+        fixed = BufferStatistics.for_buffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_RAW, False, hist_range=(0, 1))
+        self.assertEqual(fixed.hist_range, (0.0, 1.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
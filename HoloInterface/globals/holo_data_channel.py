@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Framing of result buffers on the data channel.
+
+Every payload is announced by a single json line (SENDING_MEASUREMENT, the buffer description and
+the number of bytes to expect) followed by the raw pixel data. Buffer descriptions with a ROI and/or
+decimation are sent as that part of the frame only, band by band, without copying the full frame.
+If the description requests a codec, the payload is the sequence of compressed chunks whose sizes are
+listed in the header.
+"""
+
+import json
+import socket
+import threading
+import unittest
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.holo_buffer_codec as holo_codec
+import globals.holo_tcp_globals as holo_dll
+from globals.holo_result_buffer import ResultBuffer
+
+# Keylist.csv keys for the size of (resampled) result images, reused to describe the payload layout:
+KEY_WIDTH_RESULT = "width_result_image"
+KEY_HEIGHT_RESULT = "height_result_image"
+KEY_DATA_TYPE = "data_type"
+
+MAX_HEADER_BYTES = 1 << 16
+
+
+def byte_keys_to_strings(json_ob: dict):
+    """convert a dictionary's keys from bytes to strings, recursively."""
+    ret = {}
+    if isinstance(json_ob, dict):
+        for key, val in json_ob.items():
+            if isinstance(key, bytes):
+                key = key.decode()
+            if isinstance(val, dict):
+                val = byte_keys_to_strings(val)
+            elif isinstance(val, (tuple, list, set)):
+                val = [byte_keys_to_strings(x) for x in val]
+            ret[key] = val
+        return ret
+    elif isinstance(json_ob, (tuple, list, set)):
+        val = [byte_keys_to_strings(x) for x in json_ob]  # recurse elements
+        return val
+    else:
+        return json_ob
+
+
+def read_header(sock: socket.socket) -> dict:
+    """Read one newline-terminated json header. Reads byte-wise, so no payload byte is consumed."""
+    line = bytearray()
+    while True:
+        char = sock.recv(1)
+        if not char:
+            raise ConnectionError("data channel closed while reading header")
+        if char == b"\n":
+            return json.loads(line.decode())
+        line += char
+        if len(line) > MAX_HEADER_BYTES:
+            raise ValueError("data channel: header too long, stream out of sync?")
+
+
+def send_buffer(sock: socket.socket, description: ResultBuffer, frame: numpy.ndarray, band_rows=256):
+    """Send the part of frame selected by the description's roi and decimation."""
+    rows, cols = description.roi_slices(frame.shape)
+    part = frame[rows, cols]  # a view, nothing copied yet
+    header = {holo_dll.KeysServerToClient().command: holo_dll.ServerToClientCommand.SENDING_MEASUREMENT.value,
+              holo_dll.KeysSendingMeasurement().buffer_desc: description.to_jso(),
+              holo_dll.KeysSendingMeasurement().bytes_to_expect: part.nbytes,
+              KEY_WIDTH_RESULT: part.shape[1],
+              KEY_HEIGHT_RESULT: part.shape[0],
+              KEY_DATA_TYPE: part.dtype.str}
+    if description.codec is not None:
+        chunks = description.codec.encode(part)
+        header[holo_codec.KEY_CHUNK_BYTES] = [len(chunk) for chunk in chunks]
+        header[holo_dll.KeysSendingMeasurement().bytes_to_expect] = sum(header[holo_codec.KEY_CHUNK_BYTES])
+    sock.sendall(json.dumps(byte_keys_to_strings(header)).encode() + b"\n")
+    if description.codec is not None:
+        for chunk in chunks:
+            sock.sendall(chunk)
+        return
+    for start in range(0, part.shape[0], band_rows):
+        sock.sendall(numpy.ascontiguousarray(part[start:start + band_rows]).data)
+
+
+def receive_buffer(sock: socket.socket, preview_levels=None) -> ResultBuffer:
+    """Receive one announced buffer; only the transferred (roi, decimated) part is allocated."""
+    header = read_header(sock)
+    command = header.get(holo_dll.KeysServerToClient().command.decode())
+    if command != holo_dll.ServerToClientCommand.SENDING_MEASUREMENT:
+        raise ValueError(f"data channel: expected SENDING_MEASUREMENT, got command {command}")
+    buffer = ResultBuffer()
+    buffer.from_jso(header[holo_dll.KeysSendingMeasurement().buffer_desc.decode()])
+    shape = (int(header[KEY_HEIGHT_RESULT]), int(header[KEY_WIDTH_RESULT]))
+    buffer.allocate(shape, numpy.dtype(header[KEY_DATA_TYPE]), preview_levels=preview_levels)
+    if buffer.codec is not None:
+        # the sender echoes the codec it actually used; without one the payload is raw
+        buffer.receive_encoded(sock, header[holo_codec.KEY_CHUNK_BYTES])
+    else:
+        buffer.receive_data(sock, int(header[holo_dll.KeysSendingMeasurement().bytes_to_expect.decode()]))
+    return buffer
+
+
+class TestDataChannel(unittest.TestCase):
+    frame = numpy.arange(300 * 200, dtype=numpy.float32).reshape(300, 200)
+
+    def transfer(self, description):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            thread = threading.Thread(target=send_buffer, args=(sender, description, self.frame, 7))
+            thread.start()
+            received = receive_buffer(receiver, preview_levels=0)
+            thread.join()
+        return received
+
+    def test_full_frame(self):
+        received = self.transfer(ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED))
+        numpy.testing.assert_array_equal(received.data, self.frame)
+
+    def test_roi_with_decimation(self):
+        description = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED, is_amp=True,
+                                   roi=(10, 20, 50, 30), decimation=4)
+        received = self.transfer(description)
+        numpy.testing.assert_array_equal(received.data, self.frame[20:50:4, 10:60:4])
+        self.assertEqual(received.roi, description.roi)
+        self.assertTrue(received.is_amp)
+
+    def test_compressed_roi(self):
+        description = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED, roi=(0, 10, 200, 100),
+                                   codec=holo_codec.BufferCodec(chunk_rows=16))
+        received = self.transfer(description)
+        numpy.testing.assert_array_equal(received.data, self.frame[10:110])
+        self.assertEqual(received.codec, description.codec)
+
+
+if __name__ == "__main__":
+    unittest.main()
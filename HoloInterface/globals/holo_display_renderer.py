@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+CPU renderer for 8 bit display images of result buffers (cv_conversions toPhase / toAmp / toLogAmp).
+
+Values are clipped to the display range, mapped to an index into a precomputed lookup table and
+looked up, all in place on per-thread scratch buffers. Bands of rows are rendered in parallel,
+rotations are returned as views of the rendered image.
+"""
+
+import math
+import os
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+
+DEFAULT_LUT_SIZE = 1 << 16  # indices fit into uint16
+
+
+def rotated_view(data: numpy.ndarray, rotation: cuda_holo.RotationMethods) -> numpy.ndarray:
+    """RotationMethods as a strided view (counter-clockwise, like numpy.rot90); nothing is copied."""
+    return numpy.rot90(data, k=int(cuda_holo.RotationMethods(rotation)), axes=(0, 1))
+
+
+def build_lut(conversion: cuda_holo.cv_conversions, low, high, size=DEFAULT_LUT_SIZE) -> numpy.ndarray:
+    """Gray values for size input values evenly spaced from low to high."""
+    values = numpy.linspace(low, high, size)
+    if conversion == cuda_holo.cv_conversions.toLogAmp:
+        values = numpy.log1p(values - low)  # log scale from the lower display limit upwards
+        low, high = 0.0, values[-1]
+        if high <= 0:
+            high = 1.0
+    scaled = (values - low) * (255.0 / (high - low)) if high > low else numpy.zeros_like(values)
+    return numpy.clip(numpy.rint(scaled), 0, 255).astype(numpy.uint8)
+
+
+class DisplayRenderer:
+    """
+    Renders complex or float buffers to uint8 images.
+
+    The display range is taken from HoloDisplaySetting.min_for_scale / max_for_scale. If both are 0
+    (the default), phases use [-pi, pi] and amplitudes the range of the rendered buffer (or of
+    BufferStatistics passed to render()). Masked (NaN) pixels are rendered as the lower limit.
+    """
+
+    def __init__(self, conversion=cuda_holo.cv_conversions.toPhase,
+                 setting: cuda_holo.HoloDisplaySetting = None,
+                 rotation=cuda_holo.RotationMethods.rotate_0,
+                 lut_size=DEFAULT_LUT_SIZE, band_rows=128, workers=None):
+        if lut_size > DEFAULT_LUT_SIZE:
+            raise ValueError(f"DisplayRenderer: lut_size must be <= {DEFAULT_LUT_SIZE}")
+        self.conversion = cuda_holo.cv_conversions(conversion)
+        self.setting = setting if setting is not None else cuda_holo.HoloDisplaySetting()
+        self.rotation = rotation
+        self.lut_size = lut_size
+        self.band_rows = band_rows
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self._lut_key = None
+        self._lut = None
+        self._scratch = threading.local()
+        self._pool = None
+
+    @classmethod
+    def for_setting(cls, setting: cuda_holo.HoloDisplaySetting, **kwargs):
+        """Phase or amplitude display, as selected by setting.display_phase."""
+        conversion = cuda_holo.cv_conversions.toPhase if setting.display_phase else cuda_holo.cv_conversions.toAmp
+        return cls(conversion, setting, **kwargs)
+
+    def display_range(self, data: numpy.ndarray, stats=None):
+        low, high = float(self.setting.min_for_scale), float(self.setting.max_for_scale)
+        if low != high:
+            return low, high
+        if self.conversion == cuda_holo.cv_conversions.toPhase:
+            return -math.pi, math.pi
+        if stats is not None:
+            return stats.display_range()
+        values = numpy.abs(data) if numpy.iscomplexobj(data) else data
+        return float(numpy.nanmin(values)), float(numpy.nanmax(values))
+
+    def lut(self, low, high) -> numpy.ndarray:
+        """Lookup table for the range; rebuilt only if conversion or range changed."""
+        key = (self.conversion, low, high, self.lut_size)
+        if key != self._lut_key:
+            self._lut = build_lut(self.conversion, low, high, self.lut_size)
+            self._lut_key = key
+        return self._lut
+
+    def _buffers(self, shape):
+        scratch = self._scratch
+        if getattr(scratch, "shape", None) != shape:
+            scratch.values = numpy.empty(shape, dtype=numpy.float32)
+            scratch.idx = numpy.empty(shape, dtype=numpy.uint16)
+            scratch.shape = shape
+        return scratch.values, scratch.idx
+
+    def _render_band(self, band: numpy.ndarray, out: numpy.ndarray, low, high, lut):
+        values, idx = self._buffers(band.shape)
+        if numpy.iscomplexobj(band):
+            if self.conversion == cuda_holo.cv_conversions.toPhase:
+                numpy.arctan2(band.imag, band.real, out=values)
+            else:
+                numpy.absolute(band, out=values)
+        elif self.conversion in (cuda_holo.cv_conversions.toAmp, cuda_holo.cv_conversions.toLogAmp):
+            numpy.absolute(band, out=values, casting="unsafe")
+        else:
+            numpy.copyto(values, band, casting="unsafe")
+        # fmax/fmin replace NaN by the limits as a side effect of clipping
+        numpy.fmax(values, low, out=values)
+        numpy.fmin(values, high, out=values)
+        values -= low
+        values *= (self.lut_size - 1) / (high - low) if high > low else 0.0
+        numpy.copyto(idx, values, casting="unsafe")
+        numpy.take(lut, idx, out=out)
+
+    def render(self, data: numpy.ndarray, out: numpy.ndarray = None, stats=None) -> numpy.ndarray:
+        """Render data (h×w) to uint8; returns the rotated view of out (allocated if None, h×w)."""
+        low, high = self.display_range(data, stats)
+        lut = self.lut(low, high)
+        if out is None:
+            out = numpy.empty(data.shape[:2], dtype=numpy.uint8)
+        bands = [slice(start, start + self.band_rows) for start in range(0, data.shape[0], self.band_rows)]
+        if self.workers > 1 and len(bands) > 1:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="DisplayRenderer")
+            for future in [self._pool.submit(self._render_band, data[b], out[b], low, high, lut) for b in bands]:
+                future.result()
+        else:
+            for b in bands:
+                self._render_band(data[b], out[b], low, high, lut)
+        return rotated_view(out, self.rotation)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+class TestDisplayRenderer(unittest.TestCase):
+    rng = numpy.random.default_rng(3)
+    field = (rng.rayleigh(1.0, (300, 200)) * numpy.exp(1j * rng.uniform(-3, 3, (300, 200)))).astype(numpy.complex64)
+
+    def test_phase_matches_direct_scaling(self):
+        renderer = DisplayRenderer(cuda_holo.cv_conversions.toPhase, band_rows=64, workers=3)
+        image = renderer.render(self.field)
+        expected = numpy.rint((numpy.angle(self.field) + math.pi) * 255 / (2 * math.pi))
+        self.assertLessEqual(numpy.abs(image.astype(int) - expected).max(), 1)
+        renderer.close()
+
+    def test_amplitude_with_setting_and_nan(self):
+        setting = cuda_holo.HoloDisplaySetting()
+        setting.min_for_scale, setting.max_for_scale = 0.5, 2.0
+        amp = numpy.abs(self.field)
+        amp[0, 0] = numpy.nan
+        image = DisplayRenderer(cuda_holo.cv_conversions.toAmp, setting, workers=1).render(amp)
+        self.assertEqual(image[0, 0], 0)
+        self.assertEqual(image[amp >= 2.0].min(), 255)
+        self.assertEqual(image[amp <= 0.5].max(), 0)
+
+    def test_rotation_is_a_view(self):
+        renderer = DisplayRenderer(cuda_holo.cv_conversions.toLogAmp, rotation=cuda_holo.RotationMethods.rotate_90,
+                                   workers=1)
+        out = numpy.empty((300, 200), dtype=numpy.uint8)
+        image = renderer.render(self.field, out=out)
+        self.assertEqual(image.shape, (200, 300))
+        self.assertTrue(numpy.shares_memory(image, out))
+        numpy.testing.assert_array_equal(image, numpy.rot90(out))
+
+
+if __name__ == "__main__":
+    unittest.main()
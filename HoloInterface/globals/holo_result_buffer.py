@@ -5,15 +5,44 @@ Created on 04.09.2020
 @author: beckmann
 """
 
+import os
+import socket
+import tempfile
 import unittest
 import warnings
-from typing import Union
+from typing import List, Tuple, Union
 
 import numpy
 
 import globals.cuda_holo_definitions as cuda_holo
+import globals.holo_buffer_codec as holo_codec
+import globals.holo_buffer_pyramid as holo_pyramid
+import globals.holo_buffer_stats as holo_stats
 import globals.holo_tcp_globals as holo_dll
 
+class KeysBufferDescOptional:
+    """Optional keys of a buffer description for partial / compressed transfers (not part of holo_tcp_globals.h)"""
+    roi = b"roi"
+    decimation = b"decimation"
+    codec = b"codec"
+
+
+def roi_as_tuple(roi) -> Union[None, Tuple[int, int, int, int]]:
+    """
+    Normalize a region of interest to (x, y, w, h) of its top left corner.
+    Accepts None, a cuda_holo.rect, a (center based) cuda_holo.HoloArea or an (x, y, w, h) sequence.
+    """
+    if roi is None:
+        return None
+    if isinstance(roi, cuda_holo.HoloArea):
+        return (int(roi.x_center) - int(roi.width) // 2, int(roi.y_center) - int(roi.height) // 2,
+                int(roi.width), int(roi.height))
+    if isinstance(roi, cuda_holo.rect):
+        return roi.x, roi.y, roi.w, roi.h
+    x, y, w, h = (int(v) for v in roi)
+    return x, y, w, h
+
+
 class CvImageBuffer:
     """
     Class for opencv result images
@@ -30,18 +59,32 @@ class ResultBuffer:
     Resultbuffer (or its description, if data is None)
     """
 
+    # derived from data while receiving; not part of the identity used by __eq__ and __hash__
+    DERIVED_MEMBERS = ("pyramid", "stats", "rows_filled")
+
     def __init__(self, step: cuda_holo.ProcessingStep=None,
                  laser_nr=0,
                  img_nr=0,
                  is_amp=False,
                  data: Union[None, numpy.array] = None,
-                 measurement_id=0):
+                 measurement_id=0,
+                 roi=None,
+                 decimation=1,
+                 codec: Union[None, holo_codec.BufferCodec] = None):
         self.processing_step = step
         self.laser_nr = laser_nr
         self.img_nr = img_nr
         self.is_amp = is_amp
         self.data = data
         self.measurement_id = measurement_id
+        # (x, y, w, h) in full-frame pixels; None requests the whole buffer. Stored as tuple to keep
+        # descriptions hashable and comparable.
+        self.roi = roi_as_tuple(roi)
+        self.decimation = decimation
+        self.codec = codec
+        self.pyramid = None
+        self.stats = None
+        self.rows_filled = None  # rows of data received so far; None if data is complete
 
     def __repr__(self):
         rep = f"<ResultBuffer: {self.processing_step.name}"
@@ -55,22 +98,33 @@ class ResultBuffer:
             rep += ", amplitude"
         if self.measurement_id is not None:
             rep += f", measurement_id {self.measurement_id}"
+        if self.roi is not None:
+            rep += ", ROI {2}×{3}@({0}, {1})".format(*self.roi)
+        if self.decimation != 1:
+            rep += f", decimation {self.decimation}"
+        if self.codec is not None:
+            rep += f", {self.codec}"
         return rep + ">"
 
     def __eq__(self, other):
         # TBe: if kind of __eq__ and __hash__ are ever needed for another class, pull them into superclass and inherit.
         same_type = isinstance(other, self.__class__)
-        same_members = self.__dict__ == other.__dict__
-        return same_type and same_members
+        return same_type and self._identity() == other._identity()
 
     def __hash__(self):
         # for set membership test, see
         # https://stackoverflow.com/questions/15326985/how-to-implement-eq-for-set-inclusion-test
         # https://stackoverflow.com/questions/390250/elegant-ways-to-support-equivalence-equality-in-python-classes
-        return hash(tuple(sorted(self.__dict__.items())))
+        return hash(tuple(sorted(self._identity().items())))
+
+    def _identity(self) -> dict:
+        return {key: value for key, value in self.__dict__.items() if key not in self.DERIVED_MEMBERS}
 
     def from_jso(self, jso):
         keys = holo_dll.KeysBufferDesc()
+        keys_opt = KeysBufferDescOptional()
+        # parsed json has str keys, the Keys* structs hold bytes:
+        jso = {k.encode() if isinstance(k, str) else k: v for k, v in jso.items()}
 
         if keys.processing_step in jso:
             proc_step_code = jso[keys.processing_step]
@@ -83,6 +137,14 @@ class ResultBuffer:
         self.img_nr = int(jso[keys.img_nr]) if keys.img_nr in jso else None
         self.is_amp = bool(jso[keys.is_amp]) if keys.is_amp in jso else None
         self.measurement_id = int(jso[keys.meas_id]) if keys.meas_id in jso else None
+        if jso.get(keys_opt.roi) is not None:
+            roi = jso[keys_opt.roi]
+            self.roi = roi_as_tuple(roi[k] for k in ("x", "y", "w", "h"))
+        else:
+            self.roi = None
+        self.decimation = int(jso.get(keys_opt.decimation, 1))
+        codec = jso.get(keys_opt.codec)
+        self.codec = holo_codec.BufferCodec.from_jso(codec) if codec is not None else None
 
     def to_jso(self):
         """return a json-dict, e.g. for sending to holo_software"""
@@ -93,8 +155,143 @@ class ResultBuffer:
                keys.is_amp: self.is_amp,
                keys.meas_id: self.measurement_id}
 
+        # partial transfer keys only when used, so plain requests stay unchanged for the holo_software:
+        keys_opt = KeysBufferDescOptional()
+        if self.roi is not None:
+            jso[keys_opt.roi] = dict(zip(("x", "y", "w", "h"), self.roi))
+        if self.decimation != 1:
+            jso[keys_opt.decimation] = self.decimation
+        if self.codec is not None:
+            jso[keys_opt.codec] = self.codec.to_jso()
+
         return jso
 
+    def roi_slices(self, full_shape) -> Tuple[slice, slice]:
+        """(row, column) slices selecting roi and decimation from a full frame, clipped to the frame."""
+        if self.decimation < 1:
+            raise ValueError(f"ResultBuffer: decimation must be >= 1, got {self.decimation}")
+        if self.roi is None:
+            return slice(0, full_shape[0], self.decimation), slice(0, full_shape[1], self.decimation)
+        x, y, w, h = self.roi
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, full_shape[1]), min(y + h, full_shape[0])
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError(f"ResultBuffer: ROI {self.roi} outside of frame {full_shape[1]}×{full_shape[0]}")
+        return slice(y0, y1, self.decimation), slice(x0, x1, self.decimation)
+
+    def transfer_shape(self, full_shape) -> Tuple[int, int]:
+        """Shape of the data actually transferred for a frame of full_shape."""
+        rows, cols = self.roi_slices(full_shape)
+        return len(range(*rows.indices(full_shape[0]))), len(range(*cols.indices(full_shape[1])))
+
+    def allocate(self, shape, dtype, preview_levels=None, binning_method=holo_pyramid.BINNING_MEAN,
+                 statistics: Union[bool, holo_stats.BufferStatistics] = True):
+        """
+        Allocate data for receiving, with its preview pyramid (unless preview_levels is 0) and
+        statistics (pass a BufferStatistics to choose histogram range or mask value).
+        """
+        self.data = numpy.empty(shape, dtype=dtype)
+        self.rows_filled = 0
+        if preview_levels == 0:
+            self.pyramid = None
+        else:
+            self.pyramid = holo_pyramid.BufferPyramid(shape, dtype, num_levels=preview_levels,
+                                                      method=binning_method)
+        if statistics is True:
+            self.stats = holo_stats.BufferStatistics.for_buffer(self.processing_step, self.is_amp)
+        else:
+            self.stats = statistics or None
+
+    def receive_data(self, sock: socket.socket, bytes_to_expect: int, chunk_bytes=1 << 20):
+        """
+        Read a SENDING_MEASUREMENT payload from sock into the allocated data.
+        Previews are updated as rows arrive; surplus bytes after the image are read and dropped.
+        """
+        if self.data is None:
+            raise ValueError("ResultBuffer: allocate() data before receiving")
+        target = memoryview(self.data.reshape(-1).view(numpy.uint8))
+        if bytes_to_expect < target.nbytes:
+            raise ValueError(f"ResultBuffer: {bytes_to_expect} bytes announced, "
+                             f"but {self!r} needs {target.nbytes}")
+        row_bytes = target.nbytes // self.data.shape[0]
+        received = 0
+        while received < target.nbytes:
+            n = sock.recv_into(target[received:received + chunk_bytes])
+            if n == 0:
+                raise ConnectionError(f"ResultBuffer: connection closed after {received} of {bytes_to_expect} bytes")
+            received += n
+            self._rows_arrived(received // row_bytes)
+        surplus = bytes_to_expect - received
+        while surplus > 0:
+            n = len(sock.recv(min(surplus, chunk_bytes)))
+            if n == 0:
+                raise ConnectionError("ResultBuffer: connection closed while draining surplus bytes")
+            surplus -= n
+
+    def receive_encoded(self, sock: socket.socket, chunk_bytes: List[int]):
+        """Read and decode the chunks of a payload sent with self.codec into the allocated data."""
+        def chunks():
+            for size in chunk_bytes:
+                chunk = bytearray(size)
+                view, received = memoryview(chunk), 0
+                while received < size:
+                    n = sock.recv_into(view[received:])
+                    if n == 0:
+                        raise ConnectionError("ResultBuffer: connection closed during encoded payload")
+                    received += n
+                yield bytes(chunk)
+
+        self.codec.decode_into(chunks(), self.data, self._rows_arrived)
+
+    def save(self, path, codec: Union[None, holo_codec.BufferCodec] = None):
+        """Store description and data in a single file, compressed with codec (default: self.codec or zlib)."""
+        codec = codec or self.codec or holo_codec.BufferCodec()
+        chunks = codec.encode(self.data)
+        desc = self.to_jso()
+        desc[KeysBufferDescOptional().codec] = codec.to_jso()
+        header = {"buffer description": {k.decode(): v for k, v in desc.items()},
+                  "shape": list(self.data.shape), "dtype": self.data.dtype.str,
+                  holo_codec.KEY_CHUNK_BYTES: [len(c) for c in chunks]}
+        with open(path, "wb") as f:
+            holo_codec.write_file_header(f, header)
+            for chunk in chunks:
+                f.write(chunk)
+
+    @classmethod
+    def load(cls, path, preview_levels=0):
+        """Counterpart to save(); the returned buffer's codec is the one it was stored with."""
+        with open(path, "rb") as f:
+            header = holo_codec.read_file_header(f)
+            buffer = cls()
+            buffer.from_jso(header["buffer description"])
+            buffer.allocate(tuple(header["shape"]), numpy.dtype(header["dtype"]), preview_levels)
+            buffer.codec.decode_into((f.read(size) for size in header[holo_codec.KEY_CHUNK_BYTES]), buffer.data,
+                                     buffer._rows_arrived)
+        return buffer
+
+    def _rows_arrived(self, rows_filled):
+        # called with the received rows still in cache; every consumer only handles the new rows
+        self.rows_filled = rows_filled
+        if self.pyramid is not None:
+            self.pyramid.update(self.data, rows_filled)
+        if self.stats is not None:
+            self.stats.update(self.data, rows_filled)
+
+    def get_preview(self, level=1) -> numpy.ndarray:
+        """
+        Data binned by 2**level; level 0 is the full buffer. Builds the pyramid if missing, from the
+        rows received so far (rows not yet arrived are undefined).
+        """
+        if level == 0:
+            return self.data
+        if self.pyramid is None or self.pyramid.num_levels < level:
+            self.pyramid = holo_pyramid.BufferPyramid(self.data.shape, self.data.dtype, num_levels=level,
+                                                      method=self.pyramid.method if self.pyramid
+                                                      else holo_pyramid.BINNING_MEAN)
+        if not self.pyramid.complete:
+            self.pyramid.update(self.data, self.rows_filled)
+        return self.pyramid.get_level(level)
+
 
 class TestBufferComparison(unittest.TestCase):
     buffer_syn_phs = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED)
@@ -116,6 +313,78 @@ class TestBufferComparison(unittest.TestCase):
         # ...but should be "in" set by comparison (__hash__ and __eq__):
         self.assertTrue(self.buffer_syn_phs_2 in sample_set)
 
+    def test_previews_and_statistics_keep_identity(self):
+        buffer = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED)
+        sample_set = {buffer}
+        buffer.pyramid = holo_pyramid.BufferPyramid((8, 8), numpy.float32, num_levels=1)
+        buffer.stats = holo_stats.BufferStatistics()
+        self.assertEqual(buffer, self.buffer_syn_phs_2)
+        self.assertEqual(hash(buffer), hash(self.buffer_syn_phs_2))
+        self.assertIn(buffer, sample_set)
+
+
+class TestBufferRoi(unittest.TestCase):
+    def test_jso_round_trip(self):
+        area = cuda_holo.HoloArea()
+        area.x_center, area.y_center, area.width, area.height = 100, 50, 20, 10
+        buffer = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED, roi=area, decimation=2)
+        parsed = ResultBuffer()
+        parsed.from_jso({k.decode(): v for k, v in buffer.to_jso().items()})
+        self.assertEqual(parsed, buffer)
+        self.assertEqual(parsed.roi, (90, 45, 20, 10))
+
+    def test_plain_description_unchanged(self):
+        jso = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED).to_jso()
+        self.assertEqual(len(jso), 5)
+
+    def test_clipped_decimated_shape(self):
+        buffer = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED, roi=(90, -5, 20, 15), decimation=3)
+        self.assertEqual(buffer.roi_slices((100, 100)), (slice(0, 10, 3), slice(90, 100, 3)))
+        self.assertEqual(buffer.transfer_shape((100, 100)), (4, 4))
+
+
+class TestBufferFile(unittest.TestCase):
+    def test_save_load(self):
+        data = numpy.linspace(0, 1, 40 * 30, dtype=numpy.float32).reshape(40, 30)
+        buffer = ResultBuffer(cuda_holo.ProcessingStep.STEP_CONVERTED_TO_HEIGHT, data=data)
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "height.holobuf")
+            buffer.save(path, holo_codec.BufferCodec(holo_codec.CODEC_LZMA, chunk_rows=16))
+            loaded = ResultBuffer.load(path)
+        numpy.testing.assert_array_equal(loaded.data, data)
+        self.assertEqual(loaded.processing_step, buffer.processing_step)
+        self.assertEqual(loaded.codec.name, holo_codec.CODEC_LZMA)
+
+
+class TestBufferReceive(unittest.TestCase):
+    def test_receive_builds_previews(self):
+        image = numpy.random.default_rng(0).random((64, 96), dtype=numpy.float32)
+        buffer = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED)
+        buffer.allocate(image.shape, image.dtype, preview_levels=2)
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.sendall(image.tobytes() + b"\0" * 4)
+            buffer.receive_data(receiver, image.nbytes + 4, chunk_bytes=1000)
+        numpy.testing.assert_array_equal(buffer.data, image)
+        self.assertTrue(buffer.pyramid.complete)
+        numpy.testing.assert_allclose(buffer.get_preview(2), image.reshape(16, 4, 24, 4).mean(axis=(1, 3)),
+                                      rtol=1e-6)
+        self.assertEqual(buffer.stats.count, image.size)
+        self.assertAlmostEqual(buffer.stats.mean, float(image.mean(dtype=numpy.float64)), places=6)
+
+    def test_preview_bins_only_received_rows(self):
+        image = numpy.ones((64, 96), dtype=numpy.float32)
+        buffer = ResultBuffer(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED)
+        buffer.allocate(image.shape, image.dtype, preview_levels=1)
+        buffer.data[:] = numpy.nan
+        buffer.data[:20] = image[:20]
+        buffer._rows_arrived(20)
+        self.assertEqual(buffer.get_preview(2)[:5].tolist(), numpy.ones((5, 24)).tolist())
+        self.assertEqual(buffer.pyramid.rows_done, [10, 5])
+        buffer.data[20:] = image[20:]
+        buffer._rows_arrived(64)
+        numpy.testing.assert_array_equal(buffer.get_preview(2), numpy.ones((16, 24)))
+
 
 if __name__ == "__main__":
     unittest.main()
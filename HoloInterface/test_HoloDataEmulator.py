@@ -0,0 +1,58 @@
+'''
+Test ROI-limited retrieval through the HoloDataEmulator
+Date - 2026-10-19
+Coding: utf-8
+'''
+
+import json
+import socket
+import threading
+import unittest
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.holo_tcp_globals as holo_dll
+from globals.holo_data_channel import byte_keys_to_strings, read_header, receive_buffer
+from globals.holo_result_buffer import ResultBuffer
+from HoloDataEmulator import HoloDataEmulator, synthetic_frame
+
+
+class TestHoloDataEmulator(unittest.TestCase):
+    '''Request full and ROI buffers like InterfaceTcpClient.slot_request_measurement does'''
+    def setUp(self):
+        self.shape = (400, 500)
+        self.emulator = HoloDataEmulator(port=0, frame_source=lambda desc: synthetic_frame(desc, self.shape))
+        self.thread = threading.Thread(target=self.emulator.serve_forever, daemon=True)
+        self.thread.start()
+        self.sock = socket.create_connection(self.emulator.server_address)
+
+    def tearDown(self):
+        self.sock.close()
+        self.emulator.shutdown()
+        self.emulator.server_close()
+
+    def request(self, buffers):
+        json_ob = {holo_dll.KeysClientToServer().command: holo_dll.ClientToServerCommand.START_ACQUISITION.value,
+                   holo_dll.KeysStartAcq().buffers_to_return: [b.to_jso() for b in buffers]}
+        self.sock.sendall(json.dumps(byte_keys_to_strings(json_ob)).encode())
+        received = [receive_buffer(self.sock, preview_levels=0) for _ in buffers]
+        ready = read_header(self.sock)
+        self.assertEqual(ready[holo_dll.KeysFunctionReady().KEY_FUNCTION_ID.decode()], 110)
+        return received
+
+    def test_roi_and_full_buffer(self):
+        step = cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED
+        roi_buffer = ResultBuffer(step, roi=(100, 50, 64, 32), decimation=2)
+        full_amp = ResultBuffer(step, is_amp=True)
+        roi_received, full_received = self.request([roi_buffer, full_amp])
+
+        self.assertEqual(roi_received.data.shape, (16, 32))
+        numpy.testing.assert_array_equal(roi_received.data,
+                                         synthetic_frame(roi_buffer, self.shape)[50:82:2, 100:164:2])
+        self.assertEqual(full_received.data.shape, self.shape)
+        self.assertTrue(full_received.is_amp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1136 @@
+'''
+Tests of the CPU reference engines in cpu_holo against direct NumPy evaluations
+Date - 2026-10-19
+Coding: utf-8
+'''
+
+import copy
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy
+
+import globals.cuda_holo_definitions as cuda_holo
+import globals.holo_tcp_globals as holo_dll
+import globals.IPM_Holo_Globals as holo_globals
+from cpu_holo import (autofocus, background, dispersion, filters, flatness_correction, height_conversion, masks,
+                      measurement_json, multi_plane, noise_reduction, offset_compensation, phase_shifting, pipeline,
+                      propagation, raw_quality, settings_fingerprint, shape_from_focus, spatial_phase_shifting,
+                      synthetic_wavelengths, tiled_evaluation, tiles, tilt)
+from cpu_holo.cache import ArrayCache
+from globals.holo_result_buffer import roi_as_tuple
+
+
+def phase_shifted_stack(phases, steps, rng, background=2000.0, modulation=1500.0):
+    '''Raw camera stack (laser-major) for the given phases (lasers × h × w) and steps per laser'''
+    images = []
+    for phase, n in zip(phases, steps):
+        for k in range(n):
+            images.append(background + modulation * numpy.cos(phase + 2 * numpy.pi * k / n))
+    return rng.poisson(numpy.array(images)).astype(numpy.uint16)
+
+
+def tilted_phase(shape, row_freq, col_freq):
+    '''Wrapped phase of a plane wave in rad'''
+    rows, cols = numpy.mgrid[:shape[0], :shape[1]]
+    return numpy.angle(numpy.exp(1j * (row_freq * rows + col_freq * cols)))
+
+
+class TestTiles(unittest.TestCase):
+    def test_bands_cover_frame_with_halo(self):
+        bands = tiles.row_bands(100, band_rows=30, halo=4)
+        self.assertEqual([b.core for b in bands], [slice(0, 30), slice(30, 60), slice(60, 90), slice(90, 100)])
+        self.assertEqual(bands[1].padded, slice(26, 64))
+        self.assertEqual(bands[1].core_in_padded, slice(4, 34))
+        self.assertEqual(tiles.map_row_bands(lambda b: b.stop - b.start, 100, 30, workers=3), [30, 30, 30, 10])
+
+    def test_pool_threads_are_reused(self):
+        def thread(band):
+            nested = tiles.map_row_bands(lambda b: threading.get_ident(), 20, 5, workers=3)
+            self.assertEqual(len(set(nested)), 1)  # serial inside a pool thread
+            return threading.get_ident()
+
+        threads = set()
+        for _ in range(3):
+            threads.update(tiles.map_row_bands(thread, 100, 10, workers=3))
+        self.assertLessEqual(len(threads), 3)
+        self.assertIs(tiles.shared_pool(3), tiles.shared_pool(3))
+
+
+class TestFilters(unittest.TestCase):
+    rng = numpy.random.default_rng(35)
+    data = rng.normal(0, 1, (37, 29)).astype(numpy.float32)
+
+    def test_box_mean_and_median_with_nan(self):
+        data = self.data.copy()
+        data[5, 5] = numpy.nan
+        padded = numpy.pad(data, 2, constant_values=numpy.nan)
+        windows = numpy.lib.stride_tricks.sliding_window_view(padded, (5, 5)).reshape(37, 29, 25)
+        numpy.testing.assert_allclose(filters.box_mean(data, 2), numpy.nanmean(windows, axis=-1), atol=1e-5)
+        numpy.testing.assert_array_equal(filters.median_filter(data, 2, band_rows=8, workers=2),
+                                         numpy.nanmedian(windows, axis=-1))
+
+    def test_open_and_close(self):
+        mask = numpy.zeros((40, 40), dtype=bool)
+        mask[5:25, 5:25] = True
+        mask[30, 30] = True  # speck, removed by opening
+        mask[15, 15] = False  # hole, filled by closing
+        opened = filters.binary_open(mask, 1)
+        self.assertFalse(opened[30, 30])
+        self.assertTrue(opened[6, 6])
+        self.assertTrue(filters.binary_close(mask, 1)[15, 15])
+
+    def test_histogram_median_and_disk_mean(self):
+        radius = 5
+        padded = numpy.pad(self.data, radius, constant_values=numpy.nan)
+        windows = numpy.lib.stride_tricks.sliding_window_view(padded, (11, 11))
+        bin_width = numpy.ptp(self.data) / filters.HISTOGRAM_MEDIAN_BINS
+        numpy.testing.assert_allclose(filters.median_filter(self.data, radius, band_rows=8, workers=2),
+                                      numpy.nanmedian(windows.reshape(37, 29, -1), axis=-1), atol=2 * bin_width)
+        disk = filters.disk_kernel(radius)  # the octagon closest to the disk
+        self.assertAlmostEqual(int(disk.sum()), numpy.pi * radius * radius, delta=radius)
+        numpy.testing.assert_allclose(filters.disk_mean(self.data, radius), numpy.nanmean(windows[..., disk], axis=-1),
+                                      atol=1e-5)
+
+    def test_disk_sum_with_nan_and_cost_independent_of_radius(self):
+        data = self.data.copy()
+        data[3, 4] = numpy.nan
+        for radius in (1, 3, 8, 40):
+            padded = numpy.pad(data, radius, constant_values=numpy.nan)
+            windows = numpy.lib.stride_tricks.sliding_window_view(padded, (2 * radius + 1,) * 2)
+            numpy.testing.assert_allclose(filters.disk_mean(data, radius),
+                                          numpy.nanmean(windows[..., filters.disk_kernel(radius)], axis=-1), atol=1e-5)
+        field = numpy.exp(1j * numpy.random.default_rng(38).normal(0, 1, (256, 256))).astype(numpy.complex64)
+
+        def seconds(radius):
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                filters.disk_mean(field, radius)
+                times.append(time.perf_counter() - start)
+            return min(times)
+
+        self.assertLess(seconds(32), 2 * seconds(2))  # the per row sums took 7 times longer
+
+    def test_histogram_median_ignores_hot_pixel(self):
+        rng = numpy.random.default_rng(38)
+        data = rng.normal(0, 1, (200, 200)).astype(numpy.float32)
+        data[100, 100] = 1000
+        data[150:160, 20:30] = -500  # area whose median lies below the histogram range
+        padded = numpy.pad(data, 5, constant_values=numpy.nan)
+        exact = numpy.nanmedian(numpy.lib.stride_tricks.sliding_window_view(padded, (11, 11)).reshape(200, 200, -1),
+                                axis=-1)
+        low, high = filters.median_value_range(data)
+        self.assertLess(high - low, 6)
+        bin_width = (high - low) / filters.HISTOGRAM_MEDIAN_BINS
+        numpy.testing.assert_allclose(filters.median_filter(data, 5, band_rows=32, workers=2), exact,
+                                      atol=2 * bin_width)
+
+    def test_gauss_from_box_means(self):
+        impulse = numpy.zeros((81, 81), dtype=numpy.float32)
+        impulse[40, 40] = 1
+        response = filters.gauss_filter(impulse, 10)
+        offsets = numpy.arange(81) - 40
+        self.assertAlmostEqual(float(numpy.sqrt((response.sum(axis=0) * offsets ** 2).sum())), 5.0, delta=0.3)
+
+    def test_apply_filter_in_bands_keeps_tilt(self):
+        rows, cols = numpy.mgrid[:100, :120]
+        field = (numpy.exp(1j * (0.8 * cols + 0.3 * rows)) * (1 + 0.2 * self.rng.random((100, 120))))
+        setting = cuda_holo.Filters()
+        setting.filterRadius = setting.filterRadius_median = 5
+        for filter_type in cuda_holo.FilterType:
+            setting.filter_type = filter_type
+            banded = filters.apply_filter(field, setting, band_rows=16, workers=3)
+            single = filters.filter_image(field, setting, tilt=filters.field_tilt(field))
+            numpy.testing.assert_allclose(banded, single, atol=1e-5)
+            phase_error = numpy.angle(banded * numpy.exp(-1j * (0.8 * cols + 0.3 * rows)))
+            self.assertLess(numpy.abs(phase_error).max(), 0.05)
+        setting.flag_tilt_compensated_filtering = False
+        setting.filter_type = cuda_holo.FilterType.mean_filter
+        self.assertLess(numpy.abs(filters.apply_filter(field, setting)).mean(), 0.2)  # the fringes average out
+
+
+class TestPhaseShifting(unittest.TestCase):
+    rng = numpy.random.default_rng(31)
+    phases = numpy.array([tilted_phase((90, 70), 0.1, f) for f in (0.05, 0.2, -0.13)])
+
+    def test_field_for_mixed_step_counts(self):
+        steps = [4, 3, 5]
+        stack = phase_shifted_stack(self.phases, steps, self.rng)
+        field = phase_shifting.temporal_phase_shift(stack, steps, memory_budget=20 * 70 * 4 * 15, workers=2)
+        self.assertEqual(field.shape, (3, 90, 70))
+        self.assertEqual(field.dtype, numpy.complex64)
+        error = numpy.angle(field * numpy.exp(-1j * self.phases))
+        self.assertLess(numpy.abs(error).max(), 0.15)
+        self.assertAlmostEqual(float(numpy.median(numpy.abs(field))), 1500.0, delta=30)
+
+    def test_phase_output_and_measurement_json(self):
+        stack = phase_shifted_stack(self.phases, [4] * 3, self.rng)
+        measurement = json.loads('{"single lasers": {"1": {"num phase steps": 4}, "0": {"num phase steps": 4},'
+                                 '"2": {"num phase steps": 4}}}')
+        self.assertEqual(measurement_json.num_phase_steps(measurement), [4, 4, 4])
+        phase = phase_shifting.field_from_measurement(stack, measurement, out_dtype=numpy.float32, workers=1)
+        self.assertEqual(phase.dtype, numpy.float32)
+        reference = numpy.angle(phase_shifting.temporal_phase_shift(stack, 4))
+        numpy.testing.assert_allclose(phase, reference, atol=1e-5)
+
+    def test_into_non_contiguous_out(self):
+        stack = phase_shifted_stack(self.phases, [4] * 3, self.rng)
+        expected = phase_shifting.temporal_phase_shift(stack, 4)
+        for dtype in (numpy.complex64, numpy.float32):
+            full = numpy.zeros((3, 90, 80), dtype=dtype)
+            out = full[:, :, 5:75]
+            self.assertIs(phase_shifting.temporal_phase_shift(stack, 4, dtype, out=out, memory_budget=1 << 16), out)
+            numpy.testing.assert_allclose(out, expected if dtype == numpy.complex64 else numpy.angle(expected),
+                                          atol=1e-5)
+            self.assertFalse(full[:, :, :5].any() or full[:, :, 75:].any())
+
+    def test_invalid_step_counts(self):
+        stack = numpy.zeros((7, 4, 4), dtype=numpy.uint16)
+        with self.assertRaises(ValueError):
+            phase_shifting.temporal_phase_shift(stack, 4)
+        with self.assertRaises(ValueError):
+            phase_shifting.temporal_phase_shift(stack, [5, 2])
+
+
+class TestSpatialPhaseShifting(unittest.TestCase):
+    shape = (128, 160)
+    carrier = (0.2, 0.125)  # cycles per pixel in x, y
+    rows, cols = numpy.mgrid[:shape[0], :shape[1]]
+    phase = 2 * numpy.pi * (2 * rows / shape[0] - 3 * cols / shape[1])  # periodic, no leakage
+    hologram = (1000 + 600 * numpy.cos(phase + 2 * numpy.pi * (carrier[0] * cols + carrier[1] * rows))
+                ).astype(numpy.float32)
+    window = spatial_phase_shifting.SPSWindow(carrier[0], carrier[1], 0.15, 0.15)
+
+    def test_full_resolution_field(self):
+        field = spatial_phase_shifting.spatial_phase_shift(self.hologram, self.window, cache=ArrayCache())
+        self.assertEqual(field.shape, self.shape)
+        core = (slice(10, -10), slice(10, -10))
+        error = numpy.angle(field[core] * numpy.exp(-1j * self.phase[core]))
+        self.assertLess(numpy.abs(error).max(), 0.02)
+        self.assertAlmostEqual(float(numpy.median(numpy.abs(field[core]))), 600, delta=10)
+        mirrored = spatial_phase_shifting.SPSWindow(-self.carrier[0], -self.carrier[1], 0.15, 0.15)
+        mirrored_field = spatial_phase_shifting.spatial_phase_shift(self.hologram, mirrored, cache=ArrayCache())
+        numpy.testing.assert_allclose(mirrored_field, numpy.conjugate(field), atol=1e-2)
+
+    def test_reference_subtracted_per_frame(self):
+        background = numpy.random.default_rng(47).normal(0, 300, self.shape).astype(numpy.float32)
+        stack = numpy.stack([self.hologram + background] * 2)
+        expected = spatial_phase_shifting.spatial_phase_shift(self.hologram, self.window, cache=ArrayCache())
+        fields = spatial_phase_shifting.spatial_phase_shift(stack, self.window, cache=ArrayCache(),
+                                                            reference=background, workers=2)
+        for field in fields:
+            numpy.testing.assert_allclose(field, expected, atol=0.1)
+        disturbed = spatial_phase_shifting.spatial_phase_shift(stack[0], self.window, cache=ArrayCache())
+        self.assertGreater(numpy.abs(disturbed - expected).max(), 1)
+
+    def test_downsampling_stack_and_cache(self):
+        cache = ArrayCache()
+        modes = cuda_holo.HoloModes()
+        modes.auto_downsampling_SPS = True
+        modes.round_aperture = True
+        stack = numpy.stack([self.hologram, self.hologram[::-1]])
+        fields = spatial_phase_shifting.spatial_phase_shift(stack, self.window, modes, cache=cache, workers=2)
+        self.assertEqual(fields.shape, (2, 21, 25))
+        self.assertEqual((cache.misses, cache.hits), (1, 0))
+        spatial_phase_shifting.spatial_phase_shift(stack, self.window, modes, cache=cache)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        # output pixel (r, c) samples the input at (r * 128 / 21, c * 160 / 25)
+        expected = 2 * numpy.pi * (2 * numpy.arange(21)[:, None] / 21 - 3 * numpy.arange(25)[None, :] / 25)
+        error = numpy.angle(fields[0] * numpy.exp(-1j * expected))
+        self.assertLess(numpy.abs(error).max(), 0.02)
+
+    def test_window_from_measurement(self):
+        measurement = {"single lasers": {"0": {"SPS_angles": {"x": 0.2, "y": 0.1, "width_x": 0.1, "height_y": 0.05}},
+                                         "1": {}}}
+        windows = spatial_phase_shifting.windows_from_measurement(measurement)
+        self.assertEqual(windows, [spatial_phase_shifting.SPSWindow(0.2, 0.1, 0.1, 0.05), None])
+
+
+def gaussian_beam(shape, pixel_m, wavelength_m, distance_m, waist_m=60e-6):
+    '''Paraxial Gaussian beam with its waist at distance 0, sampled around pixel (h // 2, w // 2)'''
+    rows, cols = numpy.mgrid[:shape[0], :shape[1]]
+    r2 = ((rows - shape[0] // 2) ** 2 + (cols - shape[1] // 2) ** 2) * pixel_m ** 2
+    rayleigh = numpy.pi * waist_m ** 2 / wavelength_m
+    q = distance_m - 1j * rayleigh
+    return -1j * rayleigh / q * numpy.exp(1j * numpy.pi * r2 / (wavelength_m * q))
+
+
+class TestPropagation(unittest.TestCase):
+    shape = (160, 141)
+    pixel = 5e-6
+    wavelengths = [633e-9, 780e-9]
+
+    def setUp(self):
+        self.fields = numpy.stack([gaussian_beam(self.shape, self.pixel, w, 0) for w in self.wavelengths])
+
+    def test_methods_match_gaussian_beam(self):
+        for method, magnification in ((propagation.METHOD.propagate_convolution, 1.0),
+                                      (propagation.METHOD.propagate_convolution_scaled, 1.5),
+                                      (propagation.METHOD.propagate_fresnel_2_step, 0.8)):
+            for distance in (0.02, -0.015):
+                out = propagation.propagate(self.fields, self.pixel, self.wavelengths, distance, method,
+                                            magnification, cache=ArrayCache())
+                pixel_out = propagation.output_pixel_m(method, self.pixel, magnification)
+                for field, wavelength in zip(out, self.wavelengths):
+                    expected = gaussian_beam(self.shape, pixel_out, wavelength, distance)
+                    self.assertLess(numpy.abs(field - expected).max(), 1e-3, (method, distance))
+
+    def test_sweep_reuses_kernels(self):
+        cache = ArrayCache()
+        distances = [-0.01, 0.0, 0.01]
+        swept = list(propagation.propagate_distances(self.fields, self.pixel, self.wavelengths, distances,
+                                                     cache=cache))
+        self.assertEqual(cache.misses, 6)
+        for distance, out in swept:
+            direct = propagation.propagate(self.fields, self.pixel, self.wavelengths, distance, cache=cache)
+            numpy.testing.assert_allclose(out, direct, atol=1e-5)
+        self.assertEqual((cache.misses, cache.hits), (6, 4))  # distance 0 is returned unchanged
+
+    def test_cache_cap_is_kept(self):
+        kernel_bytes = propagation.kernel_nbytes(propagation.METHOD.propagate_convolution, self.shape)
+        self.assertEqual(kernel_bytes, self.shape[0] * self.shape[1] * 8)
+        cache = ArrayCache(kernel_bytes)  # one kernel fits, the kernels of both lasers do not
+        cache.get("other", lambda: numpy.zeros(16))
+        expected = propagation.propagate(self.fields, self.pixel, self.wavelengths, 0.01, cache=ArrayCache())
+        for _ in range(2):
+            out = propagation.propagate(self.fields, self.pixel, self.wavelengths, 0.01, cache=cache)
+        numpy.testing.assert_array_equal(out, expected)
+        self.assertEqual((cache.max_bytes, len(cache), cache.misses), (kernel_bytes, 1, 1))  # built uncached
+        cache = ArrayCache(5 * kernel_bytes)  # the kernels of 2 of the 3 distances fit
+        distances = [0.01, 0.02, 0.03]
+        for _ in range(2):
+            for _distance, _out in propagation.propagate_distances(self.fields, self.pixel, self.wavelengths,
+                                                                   distances, cache=cache):
+                pass
+        self.assertEqual((cache.misses, cache.hits, cache.max_bytes), (4, 4, 5 * kernel_bytes))
+        kernels = propagation.propagation_kernels(propagation.METHOD.propagate_fresnel_2_step, self.shape, self.pixel,
+                                                  self.wavelengths[0], 0.01, 0.8, cache=ArrayCache(1 << 16))
+        self.assertLessEqual(kernels.nbytes, 3 * 8 * sum(self.shape))  # separable chirps, one vector per axis
+
+    def test_batch_equals_single_propagations(self):
+        distances = [0.01, 0.02]
+        for method in propagation.METHOD:
+            batch = propagation.propagate_batch(self.fields, self.pixel, self.wavelengths, distances, method, 1.2)
+            for distance, out in zip(distances, batch):
+                single = propagation.propagate(self.fields, self.pixel, self.wavelengths, distance, method, 1.2)
+                numpy.testing.assert_allclose(out, single, atol=1e-5)
+
+    def test_batch_through_distance_zero(self):
+        distances = [-0.01, 0.0, 0.01]
+        batch = propagation.propagate_batch(self.fields, self.pixel, self.wavelengths, distances,
+                                            propagation.METHOD.propagate_fresnel_2_step, cache=ArrayCache())
+        numpy.testing.assert_allclose(batch[1], self.fields, atol=1e-6)
+        single = propagation.propagate(self.fields, self.pixel, self.wavelengths, 0.01,
+                                       propagation.METHOD.propagate_fresnel_2_step)
+        numpy.testing.assert_allclose(batch[2], single, atol=1e-5)
+        with self.assertRaises(ValueError):
+            propagation.PropagationKernels(propagation.METHOD.propagate_fresnel_2_step, self.shape, self.pixel,
+                                           self.wavelengths[0], 0.0, 0.8)
+
+    def test_settings_from_measurement(self):
+        measurement = {"holography_settings": {"propagation_method": 2, "propagation_mm": 12.5}}
+        self.assertEqual(measurement_json.propagation_settings(measurement),
+                         (propagation.METHOD.propagate_convolution_scaled, 0.0125))
+
+
+class TestAutofocus(unittest.TestCase):
+    rng = numpy.random.default_rng(34)
+    wavelengths = [633e-9, 640e-9]
+    pixel = 5e-6
+    focus_mm = 4.0
+    blocks = numpy.kron(rng.random((16, 16)), numpy.ones((8, 8)))  # structures of 8 pixels
+
+    def camera_fields(self, height_m, amplitude=1.0):
+        '''Fields of both lasers, focus_mm in front of the object plane'''
+        objects = numpy.stack([amplitude * numpy.exp(4j * numpy.pi * height_m / w) for w in self.wavelengths])
+        return propagation.propagate(objects, self.pixel, self.wavelengths, -self.focus_mm * 1e-3, cache=ArrayCache())
+
+    def setting(self, mirrorlike):
+        setting = cuda_holo.AutoFocusSetting()
+        setting.roi.x_center, setting.roi.y_center, setting.roi.width, setting.roi.height = 64, 64, 64, 64
+        setting.num_steps = 21
+        setting.dist_estimate_mm = 1.0
+        setting.is_mirrorlike_surface = mirrorlike
+        setting.do_additional_fine_focus = True
+        return setting
+
+    def test_diffuse_surface(self):
+        fields = self.camera_fields(self.rng.normal(0, 2e-6, (128, 128)), 0.2 + 0.8 * (self.blocks > 0.5))
+        for criterion in (autofocus.CRITERIA.amp_single_laser, autofocus.CRITERIA.correlation_amp):
+            result = autofocus.autofocus(fields, self.pixel, self.wavelengths, self.setting(False), criterion,
+                                         cache=ArrayCache())
+            self.assertAlmostEqual(result.distance_mm, self.focus_mm, delta=0.05, msg=criterion.name)
+            self.assertEqual([c.shape for c in result.curves], [(21,), (21,)])
+
+    def test_mirrorlike_surface_and_message(self):
+        fields = self.camera_fields(0.3e-6 * self.blocks)
+        for criterion in (autofocus.CRITERIA.phase_gradient, autofocus.CRITERIA.gradient_of_amps):
+            result = autofocus.autofocus(fields, self.pixel, self.wavelengths, self.setting(True), criterion,
+                                         cache=ArrayCache())
+            self.assertAlmostEqual(result.distance_mm, self.focus_mm, delta=0.05, msg=criterion.name)
+        message = result.function_ready_jso()
+        keys = holo_dll.KeysFunctionReady()
+        self.assertEqual(message[keys.KEY_FUNCTION_ID], holo_globals.FunctionId.auto_focus_finished)
+        self.assertAlmostEqual(message[keys.KEY_OPTIONAL_DOUBLE], result.distance_mm * 1e3)
+
+    def test_setting_from_jso(self):
+        setting = autofocus.setting_from_jso({"number_of_steps_af": 7, "search_range_mm_af": 2.5,
+                                              "propagation_method_af": 2, "additional_fine_search_af": True})
+        self.assertEqual((setting.num_steps, setting.range_mm, setting.prop_method), (7, 2.5, 2))
+        self.assertTrue(setting.do_additional_fine_focus)
+        self.assertEqual(setting.idx_laser, 0)
+        self.assertEqual(autofocus.roi_in_frame(setting.roi, (100, 120)), (0, 0, 120, 100))
+        jso = {"w_of_ROI_for_af": 40, "h_of_ROI_for_af": 20, "center_x_for_af": 50, "center_y_for_af": 30,
+               "mirrorlike_seurface_af": False, "use_phase_image": True}
+        setting = autofocus.setting_from_jso(jso)
+        self.assertEqual(roi_as_tuple(setting.roi), (30, 20, 40, 20))
+        self.assertFalse(setting.is_mirrorlike_surface)
+        self.assertTrue(setting.use_phase_image)
+        jso["center_af_ROI_from_ref_point"] = True
+        setting = autofocus.setting_from_jso(jso, reference_point=(110, 95))
+        self.assertEqual(roi_as_tuple(setting.roi), (90, 85, 40, 20))
+        self.assertEqual(autofocus.roi_in_frame(setting.roi, (100, 120)), (90, 85, 30, 15))
+
+
+class TestShapeFromFocus(unittest.TestCase):
+    rng = numpy.random.default_rng(35)
+    pixel = 5e-6
+    wavelength = 633e-9
+
+    def setUp(self):
+        # diffuse binary object, the left half 2 mm and the right half 5 mm behind the camera plane
+        amplitude = numpy.kron(self.rng.random((32, 32)) > 0.5, numpy.ones((4, 4)))
+        obj = amplitude * numpy.exp(1j * self.rng.uniform(-numpy.pi, numpy.pi, (128, 128)))
+        left = obj.copy()
+        left[:, 64:] = 0
+        self.field = (propagation.propagate(left, self.pixel, self.wavelength, -2e-3)
+                      + propagation.propagate(obj - left, self.pixel, self.wavelength, -5e-3))
+        self.setting = cuda_holo.ExtendedDepthSetting()
+        self.setting.num_planes_sff = 17
+        self.setting.searchrange_mm = 8
+        self.setting.prop_distance_at_roi_mm = 3.5
+
+    def test_accumulator_equals_full_stack(self):
+        stack = self.rng.random((9, 20, 30)).astype(numpy.float32)
+        accumulator = shape_from_focus.FocusAccumulator((20, 30))
+        for plane, sharpness in enumerate(stack):
+            accumulator.update_rows(slice(0, 10), sharpness[:10], plane)
+            accumulator.update_rows(slice(10, 20), sharpness[10:], plane)
+        accumulator.planes = 9
+        numpy.testing.assert_array_equal(accumulator.best_plane, stack.argmax(axis=0))
+        _depth, quality = accumulator.depth_and_quality(numpy.arange(9))
+        numpy.testing.assert_allclose(quality, 1 - stack.mean(axis=0) / stack.max(axis=0), atol=1e-6)
+
+    def test_depth_of_two_planes(self):
+        self.setting.threshold_sff_quality = 0.3
+        self.setting.filterradius_median_sff = 3
+        self.setting.filter_radius_open_sffmask = self.setting.filter_radius_close_sffmask = 2
+        result = shape_from_focus.shape_from_focus(self.field, self.pixel, [self.wavelength], self.setting,
+                                                   band_rows=32, workers=2, cache=ArrayCache())
+        self.assertEqual(result.depth_mm.shape, (128, 128))
+        for cols, expected in ((slice(10, 50), 2.0), (slice(78, 118), 5.0)):
+            depth = result.depth_mm[:, cols]
+            depth = depth[~numpy.isnan(depth)]
+            self.assertGreater(depth.size, 1000)
+            self.assertAlmostEqual(float(numpy.median(depth)), expected, delta=0.1)
+            self.assertGreater(numpy.mean(numpy.abs(depth - expected) < 0.3), 0.8)
+
+    def test_two_planes_pick_the_sharper(self):
+        self.setting.num_planes_sff, self.setting.searchrange_mm = 2, 3
+        self.setting.threshold_sff_quality = 0  # as in Keylist.csv, 2 planes reach a quality of 0.5 at most
+        self.setting.filterradius_median_sff = 0
+        result = shape_from_focus.shape_from_focus(self.field, self.pixel, [self.wavelength], self.setting,
+                                                   cache=ArrayCache())
+        numpy.testing.assert_array_equal(result.distances_mm, [2.0, 5.0])
+        self.assertTrue(numpy.isin(result.depth_mm[~numpy.isnan(result.depth_mm)], [2.0, 5.0]).all())
+        for cols, expected in ((slice(10, 50), 2.0), (slice(78, 118), 5.0)):
+            self.assertEqual(float(numpy.nanmedian(result.depth_mm[:, cols])), expected)
+        self.setting.num_planes_sff = 1
+        with self.assertRaises(ValueError):
+            shape_from_focus.shape_from_focus(self.field, self.pixel, [self.wavelength], self.setting)
+
+    def test_setting_from_measurement(self):
+        setting = measurement_json.extended_depth_setting({"num_planes_SFF": 40, "threshold_SFF": 0.5,
+                                                           "extended_depth_center_x": 100,
+                                                           "extended_depth_center_y": 50})
+        self.assertEqual((setting.num_planes_sff, setting.roi.x_center, setting.roi.y_center), (40, 100, 50))
+        self.assertAlmostEqual(setting.threshold_sff_quality, 0.5)
+        default_y = cuda_holo.ExtendedDepthSetting().roi.y_center
+        setting = measurement_json.extended_depth_setting({"extended_depth_center_x": 100})
+        self.assertEqual((setting.roi.x_center, setting.roi.y_center), (100, default_y))
+
+
+class TestMultiPlane(unittest.TestCase):
+    pixel = 5e-6
+    wavelength = 633e-9
+
+    def setUp(self):
+        amplitude = numpy.kron(numpy.random.default_rng(36).random((32, 32)) > 0.5, numpy.ones((4, 4)))
+        left = amplitude.astype(numpy.complex64)
+        left[:, 64:] = 0
+        self.field = (propagation.propagate(left, self.pixel, self.wavelength, -2e-3)
+                      + propagation.propagate(amplitude - left, self.pixel, self.wavelength, -5e-3))
+        self.distances = numpy.where(numpy.arange(128) < 64, 2.0, 5.0) * numpy.ones((128, 1))
+        self.setting = cuda_holo.ExtendedDepthSetting()
+        self.setting.num_propagation_distances = 2
+        self.setting.prop_distance_at_roi_mm = 3.5
+        self.setting.prop_planes_selection_method = cuda_holo.PropPlanesSelectionMethod.histogram
+
+    def test_histogram_plane_selection(self):
+        self.setting.num_propagation_distances = 3
+        distances = numpy.concatenate([numpy.full(500, 2.0), numpy.full(300, 5.0), numpy.full(100, 3.3),
+                                       numpy.full(5, 4.0), [20.0, numpy.nan]])
+        numpy.testing.assert_allclose(multi_plane.select_planes(distances, self.setting), [2.0, 3.3, 5.0])
+
+    def test_each_tile_uses_its_plane(self):
+        result = multi_plane.multi_plane_propagation(self.field, self.pixel, [self.wavelength], self.distances,
+                                                     self.setting, tile=32, numerical_aperture=0.2,
+                                                     cache=ArrayCache())
+        numpy.testing.assert_allclose(result.planes_mm, [2.0, 5.0])
+        self.assertEqual(result.tiles_propagated, 16)  # every tile is propagated to one plane only
+        for cols, distance in ((slice(0, 64), 2e-3), (slice(64, 128), 5e-3)):
+            full = propagation.propagate(self.field, self.pixel, self.wavelength, distance)
+            numpy.testing.assert_allclose(result.fields[:, cols], full[:, cols], atol=1e-4)
+
+    def test_interpolation_between_planes(self):
+        self.setting.interpolate_multi_plane = True
+        self.setting.prop_planes_selection_method = cuda_holo.PropPlanesSelectionMethod.uniform_distribution
+        self.distances[:, 64:] = 3.5  # halfway between the planes
+        self.distances[0, 0] = 5.0
+        result = multi_plane.multi_plane_propagation(self.field, self.pixel, [self.wavelength], self.distances,
+                                                     self.setting, tile=32, numerical_aperture=0.2,
+                                                     cache=ArrayCache())
+        near = propagation.propagate(self.field, self.pixel, self.wavelength, 2e-3)
+        far = propagation.propagate(self.field, self.pixel, self.wavelength, 5e-3)
+        numpy.testing.assert_allclose(result.fields[:, 64:], 0.5 * (near + far)[:, 64:], atol=1e-4)
+        self.assertEqual(result.tiles_propagated, 16 + 8 + 1)
+
+    def test_crops_split_on_column_gaps(self):
+        used = numpy.array([[True, False, False, True]])
+        crops = multi_plane.plane_crops(used, (32, 128), tile=32, guard=8)
+        self.assertEqual([(crop_cols, target_cols) for _, crop_cols, _, target_cols in crops],
+                         [(slice(0, 48), slice(0, 32)), (slice(80, 128), slice(96, 128))])  # one shape, one kernel
+        self.assertEqual(len(multi_plane.plane_crops(used, (32, 128), tile=32, guard=40)), 1)
+
+    def test_without_distances(self):
+        result = multi_plane.multi_plane_propagation(self.field, self.pixel, [self.wavelength],
+                                                     numpy.full((128, 128), numpy.nan), self.setting, tile=32,
+                                                     cache=ArrayCache())
+        numpy.testing.assert_array_equal(result.planes_mm, [3.5])
+        self.assertEqual((result.crops_propagated, result.pixels_propagated), (1, 128 * 128))
+        numpy.testing.assert_allclose(result.fields, propagation.propagate(self.field, self.pixel, self.wavelength,
+                                                                           3.5e-3), atol=1e-5)
+
+
+class TestSyntheticWavelengths(unittest.TestCase):
+    wavelengths = [633e-9, 640e-9, 660e-9]
+
+    def setUp(self):
+        # height ramp of +-12 um, within a quarter of the coarsest synthetic wavelength (57.9 um)
+        self.height = numpy.linspace(-12e-6, 12e-6, 96)[None, :] * numpy.ones((64, 1))
+        self.fields = numpy.array([numpy.exp(4j * numpy.pi * self.height / w) for w in self.wavelengths],
+                                  dtype=numpy.complex64)
+        self.filter_setting = cuda_holo.Filters()
+        self.filter_setting.filterRadius = 0
+
+    def test_unwraps_beyond_finest_wavelength(self):
+        combiner = synthetic_wavelengths.SyntheticCombiner(self.wavelengths, filter_setting=self.filter_setting,
+                                                           band_rows=16)
+        result = combiner.combine(self.fields)
+        fine_m, coarse_m = result.synthetic_m[-1], result.synthetic_m[0]
+        self.assertGreater(coarse_m, fine_m)
+        self.assertGreater(numpy.ptp(self.height), fine_m / 2)  # the fine phase alone is ambiguous
+        numpy.testing.assert_allclose(result.fine, 4 * numpy.pi * self.height / fine_m, atol=2e-3)
+        numpy.testing.assert_allclose(result.combined, 4 * numpy.pi * self.height / coarse_m, atol=1e-3)
+        self.assertIs(result.buffer_for_step(cuda_holo.ProcessingStep.STEP_SYN_PHASES_COMBINED), result.combined)
+        self.assertIs(combiner.combine(self.fields).combined, result.combined)  # buffers are reused
+
+    def test_bands_match_single_band(self):
+        self.filter_setting.filterRadius = 2
+        noisy = self.fields * numpy.exp(0.3j * numpy.random.default_rng(37).standard_normal(self.fields.shape))
+        banded = synthetic_wavelengths.SyntheticCombiner(self.wavelengths, filter_setting=self.filter_setting,
+                                                         band_rows=8, workers=3)
+        single = synthetic_wavelengths.SyntheticCombiner(self.wavelengths, filter_setting=self.filter_setting,
+                                                         band_rows=64)
+        self.assertEqual(banded.filter_radii(), [4, 2])
+        numpy.testing.assert_allclose(banded.combine(noisy).filtered, single.combine(noisy).filtered, atol=1e-5)
+
+    def test_combination_error_is_masked(self):
+        thresholds = cuda_holo.Thresholds()
+        thresholds.threshold_combination_error = 1.0
+        self.fields[2, 10:20, 10:20] *= numpy.exp(2.5j)
+        combiner = synthetic_wavelengths.SyntheticCombiner(self.wavelengths, filter_setting=self.filter_setting,
+                                                           thresholds=thresholds)
+        result = combiner.combine(self.fields)
+        invalid = numpy.isnan(result.combined)
+        self.assertTrue(invalid[10:20, 10:20].all())
+        self.assertEqual(invalid.sum(), 100)
+
+    def test_combiner_from_measurement(self):
+        measurement = {"single lasers": {str(idx): {"lda_m": w} for idx, w in enumerate(self.wavelengths)},
+                       "synthetic wavelengths": {"combined_m": 2e-5}}
+        combiner = synthetic_wavelengths.combiner_from_measurement(measurement)
+        self.assertEqual(combiner.pairs, [(0, 1), (0, 2)])
+        self.assertEqual(combiner.combined_m, 2e-5)
+        self.assertEqual(combiner.filter_radii(), [2, 1])  # Filters defaults
+        measurement["holography_settings"] = {"filter radius": 3, "key_filter_scale_rough_signal": 1.5,
+                                              "filter type": 0, "threshold finer signal error": 0.5}
+        combiner = synthetic_wavelengths.combiner_from_measurement(measurement)
+        self.assertEqual(combiner.filter_radii(), [4, 3])
+        self.assertEqual(combiner.filter_setting.filter_type, cuda_holo.FilterType.mean_filter)
+        self.assertEqual(combiner.thresholds.threshold_combination_error, 0.5)
+        measurement["holography_settings"]["threshold finer signal error"] = 0
+        combiner = synthetic_wavelengths.combiner_from_measurement(measurement)
+        self.assertEqual(combiner.thresholds.threshold_combination_error,
+                         cuda_holo.Thresholds().threshold_combination_error)
+
+
+class TestNoiseReduction(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(39)
+        self.phase = tilted_phase((80, 60), 0.02, 0.05)
+        self.fields = numpy.exp(1j * self.phase)[None].repeat(2, axis=0).astype(numpy.complex64)
+        self.outliers = numpy.zeros((2, 80, 60), dtype=bool)
+        self.outliers[:, 1::9, 2::7] = True
+        self.fields[self.outliers] *= numpy.exp(1j * rng.uniform(2.0, 4.0, self.outliers.sum()))
+        self.settings = cuda_holo.NoiseDetectionSettings()
+        self.settings.filter_radius_noise_detection = 2
+
+    def test_methods_remove_outliers(self):
+        for method in list(noise_reduction.METHODS)[1:]:
+            self.settings.method = method
+            reducer = noise_reduction.NoiseReducer(self.settings, band_rows=16, workers=3)
+            reduced = reducer.reduce(self.fields)
+            error = numpy.abs(numpy.angle(reduced * numpy.exp(-1j * self.phase)))
+            self.assertLess(numpy.abs(reduced[self.outliers]).max() if method == noise_reduction.METHODS.ReduceAmplitude
+                            else error[self.outliers].max(), 0.3, method.name)
+            self.assertLess(error[~self.outliers].max(), 0.1, method.name)
+            single = noise_reduction.NoiseReducer(self.settings, band_rows=80).reduce(self.fields)
+            numpy.testing.assert_allclose(reduced, single, atol=1e-5)
+            self.assertIs(reducer.reduce(self.fields), reduced)
+
+    def test_complex_median_with_spike(self):
+        self.settings.method = noise_reduction.METHODS.ComplexMedianFilter
+        self.settings.filter_radius_noise_detection = 4
+        fields = self.fields.copy()
+        fields[:, 40, 30] *= 1000  # hot pixel, it dominates the mean of its neighbourhood and is kept
+        reduced = noise_reduction.reduce_noise(fields, self.settings)
+        error = numpy.abs(numpy.angle(reduced * numpy.exp(-1j * self.phase)))
+        error[:, 40, 30] = 0
+        self.assertLess(error[self.outliers].max(), 0.3)  # replaced by medians with the spike in range
+        self.assertLess(error[~self.outliers].max(), 0.1)
+
+    def test_settings_from_jso(self):
+        settings, cutoff = noise_reduction.settings_from_jso({"key_noise_detection_method": 3,
+                                                              "key_noise_detection_filter_radius": 4,
+                                                              "key_noise_detection_cutoff": 1.0})
+        self.assertEqual(settings.method, noise_reduction.METHODS.ComplexMedianFilter)
+        self.assertEqual(noise_reduction.detection_radius(settings), 4)
+        self.assertEqual((settings.order, cutoff), (3, 1.0))
+        self.assertIs(noise_reduction.reduce_noise(self.fields, cuda_holo.NoiseDetectionSettings()), self.fields)
+
+
+class TestTilt(unittest.TestCase):
+    synthetic_m = [1e-3, 2.5e-4]
+
+    def setUp(self):
+        rng = numpy.random.default_rng(40)
+        rows, cols = numpy.mgrid[:200, :240]
+        height = 2e-6 * rows - 1.5e-6 * cols + 3e-6
+        self.phases = numpy.array([tilt.wrap(4 * numpy.pi * height / w + rng.normal(0, 0.05, height.shape))
+                                   for w in self.synthetic_m]).astype(numpy.float32)
+        self.phases[:, 50:80, 100:140] = rng.uniform(-numpy.pi, numpy.pi, (2, 30, 40))  # diffuse area
+        self.expected = numpy.array([[4 * numpy.pi * 2e-6 / w, -4 * numpy.pi * 1.5e-6 / w] for w in self.synthetic_m])
+        self.settings = cuda_holo.TiltSettings()
+        ring = self.settings.ring_for_roi
+        ring.center_x, ring.center_y, ring.radius, ring.width = 120, 100, 60, 3
+
+    def test_methods(self):
+        for method in list(tilt.METHOD)[1:]:
+            for each_synth in (True, False):
+                self.settings.method = method
+                self.settings.untilt_each_synth = each_synth
+                self.settings.use_mirror_only = self.settings.use_low_pass_filter = not each_synth
+                untilted, estimate = tilt.untilt(self.phases, self.settings, self.synthetic_m)
+                numpy.testing.assert_allclose(estimate[:, :2], self.expected, atol=2e-3, err_msg=method.name)
+                self.assertLess(float(numpy.median(numpy.abs(untilted))), 0.06, method.name)
+
+    def test_ring_samples_are_cached(self):
+        cache = ArrayCache()
+        self.settings.method = tilt.METHOD.tilt_correction_on_ring
+        first = tilt.estimate_tilt(self.phases[0], self.settings, cache=cache)
+        second = tilt.estimate_tilt(self.phases[0], self.settings, cache=cache)
+        numpy.testing.assert_array_equal(first, second)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        samples = tilt.ring_samples(self.phases.shape[-2:], self.settings.ring_for_roi, cache)
+        distance = numpy.hypot(samples.rows - 100, samples.cols - 120)
+        self.assertTrue(((distance >= 58.5) & (distance < 61.5)).all())
+
+    def test_line_tilt_and_in_place_removal(self):
+        line = cuda_holo.LineTilt()
+        line.section_x.x_start, line.section_x.y_start, line.section_x.length = 10, 20, 80
+        line.section_y.x_start, line.section_y.y_start, line.section_y.length = 30, 100, 90
+        estimate = tilt.line_tilt(self.phases, line)
+        numpy.testing.assert_allclose(estimate[:, :2], self.expected, atol=2e-3)
+        phases = self.phases.copy()
+        self.assertIs(tilt.remove_tilt(phases, estimate, out=phases), phases)
+        self.assertLess(float(numpy.median(numpy.abs(phases))), 0.06)
+
+
+class TestOffsetCompensation(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(41)
+        self.phase = tilt.wrap(2.0 + rng.normal(0, 0.05, (200, 240))).astype(numpy.float32)
+        self.phase[:100] = tilt.wrap(self.phase[:100] + rng.normal(0, 1.5, (100, 240)))  # rough upper half
+        self.setting = cuda_holo.OffsetCompensation()
+        self.setting.x_center, self.setting.y_center, self.setting.width, self.setting.height = 120, 150, 20, 20
+        self.setting.phase_val_target = 0.5
+
+    def test_single_offset_methods(self):
+        methods = offset_compensation.METHOD
+        for method in (methods.OffsetFromRefPoint, methods.OffsetFromHistogram, methods.OffsetFromAutoRefPoint,
+                       methods.OffsetFromGlobalDiff):
+            self.setting.method = method
+            self.setting.use_mirror_only = method == methods.OffsetFromGlobalDiff
+            compensated, result = offset_compensation.compensate_offset(self.phase, self.setting,
+                                                                        max_samples=5000)
+            self.assertAlmostEqual(result.offset, 1.5, delta=0.02, msg=method.name)
+            self.assertAlmostEqual(self.setting.phase_offset_roi_combined, result.offset, places=6)
+            self.assertAlmostEqual(float(numpy.median(compensated[100:])), 0.5, delta=0.02, msg=method.name)
+
+    def test_auto_reference_point_in_smooth_area(self):
+        self.setting.method = offset_compensation.METHOD.OffsetFromAutoRefPoint
+        result = offset_compensation.find_offset(self.phase, self.setting)
+        self.assertGreaterEqual(result.reference_point[1], 110)
+
+    def test_small_auto_window_searches_the_sampled_grid(self):
+        self.setting.method = offset_compensation.METHOD.OffsetFromAutoRefPoint
+        self.setting.width = self.setting.height = 4  # smaller than two sample steps
+        shapes = []
+        search = offset_compensation.smoothest_window
+
+        def recording(phase, *args):
+            shapes.append(phase.shape)
+            return search(phase, *args)
+
+        offset_compensation.smoothest_window = recording
+        try:
+            result = offset_compensation.find_offset(self.phase, self.setting, max_samples=3000)
+        finally:
+            offset_compensation.smoothest_window = search
+        self.assertGreaterEqual(result.reference_point[1], 110)
+        self.assertAlmostEqual(result.offset, 1.5, delta=0.2)
+        self.assertLessEqual(shapes[0][0] * shapes[0][1], 3000)
+        self.assertLessEqual(max(h * w for h, w in shapes[1:]), 24 * 24)
+
+    def test_offsets_per_tile_to_reference(self):
+        self.setting.method = offset_compensation.METHOD.OffsetFromGlobalDiffROIwise
+        self.setting.width, self.setting.height = 60, 50
+        tile_offsets = numpy.linspace(-2, 2, 16).reshape(4, 4)
+        shifted = tilt.wrap(self.phase + numpy.kron(tile_offsets, numpy.ones((50, 60)))).astype(numpy.float32)
+        compensated, result = offset_compensation.compensate_offset(shifted, self.setting, reference=self.phase)
+        numpy.testing.assert_allclose(result.offset[2:], tile_offsets[2:], atol=0.02)  # smooth half
+        self.assertEqual(result.roi_offset, result.offset[3, 2])  # the tile around (120, 150)
+        self.assertAlmostEqual(self.setting.phase_offset_roi_combined, result.roi_offset, places=6)
+        numpy.testing.assert_allclose(compensated[100:], self.phase[100:], atol=0.05)
+
+    def test_histogram_and_stack_in_place(self):
+        counts, _sums = offset_compensation.phase_histogram(self.phase, bins=64, band_rows=30)
+        numpy.testing.assert_array_equal(counts, numpy.histogram(self.phase, 64, (-numpy.pi, numpy.pi))[0])
+        self.setting.method = offset_compensation.METHOD.OffsetFromRefPoint
+        stack = numpy.array([self.phase, tilt.wrap(self.phase + 1)])
+        compensated, results = offset_compensation.compensate_offset(stack, self.setting, in_place=True)
+        self.assertIs(compensated, stack)
+        self.assertAlmostEqual(results[1].offset - results[0].offset, 1.0, places=3)
+        numpy.testing.assert_allclose(stack[:, 150, 120], 0.5, atol=0.2)
+
+
+class TestHeightConversion(unittest.TestCase):
+    wavelength = 1.2e-3
+
+    def setUp(self):
+        rows, cols = numpy.mgrid[:40, :60]
+        self.plane = numpy.array([0.02, -0.03, 0.5])
+        self.phase = numpy.linspace(-3, 3, 2400).reshape(40, 60).astype(numpy.float32)
+        self.tilted = self.phase + self.plane[0] * rows + self.plane[1] * cols + self.plane[2]
+        self.settings = cuda_holo.HeightValueConversionSettings()
+
+    def test_fused_scale_and_revert_untilt(self):
+        self.settings.convert_to_height_unit = height_conversion.UNITS.convert_to_micron
+        self.settings.revert_untilt = True
+        phase = self.phase.copy()
+        height = height_conversion.convert_to_height(phase, self.settings, self.wavelength, self.plane, out=phase,
+                                                     band_rows=16, workers=2)
+        self.assertTrue(numpy.shares_memory(height, phase))
+        numpy.testing.assert_allclose(height, self.tilted * self.wavelength / (4 * numpy.pi) * 1e6, atol=1e-3)
+
+    def test_orientation_is_a_view_until_export(self):
+        settings = height_conversion.settings_from_jso({"convert_to_height_unit": 0, "do_transpose": True,
+                                                        "rotation_type": 1})
+        view = height_conversion.convert_to_height(self.phase, settings, self.wavelength)
+        self.assertFalse(view.flags.c_contiguous)
+        numpy.testing.assert_array_equal(view, numpy.rot90(self.phase.T))
+        exported = height_conversion.materialize(view)
+        self.assertTrue(exported.flags.c_contiguous)
+        numpy.testing.assert_array_equal(exported, view)
+
+
+class TestFlatnessCorrection(unittest.TestCase):
+    pixel = 5e-6
+    wavelengths = [633e-9, 640e-9]
+
+    def setUp(self):
+        self.settings = cuda_holo.FlatnessCorrection()
+        self.settings.tilt_x, self.settings.tilt_y = 0.001, -0.002
+        self.settings.second_order_term, self.settings.second_order_term_correction_y = 3.0, 0.5
+        self.settings.refractive_power_dpt = 2.0
+        self.fields = numpy.ones((2, 30, 40), dtype=numpy.complex64)
+
+    def test_matches_full_polynomial_and_caches_vectors(self):
+        cache = ArrayCache()
+        self.assertTrue(flatness_correction.apply_correction(self.fields, self.pixel, self.wavelengths, self.settings,
+                                                             band_rows=8, workers=2, cache=cache))
+        y, x = numpy.mgrid[:30, :40] - numpy.array([15, 20])[:, None, None]
+        for field, wavelength in zip(self.fields, self.wavelengths):
+            phase = (4 * numpy.pi / wavelength * self.pixel * (numpy.tan(numpy.radians(0.001)) * x
+                                                               + numpy.tan(numpy.radians(-0.002)) * y)
+                     + 3e-6 * (x * x + 0.5 * y * y) - numpy.pi * 2.0 * self.pixel ** 2 * (x * x + y * y) / wavelength)
+            numpy.testing.assert_allclose(field, numpy.exp(1j * phase), atol=1e-5)
+        flatness_correction.apply_correction(self.fields, self.pixel, self.wavelengths, self.settings, cache=cache)
+        self.assertEqual((cache.misses, cache.hits), (2, 2))
+
+    def test_stage_selection(self):
+        self.settings.virtual_lens_method = flatness_correction.LENS.no_virtual_lens
+        before = flatness_correction.LENS.virtual_lens_before_propagation
+        self.assertFalse(flatness_correction.apply_correction(self.fields, self.pixel, self.wavelengths, self.settings,
+                                                              stage=before))
+        self.assertTrue((self.fields == 1).all())
+        self.settings.tilt_x = self.settings.tilt_y = self.settings.second_order_term = 0
+        self.assertTrue(flatness_correction.is_identity(self.settings))  # the lens is off
+
+
+class TestMasks(unittest.TestCase):
+    def setUp(self):
+        self.ring = cuda_holo.Ring()
+        self.ring.center_x, self.ring.center_y, self.ring.radius, self.ring.width = 50, 40, 20, 4
+        self.data = numpy.random.default_rng(5).normal(size=(2, 90, 110))
+        y, x = numpy.mgrid[:90, :110]
+        distance = numpy.hypot(y - 40, x - 50)
+        self.full_mask = (distance >= 18) & (distance < 22)
+
+    def test_ring_mask_matches_full_frame_mask_and_is_cached(self):
+        cache = ArrayCache()
+        region = masks.ring_mask(self.data.shape, self.ring, cache)
+        self.assertIs(masks.ring_mask(self.data.shape[-2:], self.ring, cache), region)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        self.assertEqual(region.box, (slice(18, 63), slice(28, 73)))
+        self.assertEqual(sorted(region.flat), list(numpy.flatnonzero(self.full_mask)))
+        numpy.testing.assert_allclose(masks.masked_mean(self.data, region), self.data[:, self.full_mask].mean(axis=1))
+        angles = numpy.arctan2(region.pixel_rows - 40, region.pixel_cols - 50)
+        self.assertTrue((numpy.diff(angles) >= 0).all())
+
+    def test_apply_ring_mask_and_area(self):
+        geometric = cuda_holo.GeometricMask()
+        geometric.ring_mask = self.ring
+        data = self.data.copy()
+        self.assertFalse(masks.apply_ring_mask(data, geometric))
+        geometric.apply_ring_mask = True
+        self.assertTrue(masks.apply_ring_mask(data, geometric, ArrayCache()))
+        numpy.testing.assert_allclose(data, numpy.where(self.full_mask, self.data, self.data * 1e-6))
+        area = cuda_holo.HoloArea()
+        area.x_center, area.y_center, area.width, area.height = 5, 80, 20, 30
+        region = masks.area_mask(self.data.shape, area, ArrayCache())
+        self.assertEqual(region.box, (slice(65, 90), slice(0, 20)))
+        numpy.testing.assert_array_equal(masks.masked_values(self.data, region),
+                                         self.data[:, 65:90, 0:20].reshape(2, -1))
+
+
+class TestDispersion(unittest.TestCase):
+    wavelengths = [633e-9, 780e-9]
+
+    def setUp(self):
+        self.settings = dispersion.settings_from_jso({"do_dispersion_correction_z": True, "thickness_BS_mm": 10,
+                                                      "type_of_glass_BS": 0})
+        self.fields = numpy.exp(1j * numpy.random.default_rng(6).uniform(-3, 3, (2, 32, 32))).astype(numpy.complex64)
+
+    def test_catalogue_indices(self):
+        d_line = 587.5618e-9
+        for glass, nd in ((dispersion.GLASS.BK7, 1.5168), (dispersion.GLASS.SIO2, 1.4585),
+                          (dispersion.GLASS.SF2, 1.6477), (dispersion.GLASS.H_LAK67, 1.7292)):
+            self.assertAlmostEqual(float(dispersion.refractive_index(glass, d_line)), nd, places=4, msg=glass.name)
+
+    def test_z_correction_is_one_cached_multiply(self):
+        cache = ArrayCache()
+        expected = self.fields.copy()
+        result = dispersion.correct_dispersion(self.fields, self.settings, self.wavelengths, cache=cache)
+        self.assertIs(result, self.fields)
+        n = dispersion.refractive_index(dispersion.GLASS.BK7, self.wavelengths)
+        phases = 2 * numpy.pi * 2 * (n - 1) * 10e-3 / numpy.array(self.wavelengths)
+        numpy.testing.assert_allclose(result, expected * numpy.exp(-1j * phases)[:, None, None], atol=1e-5)
+        dispersion.correct_dispersion(self.fields, self.settings, self.wavelengths, cache=cache)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+
+    def test_xy_rescales_onto_first_laser(self):
+        self.settings.do_dispersion_correction_z, self.settings.do_dispersion_correction_xy = False, True
+        table = dispersion.dispersion_table(self.settings, self.wavelengths)
+        self.assertEqual(table.focus_shifts_m[0], 0)
+        self.assertLess(table.focus_shifts_m[1], 0)  # lower index at the longer wavelength
+        image_distance = -table.focus_shifts_m[1] / 0.05
+        scales = dispersion.lateral_scales(table, image_distance)
+        self.assertAlmostEqual(float(scales[1]), 0.95)
+        center = 31.5
+        x = numpy.arange(64) - center
+        pattern = numpy.exp(1j * 0.1 * (x[:, None] + 2 * x[None, :])).astype(numpy.complex64)
+        fields = numpy.stack([pattern, numpy.exp(1j * 0.1 / 0.95 * (x[:, None] + 2 * x[None, :]))]).astype(
+            numpy.complex64)
+        with self.assertRaises(ValueError):
+            dispersion.correct_dispersion(fields.copy(), self.settings, self.wavelengths)
+        cache = ArrayCache()
+        dispersion.correct_dispersion(fields, self.settings, self.wavelengths, image_distance, cache=cache)
+        numpy.testing.assert_array_equal(fields[0], pattern)
+        numpy.testing.assert_allclose(fields[1], pattern, atol=0.02)
+        self.assertEqual(cache.misses, 2)  # the table and one square axis
+
+
+class TestRawQuality(unittest.TestCase):
+    def setUp(self):
+        rows, cols = numpy.mgrid[:200, :240]
+        self.phase = 0.3 * cols + 0.1 * rows
+        self.thresholds, self.references = raw_quality.settings_from_jso({
+            "max_num_repeats": 2, "flag_sigma_grayvals_as_criterion": True, "rel_threshold_variation_grayvals": 7,
+            "flag_deviation_phase_steps_as_criterion": True, "rel_threshold_deviation_phasesteps": 0.4,
+            "flag_modulation_as_criterion": True, "threshold_variation_modulation": 0.5,
+            "flag_smoothness_as_criterion": True, "threshold_variation_smootheness": 0.2,
+            "flag_snr_fft_steps_as_criterion": "", "threshold_snr_fft": ""})
+
+    def stack(self, steps=(0, 1, 2, 3), brightness=(1, 1, 1, 1)):
+        frames = [b * (100 + 60 * numpy.cos(self.phase + numpy.pi / 2 * s)) for s, b in zip(steps, brightness)]
+        return numpy.stack(frames * 2).astype(numpy.uint16)
+
+    def test_good_stack_is_accepted(self):
+        report = raw_quality.check_raw_quality(self.stack(), 4, self.thresholds, self.references)
+        self.assertTrue(report.accepted, report)
+        self.assertEqual(sorted(report.values), ["grayvals", "modulation", "phasesteps", "smoothness", "snr"])
+        self.assertAlmostEqual(report.values["modulation"], 0.4, delta=0.01)
+
+    def test_bad_stacks_are_repeated(self):
+        for stack, criterion in ((self.stack(steps=(0, 1, 2.6, 3)), "phasesteps"),
+                                 (self.stack(brightness=(1, 1.2, 1, 1)), "grayvals")):
+            report = raw_quality.check_raw_quality(stack, [4, 4], self.thresholds, self.references, workers=2)
+            self.assertEqual(report.failed, [criterion])
+            self.assertTrue(report.repeat)
+        self.thresholds.current_num_repeats = 2
+        self.assertFalse(raw_quality.check_raw_quality(stack, 4, self.thresholds).repeat)
+
+
+class TestBackground(unittest.TestCase):
+    def setUp(self):
+        self.frames = numpy.random.default_rng(8).integers(0, 200, (5, 64, 80)).astype(numpy.uint16)
+        self.settings = cuda_holo.BackgroundImageSettings()
+        self.settings.exposure_ms = 2.5
+        self.settings.update_background_image = True
+
+    def test_running_average_is_memory_mapped_and_reloaded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            references = background.ReferenceImages(directory)
+            references.update(self.frames[:2], self.settings, band_rows=16)
+            self.assertEqual(references.update(self.frames[2:], self.settings), 5)
+            reloaded = background.ReferenceImages(directory)
+            average = reloaded.average(background.BACKGROUND, 2.5, self.frames.shape)
+            self.assertIsInstance(average, numpy.memmap)
+            numpy.testing.assert_allclose(average, self.frames.mean(axis=0), atol=1e-4)
+            self.assertIsNone(reloaded.average(background.DARK, 2.5, self.frames.shape))
+            del average, reloaded, references
+
+    def test_low_passed_once_and_applied(self):
+        cache = ArrayCache()
+        references = background.ReferenceImages(cache=cache)
+        self.settings.is_darkimage = True
+        references.update(self.frames, self.settings)
+        self.settings.update_background_image = False
+        self.assertEqual(references.update(self.frames[:1], self.settings), 5)
+        self.assertIsNone(references.applied_reference(self.settings, self.frames.shape))
+        self.settings.apply_background_image = True
+        expected = background.low_pass(self.frames.mean(axis=0), 0.03125, 0.03125)
+        for _ in range(2):
+            numpy.testing.assert_allclose(references.applied_reference(self.settings, self.frames.shape), expected,
+                                          atol=1e-3)
+        self.assertEqual((cache.misses, cache.hits), (1, 1))
+        smooth = background.low_pass(self.frames[0], 0.1, 0.1)
+        raw = self.frames[0].astype(numpy.float32)
+        self.assertLess(numpy.abs(numpy.diff(smooth, axis=1)).mean(), numpy.abs(numpy.diff(raw, axis=1)).mean() / 4)
+
+
+class TestTiledEvaluation(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.default_rng(9)
+        self.data = (rng.normal(size=(2, 150, 210)) + 1j * rng.normal(size=(2, 150, 210))).astype(numpy.complex64)
+        self.chain = tiled_evaluation.StageChain(functools.partial(filters.box_mean, radius=2),
+                                                 functools.partial(filters.box_mean, radius=3))
+        self.expected = filters.box_mean(filters.box_mean(self.data, 2), 3)
+
+    def test_halo_of_filter_chain(self):
+        mean, gauss = cuda_holo.Filters(), cuda_holo.Filters()
+        mean.filter_type, mean.filterRadius = cuda_holo.FilterType.mean_filter, 2
+        gauss.filter_type, gauss.filterRadius = cuda_holo.FilterType.gauss_filter, 4
+        self.assertEqual(tiled_evaluation.filters_halo(mean, gauss), 2 + filters.gauss_halo(4))
+        self.assertEqual(tiled_evaluation.chain_halo(2, 3), 5)
+        tile_list = tiled_evaluation.frame_tiles((150, 210), (64, 100), halo=5)
+        self.assertEqual(len(tile_list), 9)
+        self.assertEqual(tile_list[4].padded, (slice(59, 133), slice(95, 205)))
+
+    def test_tiles_in_process_pool_match_full_frame(self):
+        with tempfile.TemporaryDirectory() as directory:
+            data = numpy.lib.format.open_memmap(os.path.join(directory, "in.npy"), mode="w+",
+                                                dtype=self.data.dtype, shape=self.data.shape)
+            data[:] = self.data
+            out = tiled_evaluation.create_output(os.path.join(directory, "out.npy"), self.data.shape)
+            tiled_evaluation.run_tiled(self.chain, [data], out, halo=5, tile_shape=(64, 100), workers=2)
+            numpy.testing.assert_allclose(out, self.expected, atol=1e-5)
+            del data, out
+        in_memory = numpy.empty_like(self.data)
+        tiled_evaluation.run_tiled(self.chain, [self.data], in_memory, halo=5, tile_shape=(64, 100))
+        numpy.testing.assert_allclose(in_memory, self.expected, atol=1e-5)
+
+    def test_views_of_memmaps_in_process_pool(self):
+        with tempfile.TemporaryDirectory() as directory:
+            data = numpy.lib.format.open_memmap(os.path.join(directory, "in.npy"), mode="w+",
+                                                dtype=self.data.dtype, shape=self.data.shape)
+            data[:] = self.data
+            out = tiled_evaluation.create_output(os.path.join(directory, "out.npy"), (3, 150, 105))
+            tiled_evaluation.run_tiled(self.chain, [data[1, :, ::2]], out[2], halo=5, tile_shape=(64, 50), workers=2)
+            expected = filters.box_mean(filters.box_mean(self.data[1, :, ::2], 2), 3)
+            numpy.testing.assert_allclose(out[2], expected, atol=1e-5)
+            self.assertFalse(out[:2].any())
+            del data, out
+        with self.assertRaises(ValueError):
+            tiled_evaluation.ArraySpec(self.data)
+
+
+class TestPipeline(unittest.TestCase):
+    wavelengths = [633.0e-9, 636.0e-9, 640.0e-9]
+
+    def setUp(self):
+        rng = numpy.random.default_rng(49)
+        height = tilted_phase((48, 40), 0.0, 0.0) + 2e-6
+        phases = numpy.stack([4 * numpy.pi * height / w for w in self.wavelengths])
+        self.stack = phase_shifted_stack(phases, [4, 4, 4], rng)
+        self.measurement = {
+            "single lasers": {str(idx): {"lda_m": w, "num phase steps": 4} for idx, w in enumerate(self.wavelengths)},
+            "camera settings": {"pixel_size_cam_um": 5.0},
+            "holography_settings": {"propagation_method": 0, "propagation_mm": 0.0},
+            "synthetic wavelengths": {},
+            "height_conversion_settings": {"convert_to_height_unit": int(height_conversion.UNITS.convert_to_micron)}}
+
+    def test_resumes_from_latest_valid_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            evaluation = pipeline.Pipeline(pipeline.default_stages(), pipeline.CheckpointStore(directory))
+            first = evaluation.run(self.stack, self.measurement)
+            self.assertEqual(first.step, pipeline.STEP.STEP_CONVERTED_TO_HEIGHT)
+            self.assertEqual(len(first.computed), 4)
+            self.assertIsNone(first.resumed_from)
+            again = evaluation.run(self.stack, self.measurement)
+            self.assertEqual((again.computed, again.resumed_from), ([], pipeline.STEP.STEP_CONVERTED_TO_HEIGHT))
+            numpy.testing.assert_array_equal(again.outputs["data"], first.outputs["data"])
+            self.measurement["height_conversion_settings"]["convert_to_height_unit"] = int(
+                height_conversion.UNITS.convert_to_mm)
+            rescaled = evaluation.run(self.stack, self.measurement)
+            self.assertEqual(rescaled.resumed_from, pipeline.STEP.STEP_SYN_PHASES_COMBINED)
+            self.assertEqual(rescaled.computed, [pipeline.STEP.STEP_CONVERTED_TO_HEIGHT])
+            numpy.testing.assert_allclose(rescaled.outputs["data"], first.outputs["data"] * 1e-3, rtol=1e-5)
+            self.measurement["synthetic wavelengths"]["combined_m"] = 5e-5
+            self.assertEqual(evaluation.run(self.stack, self.measurement).resumed_from,
+                             pipeline.STEP.STEP_VIS_PHASES_RAW)
+            self.assertIsNone(evaluation.run(self.stack[::-1], self.measurement).resumed_from)
+
+    def test_load_as_and_return_after(self):
+        modes = cuda_holo.HoloModes()
+        modes.step_return_after = pipeline.STEP.STEP_VIS_PHASES_RAW
+        fields = pipeline.Pipeline(pipeline.default_stages()).run(self.stack, self.measurement, modes)
+        self.assertEqual(fields.step, pipeline.STEP.STEP_VIS_PHASES_RAW)
+        self.assertEqual(fields.outputs["data"].shape, (3, 48, 40))
+        modes.step_load_as, modes.step_return_after = fields.step, pipeline.STEP.STEP_CONVERTED_TO_HEIGHT
+        result = pipeline.Pipeline(pipeline.default_stages()).run(fields.outputs["data"], self.measurement, modes)
+        self.assertEqual(result.computed, [pipeline.STEP.STEP_SYN_PHASES_COMBINED,
+                                           pipeline.STEP.STEP_CONVERTED_TO_HEIGHT])
+        self.assertAlmostEqual(float(numpy.nanmedian(result.outputs["data"])), 2.0, delta=0.05)
+
+
+class TestSettingsFingerprint(unittest.TestCase):
+    STEP = settings_fingerprint.STEP
+
+    def setUp(self):
+        self.measurement = {
+            "single lasers": {"0": {"lda_m": 633e-9, "num phase steps": 4, "port": 1}},
+            "camera settings": {"pixel_size_cam_um": 5.0, "exposure_ms": 2.0, "save_folder": "C:/data"},
+            "holography_settings": {"propagation_mm": 1.0, "filter radius": 3.0, "display phase": True},
+            "synthetic wavelengths": {"combined_m": 1e-4},
+            "reference_offset_result_settings": {"x_center_roi_reference_point": 10},
+            "height_conversion_settings": {"convert_to_height_unit": 1}}
+
+    def changed(self, *path, value):
+        new = copy.deepcopy(self.measurement)
+        entry = new
+        for key in path[:-1]:
+            entry = entry[key]
+        entry[path[-1]] = value
+        return settings_fingerprint.invalidated_steps(self.measurement, new)
+
+    def test_every_keylist_key_has_a_step(self):
+        keys = settings_fingerprint.keylist_keys()
+        self.assertIn("single lasers", keys)
+        self.assertEqual(settings_fingerprint.unmapped_keys(keys), [])
+
+    def test_change_invalidates_its_step_and_later(self):
+        later = [s for s in self.STEP if s >= self.STEP.STEP_SYN_PHASES_FILTERED]
+        self.assertEqual(self.changed("holography_settings", "filter radius", value=5.0), later)
+        self.assertEqual(self.changed("single lasers", "0", "lda_m", value=640e-9)[0], self.STEP.STEP_VIS_PHASES_RAW)
+        self.assertEqual(self.changed("height_conversion_settings", "convert_to_height_unit", value=2),
+                         [self.STEP.STEP_CONVERTED_TO_HEIGHT])
+        self.assertEqual(self.changed("holography_settings", "display phase", value=False), [])
+        self.assertEqual(self.changed("camera settings", "save_folder", value="D:/"), [])
+        self.assertEqual(self.changed("unknown_setting", value=1)[0], settings_fingerprint.UNKNOWN_STEP)
+
+    def test_member_never_counts_before_its_collection(self):
+        self.assertEqual(self.changed("reference_offset_result_settings", "x_center_roi_reference_point", value=20)[0],
+                         self.STEP.STEP_SYN_PHASES_COMBINED)
+        selected = settings_fingerprint.settings_at_step(self.measurement, self.STEP.STEP_CAM_CPX,
+                                                         after=self.STEP.STEP_CAM_IMAGE)
+        self.assertEqual(selected, {"single lasers": {"0": {"num phase steps": 4}}})
+
+    def test_struct_fingerprints(self):
+        modes, filters_settings = cuda_holo.HoloModes(), cuda_holo.Filters()
+        before = settings_fingerprint.step_fingerprints({}, [modes, filters_settings])
+        modes.step_return_after = self.STEP.STEP_CAM_CPX
+        self.assertEqual(settings_fingerprint.step_fingerprints({}, [modes, filters_settings]), before)
+        changed = cuda_holo.Filters()
+        changed.filterRadius = 7
+        self.assertEqual(settings_fingerprint.invalidated_steps({}, {}, [modes, filters_settings], [modes, changed])[0],
+                         self.STEP.STEP_VIS_PHASES_RAW)
+
+    def test_two_structs_of_one_type(self):
+        mean, gauss = cuda_holo.Filters(), cuda_holo.Filters()
+        gauss.filter_type = cuda_holo.FilterType.gauss_filter
+        step = self.STEP.STEP_SYN_PHASES_FILTERED
+        self.assertEqual(settings_fingerprint.fingerprint({}, step, [mean, gauss]),
+                         settings_fingerprint.fingerprint({}, step, [gauss, mean]))
+        self.assertNotEqual(settings_fingerprint.fingerprint({}, step, [mean, gauss]),
+                            settings_fingerprint.fingerprint({}, step, [mean, mean]))
+
+    def test_pipeline_stages_follow_the_key_steps(self):
+        stages = pipeline.default_stages()
+        new = copy.deepcopy(self.measurement)
+        new["synthetic wavelengths"]["combined_m"] = 2e-4
+        changed = [stage.step for stage in stages
+                   if stage.settings_hash(self.measurement) != stage.settings_hash(new)]
+        self.assertEqual(changed, [self.STEP.STEP_SYN_PHASES_COMBINED])
+
+
+if __name__ == "__main__":
+    unittest.main()